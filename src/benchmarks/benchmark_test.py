@@ -0,0 +1,20 @@
+import pytest
+
+from benchmarks.cases import case_id, cases, prepare
+
+# The benchmark matrix under pytest-benchmark, run from `src/`:
+#   python -m pytest benchmarks/ --benchmark-json=benchmark.json
+# Without pytest-benchmark installed the benchmarks are skipped.
+pytest.importorskip('pytest_benchmark')
+
+CASES = cases()
+
+@pytest.mark.parametrize('name, params', CASES, ids=[case_id(name, params) for name, params in CASES])
+def test_benchmark(benchmark, name, params):
+    try:
+        run = prepare(name, params)
+    except ValueError as e:
+        pytest.skip(str(e))
+
+    benchmark.extra_info.update(params)
+    benchmark(run)
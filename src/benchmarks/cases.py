@@ -0,0 +1,250 @@
+import importlib
+import importlib.util
+import inspect
+import os
+import random
+import tempfile
+
+from benchmarks.imports import CORE_MODULES, import_times
+from nltk_utils.datasets import generate_documents_pcfg
+from nltk_utils.graphs import is_transient
+from nltk_utils.pcfg.generate import generate_pcfg, generate_sentence_pcfg, sentence_in_pcfg
+from nltk_utils.utils import generate_nonterminals, generate_terminals
+
+# The benchmark matrix. Every case is a function and a dict of parameters, `prepare(case)` builds the grammar and inputs
+# outside of the timed part and returns a function without arguments that does the timed work.
+# All randomness comes from fixed seeds, so every run of a case does exactly the same work.
+# The cases also run against older versions of the package, to compare with a baseline: newer functions and arguments
+# are only used where they exist. Without them a case falls back to the old call, seeding the global `random` instead
+# of passing an rng, or it is skipped if the old version can not do its work (e.g. sentences of a given length).
+
+
+def _optional(module: str, name: str):
+    """`module.name`, or None in versions of the package that do not have it."""
+    try:
+        return getattr(importlib.import_module(module), name)
+    except (ImportError, AttributeError):
+        return None
+
+
+def _accepts(function, parameter: str) -> bool:
+    """Whether `function` takes the keyword argument `parameter`."""
+    return parameter in inspect.signature(function).parameters
+
+
+CorpusWriter = _optional('nltk_utils.datasets', 'CorpusWriter')
+can_sample = _optional('nltk_utils.pcfg.analysis', 'can_sample')
+derive_length = _optional('nltk_utils.sampling', 'derive_length')
+load_compiled = _optional('nltk_utils.store', 'load_compiled')
+save_compiled = _optional('nltk_utils.store', 'save_compiled')
+compile_grammar = _optional('nltk_utils.utils', 'compile_grammar')
+_compiled_cache = _optional('nltk_utils.utils', '_compiled_cache')
+
+SEED = 0
+
+# (terminals, nonterminals, rules)
+GRAMMAR_SIZES = [(5, 5, 10), (10, 10, 30), (20, 20, 80)]
+SENTENCE_LENGTHS = [10, 30, 100]
+CORPUS_SIZES = [100, 1000]
+# a grammar that is slow to parse, for loading compiled grammars. Larger alphabets have symbols that can not be parsed
+LARGE_GRAMMAR = (26, 25, 2000)
+
+# the number of calls in one timed run, so fast functions are not dominated by timer overhead
+N_GRAMMARS = 20
+N_SENTENCES = 200
+N_MEMBERSHIP = 20
+
+
+def cases(quick: bool = False) -> list[tuple[str, dict]]:
+    """
+    The benchmark cases as `(name, params)`.
+    - quick (`bool`): only the smallest size of every dimension, for a smoke test
+    """
+
+    sizes = GRAMMAR_SIZES[:1] if quick else GRAMMAR_SIZES
+    lengths = SENTENCE_LENGTHS[:1] if quick else SENTENCE_LENGTHS
+    corpus_sizes = CORPUS_SIZES[:1] if quick else CORPUS_SIZES
+
+    result = []
+    for n_terminals, n_nonterminals, n_rules in sizes:
+        size = {'terminals': n_terminals, 'nonterminals': n_nonterminals, 'rules': n_rules}
+        result.append(('generate_pcfg', size))
+        result.append(('is_transient', size))
+        result.append(('generate_sentence_pcfg', {**size, 'length': None}))
+        for length in lengths:
+            result.append(('generate_sentence_pcfg', {**size, 'length': length}))
+            result.append(('sentence_in_pcfg', {**size, 'length': length}))
+        for n_documents in corpus_sizes:
+            result.append(('generate_documents_pcfg', {**size, 'documents': n_documents, 'sentences': 5}))
+
+    # parsing the text against loading the compiled file, their ratio is the speed-up of `load_compiled`
+    n_terminals, n_nonterminals, n_rules = LARGE_GRAMMAR
+    large = {'terminals': n_terminals, 'nonterminals': n_nonterminals, 'rules': n_rules}
+    result.append(('compile_grammar', large))
+    result.append(('load_compiled', large))
+
+    # a fresh interpreter importing the core modules, see `benchmarks.imports`
+    result.append(('import', {'modules': len(CORE_MODULES)}))
+
+    return result
+
+
+def case_id(name: str, params: dict) -> str:
+    """A readable id of a case, e.g. `sentence_in_pcfg[terminals=5,nonterminals=5,rules=10,length=10]`."""
+    return f"{name}[{','.join(f'{key}={value}' for key, value in params.items())}]"
+
+
+def _generate_pcfg(terminals: list[str], nonterminals: list[str], n_rules: int, method: str, rng: random.Random) -> str:
+    """`generate_pcfg` with the given method and rng, or with the global `random` seeded from `rng` in old versions."""
+
+    if _accepts(generate_pcfg, 'rng'):
+        return generate_pcfg(terminals, nonterminals, n_rules, 0.5, method=method, rng=rng)
+
+    random.seed(rng.random())
+    return generate_pcfg(terminals, nonterminals, n_rules, 0.5)
+
+
+def benchmark_grammar(n_terminals: int, n_nonterminals: int, n_rules: int, seed: int = SEED) -> str:
+    """
+    The first constructive grammar of the seed that passes `can_sample`, the same grammar on every run.\\
+    Old versions have neither, there it is the first grammar that `is_transient`.
+    """
+
+    rng = random.Random(f'{seed}:{n_terminals}:{n_nonterminals}:{n_rules}')
+    terminals = generate_terminals(n_terminals)
+    nonterminals = generate_nonterminals(n_nonterminals)
+    samplable = can_sample if can_sample is not None else is_transient
+
+    for _ in range(1000):
+        grammar = _generate_pcfg(terminals, nonterminals, n_rules, 'constructive', rng)
+        if samplable(grammar):
+            return grammar
+
+    raise ValueError(f"No samplable grammar with {n_terminals} terminals, {n_nonterminals} nonterminals and {n_rules} rules.")
+
+
+def prepare(name: str, params: dict):
+    """
+    Build the inputs of a case and return the function to time.\\
+    Raises a ValueError if the case can not run, e.g. the grammar has no sentence of the requested length.
+    """
+
+    if name in ('compile_grammar', 'load_compiled'):
+        return _prepare_load(name, params)
+
+    if name == 'import':
+        modules = [module for module in CORE_MODULES if importlib.util.find_spec(module) is not None]
+
+        def run():
+            import_times(modules)
+        return run
+
+    grammar = benchmark_grammar(params['terminals'], params['nonterminals'], params['rules'])
+    compiled = compile_grammar(grammar, probabilistic=True) if compile_grammar is not None else grammar
+
+    if name == 'generate_pcfg':
+        terminals = generate_terminals(params['terminals'])
+        nonterminals = generate_nonterminals(params['nonterminals'])
+
+        def run():
+            rng = random.Random(SEED)
+            for _ in range(N_GRAMMARS):
+                _generate_pcfg(terminals, nonterminals, params['rules'], 'constructive', rng)
+        return run
+
+    if name == 'is_transient':
+        # the analysis is cached on the compiled grammar, drop it so every call analyses the grammar again
+        def run():
+            for _ in range(N_GRAMMARS):
+                if compile_grammar is not None:
+                    compiled.cache.pop(('graph_analysis', 'S'), None)
+                is_transient(compiled)
+        return run
+
+    if name == 'generate_sentence_pcfg':
+        length = params['length']
+        if length is not None:
+            if derive_length is None:
+                raise ValueError("Sentences of a given length need `derive_length`.")
+            # fills the length table outside of the timed part and checks that the length exists
+            derive_length(compiled, length, rng=random.Random(SEED))
+
+        if not _accepts(generate_sentence_pcfg, 'rng'):
+            def run():
+                random.seed(SEED)
+                for _ in range(N_SENTENCES):
+                    generate_sentence_pcfg(compiled, join_char='')
+            return run
+
+        def run():
+            rng = random.Random(SEED)
+            for _ in range(N_SENTENCES):
+                generate_sentence_pcfg(compiled, join_char='', rng=rng, length=length)
+        return run
+
+    if name == 'sentence_in_pcfg':
+        if derive_length is None:
+            raise ValueError("Sentences of a given length need `derive_length`.")
+
+        # half of the sentences are in the language, the other half have two tokens swapped
+        rng = random.Random(SEED)
+        sentences = []
+        for i in range(N_MEMBERSHIP):
+            tokens = [compiled.terminals[symbol] for symbol in derive_length(compiled, params['length'], rng=rng)]
+            if i % 2:
+                j = rng.randrange(len(tokens) - 1)
+                tokens[j], tokens[j + 1] = tokens[j + 1], tokens[j]
+            sentences.append(''.join(tokens))
+
+        def run():
+            for sentence in sentences:
+                sentence_in_pcfg(sentence, compiled)
+        return run
+
+    if name == 'generate_documents_pcfg':
+        if CorpusWriter is None or not _accepts(generate_documents_pcfg, 'seed'):
+            # old versions write into `documents/` of the working directory
+            def run():
+                cwd = os.getcwd()
+                with tempfile.TemporaryDirectory() as directory:
+                    os.chdir(directory)
+                    try:
+                        random.seed(SEED)
+                        generate_documents_pcfg(compiled, params['documents'], params['sentences'])
+                    finally:
+                        os.chdir(cwd)
+            return run
+
+        def run():
+            with tempfile.TemporaryDirectory() as directory:
+                with CorpusWriter(directory) as writer:
+                    generate_documents_pcfg(compiled, params['documents'], params['sentences'], seed=SEED, writer=writer)
+        return run
+
+    raise ValueError(f"Unknown benchmark '{name}'.")
+
+
+def _prepare_load(name: str, params: dict):
+    """The cases that read a large grammar. It does not have to be samplable, so it is not a `benchmark_grammar`."""
+
+    if compile_grammar is None or (name == 'load_compiled' and load_compiled is None):
+        raise ValueError(f"The case '{name}' needs `compile_grammar` and `nltk_utils.store`.")
+
+    rng = random.Random(f"{SEED}:{params['terminals']}:{params['nonterminals']}:{params['rules']}")
+    grammar = _generate_pcfg(generate_terminals(params['terminals']), generate_nonterminals(params['nonterminals']),
+                             params['rules'], 'direct', rng)
+
+    if name == 'compile_grammar':
+        def run():
+            # the grammar is cached by its text, drop the cache so every call parses it
+            _compiled_cache.clear()
+            compile_grammar(grammar, probabilistic=True)
+        return run
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'large.grammar')
+    save_compiled(grammar, path)
+
+    def run():
+        load_compiled(path)
+    return run
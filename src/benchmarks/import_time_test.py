@@ -0,0 +1,5 @@
+from benchmarks.imports import IMPORT_BUDGET, import_times
+
+def test_core_import_budget():
+    times, total = import_times()
+    assert total - times.get('numpy', 0) < IMPORT_BUDGET
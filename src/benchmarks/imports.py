@@ -0,0 +1,36 @@
+import importlib.util
+import os
+import subprocess
+import sys
+
+# The import time of the core of the package, measured with `python -X importtime` in a fresh interpreter.
+# Timings depend on the machine, so the budget is checked here and not by the unit tests, which only check
+# that nltk, tqdm and networkx are not imported (see `nltk_utils/pcfg/tests/import_test.py`).
+
+# the directory of the `nltk_utils` that is benchmarked, which is another checkout when comparing with a baseline
+SRC = os.path.dirname(os.path.dirname(importlib.util.find_spec('nltk_utils').origin))
+CORE_MODULES = ['nltk_utils.datasets', 'nltk_utils.pcfg.generate', 'nltk_utils.cfg.generate', 'nltk_utils.graphs', 'nltk_utils.pcfg.analysis']
+
+# microseconds, for everything the modules import except numpy. That is about 170ms here, importing nltk alone adds about 300ms
+IMPORT_BUDGET = 300_000
+
+
+def import_times(modules: list[str] = CORE_MODULES) -> tuple[dict[str, int], int]:
+    """
+    Import the modules in a fresh interpreter.
+    Returns the cumulative import time of every module and the total, in microseconds.
+    """
+
+    code = 'import ' + ', '.join(modules)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=SRC, capture_output=True, text=True, check=True)
+
+    times, total = {}, 0
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+        # nested imports are indented, the top level ones add up to the total
+        if not name[1:].startswith(' '):
+            total += int(cumulative)
+    return times, total
@@ -0,0 +1,121 @@
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+from benchmarks.cases import case_id, cases, prepare
+
+# Run the benchmark matrix and write the timings to JSON, run from `src/`:
+#   python -m benchmarks.run --output before.json
+#   python -m benchmarks.run --output after.json --compare before.json
+# Timings are only comparable between runs on the same machine.
+
+
+def time_case(run, repeat: int) -> list[float]:
+    """Time `repeat` calls of `run` after one untimed warm-up call, which also fills the grammar caches."""
+
+    run()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(quick: bool = False, repeat: int = 5, pattern: str | None = None) -> dict:
+    """Run all cases whose id contains `pattern` and return the report."""
+
+    results = []
+    for name, params in cases(quick):
+        identifier = case_id(name, params)
+        if pattern is not None and pattern not in identifier:
+            continue
+
+        try:
+            run = prepare(name, params)
+        except ValueError as e:
+            print(f'{identifier}: skipped, {e}', file=sys.stderr)
+            continue
+
+        times = time_case(run, repeat)
+        results.append({
+            'id': identifier,
+            'name': name,
+            'params': params,
+            'times': times,
+            'min': min(times),
+            'median': statistics.median(times),
+            'mean': statistics.mean(times),
+            'stdev': statistics.stdev(times) if len(times) > 1 else 0.0,
+        })
+        print(f"{identifier}: {min(times) * 1000:.2f} ms", file=sys.stderr)
+
+    return {
+        'commit': git_commit(),
+        'date': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def compare(report: dict, baseline: dict, threshold: float = 1.1) -> list[str]:
+    """Compare the best times of the cases in both reports. Returns the ids that got slower by more than `threshold`."""
+
+    baseline_times = {result['id']: result['min'] for result in baseline['results']}
+    regressions = []
+
+    print(f"{'case':<80} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    for result in report['results']:
+        before = baseline_times.get(result['id'])
+        if before is None:
+            continue
+        ratio = result['min'] / before
+        flag = ' !' if ratio > threshold else ''
+        print(f"{result['id']:<80} {before * 1000:>8.2f}ms {result['min'] * 1000:>8.2f}ms {ratio:>7.2f}{flag}")
+        if ratio > threshold:
+            regressions.append(result['id'])
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time grammar generation, sampling, membership, analysis and corpus writing.')
+    parser.add_argument('--output', default='benchmark.json', help='where to write the JSON report')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per case')
+    parser.add_argument('--quick', action='store_true', help='only the smallest sizes')
+    parser.add_argument('--filter', default=None, help='only run cases whose id contains this string')
+    parser.add_argument('--compare', default=None, help='a previous JSON report to compare against')
+    parser.add_argument('--threshold', type=float, default=1.1, help='slowdown ratio that counts as a regression')
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.quick, args.repeat, args.filter)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,8 @@
 from nltk_utils.datasets import generate_documents_pcfg, save_documents, save_grammar
 from nltk_utils.pcfg.generate import generate_pcfg, generate_sentence_pcfg, sentence_in_pcfg
 from nltk_utils.utils import to_pcfg, generate_nonterminals, generate_terminals
-from nltk_utils.graphs import is_transient, has_unproductive_rules
+from nltk_utils.graphs import is_transient
+from nltk_utils.pcfg.analysis import analyze_pcfg, can_sample
 
 
 # parameters for the PCFG
@@ -18,14 +19,14 @@ terminals = generate_terminals(N_TERMINALS)
 nonterminals = generate_nonterminals(N_NONTERMINALS)
 
 
-counter = 0 # count how many grammars were generated until one with no unproductive rules was found
+counter = 0 # count how many grammars were generated until one that terminates was found
 
-# generate pcfgs, until one is found that has no unproductive rules
+# generate pcfgs, until one is found whose derivations terminate
 while counter < TRIES:
-    # generate a random pcfg
-    grammar = generate_pcfg(terminals, nonterminals, N_RULES, PROB_TERMINAL)
-    # check if the pcfg has unproductive rules
-    if not has_unproductive_rules(grammar):
+    # generate a random pcfg, the constructive method never produces unproductive rules
+    grammar = generate_pcfg(terminals, nonterminals, N_RULES, PROB_TERMINAL, method='constructive')
+    # check if its derivations terminate, without sampling them
+    if can_sample(grammar):
         break
     counter += 1
 
@@ -35,6 +36,7 @@ if counter == 1000:
 
 print(f"Generated grammar after {counter} tries.")
 print(grammar)
+print(analyze_pcfg(grammar))
 
 # save the grammar
 save_grammar(grammar)
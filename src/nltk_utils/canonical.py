@@ -0,0 +1,219 @@
+from __future__ import annotations
+
+import hashlib
+import os
+from typing import TYPE_CHECKING
+
+from nltk_utils.utils import CompiledGrammar, compile_grammar, format_probability
+
+if TYPE_CHECKING:
+    import nltk
+
+# Canonical forms of grammars, to recognize grammars that are the same up to renaming their symbols.
+# Symbols are colored by refinement, like Weisfeiler-Lehman on the graph of symbols and productions: a symbol starts
+# with its kind (start symbol, nonterminal or terminal) and is split by the colors of the productions it occurs in,
+# and where. A production's color is its probability with the colors of its symbols. When the colors are stable but some
+# symbols still share one, the ties are broken exactly: every symbol of the first shared color is individualized
+# in turn and refined again, and the smallest canonical form of all branches wins. Automorphisms found on the way
+# (two branches with the same form) prune branches that would give the same forms again.
+# The canonical form is a grammar string with the start symbol `S`, nonterminals `N1, N2, ...`, terminals `t0, t1, ...`
+# and its productions sorted, so it does not depend on the names of the symbols or the order of the rules.
+
+
+def _refine(grammar: CompiledGrammar, colors: list[int]) -> list[int]:
+    """
+    Refine a coloring of the symbols (nonterminal `i` is `i`, terminal `j` is `len(nonterminals) + j`) until it is stable.\\
+    The colors are numbered by sorting their signatures, which only use earlier colors, so they never depend on the symbol names.
+    """
+
+    n_nonterminals = len(grammar.nonterminals)
+    probs = grammar.probs if grammar.probs is not None else [0.0] * grammar.n_productions
+
+    def index(symbol):
+        return symbol if symbol >= 0 else n_nonterminals + ~symbol
+
+    n_colors = len(set(colors))
+    while True:
+        occurrences = [[] for _ in colors]
+        for production, rhs in enumerate(grammar.rhs_tuples):
+            symbols = [index(symbol) for symbol in rhs]
+            signature = (probs[production], colors[grammar.lhs[production]], tuple(colors[symbol] for symbol in symbols))
+            occurrences[grammar.lhs[production]].append((-1, signature))
+            for position, symbol in enumerate(symbols):
+                occurrences[symbol].append((position, signature))
+
+        signatures = [(color, tuple(sorted(symbol_occurrences))) for color, symbol_occurrences in zip(colors, occurrences)]
+        colors = _number(signatures)
+
+        # refinement only ever splits colors, the coloring is stable once their number stops growing
+        if len(set(colors)) == n_colors:
+            return colors
+        n_colors = len(set(colors))
+
+
+def _number(signatures: list) -> list[int]:
+    """Replace every signature by its rank among the distinct signatures."""
+    ranks = {signature: rank for rank, signature in enumerate(sorted(set(signatures)))}
+    return [ranks[signature] for signature in signatures]
+
+
+def _form(grammar: CompiledGrammar, colors: list[int]) -> str:
+    """The grammar string of a coloring where every symbol has its own color."""
+
+    n_nonterminals = len(grammar.nonterminals)
+
+    # the start symbol always has the smallest color, then the nonterminals, then the terminals
+    nonterminal_order = sorted(range(n_nonterminals), key=lambda symbol: colors[symbol])
+    terminal_order = sorted(range(len(grammar.terminals)), key=lambda symbol: colors[n_nonterminals + symbol])
+    nonterminal_rank = {symbol: rank for rank, symbol in enumerate(nonterminal_order)}
+    terminal_rank = {symbol: rank for rank, symbol in enumerate(terminal_order)}
+
+    def name(rank):
+        return 'S' if rank == 0 else f'N{rank}'
+
+    productions = []
+    for production, rhs in enumerate(grammar.rhs_tuples):
+        # nonterminals sort before terminals on the right-hand side, like in the grammar strings of generate_pcfg
+        key = tuple((0, nonterminal_rank[symbol]) if symbol >= 0 else (1, terminal_rank[~symbol]) for symbol in rhs)
+        prob = grammar.probs[production] if grammar.probs is not None else None
+        productions.append((nonterminal_rank[grammar.lhs[production]], key, prob))
+    productions.sort(key=lambda production: (production[0], production[1], production[2] or 0.0))
+
+    lines = []
+    for lhs, rhs, prob in productions:
+        symbols = [name(rank) if kind == 0 else f'"t{rank}"' for kind, rank in rhs]
+        line = f'{name(lhs)} -> {" ".join(symbols)}'
+        if prob is not None:
+            line += f' [{format_probability(prob)}]'
+        lines.append(line)
+
+    return '\n'.join(lines)
+
+
+def _orbit_representatives(cell: list[int], automorphisms: list[list[int]]) -> list[int]:
+    """The first symbol of every orbit of `cell` under the group generated by `automorphisms`."""
+
+    parent = {symbol: symbol for symbol in cell}
+
+    def find(symbol):
+        while parent[symbol] != symbol:
+            parent[symbol] = parent[parent[symbol]]
+            symbol = parent[symbol]
+        return symbol
+
+    for automorphism in automorphisms:
+        for symbol in cell:
+            image = automorphism[symbol]
+            if image in parent:
+                a, b = find(symbol), find(image)
+                if a != b:
+                    parent[max(a, b)] = min(a, b)
+
+    return [symbol for symbol in cell if find(symbol) == symbol]
+
+
+def canonical_form(grammar: str | nltk.CFG | nltk.PCFG | CompiledGrammar) -> str:
+    """
+    The canonical form of a grammar: the same string for every grammar that only differs in the names of its symbols
+    and the order of its rules, see the top of this module.\\
+    The refinement alone decides almost every random grammar. The exact search over ties is exponential in the worst case,
+    for grammars with many interchangeable symbols, but automorphisms keep it small for the symmetries that occur in practice.
+    """
+
+    grammar = compile_grammar(grammar)
+
+    form = grammar.cache.get('canonical_form')
+    if form is not None:
+        return form
+
+    n_nonterminals = len(grammar.nonterminals)
+    colors = [0 if symbol == grammar.start else 1 for symbol in range(n_nonterminals)] + [2] * len(grammar.terminals)
+
+    leaves = {}          # form -> the coloring of the first branch that gave it
+    automorphisms = []   # symbol permutations, from two branches with the same form
+
+    def search(colors: list[int], path: list[int]) -> str:
+        colors = _refine(grammar, colors)
+
+        # the first color that is shared by several symbols
+        cells = {}
+        for symbol, color in enumerate(colors):
+            cells.setdefault(color, []).append(symbol)
+        shared = [cell for color, cell in sorted(cells.items()) if len(cell) > 1]
+        if not shared:
+            form = _form(grammar, colors)
+            other = leaves.setdefault(form, colors)
+            if other is not colors:
+                # map every symbol to the symbol with the same color in the other branch
+                by_color = {color: symbol for symbol, color in enumerate(other)}
+                automorphisms.append([by_color[color] for color in colors])
+            return form
+
+        best = None
+        for symbol in shared[0]:
+            # only the automorphisms that fix the symbols individualized so far may prune this cell
+            fixing = [automorphism for automorphism in automorphisms if all(automorphism[v] == v for v in path)]
+            if symbol not in _orbit_representatives(shared[0], fixing):
+                continue
+            # individualize the symbol: it keeps the color of the cell, the other symbols of the cell come after it
+            individualized = _number([(color, other != symbol and color == colors[symbol]) for other, color in enumerate(colors)])
+            form = search(individualized, path + [symbol])
+            if best is None or form < best:
+                best = form
+
+        return best
+
+    form = grammar.cache['canonical_form'] = search(colors, [])
+    return form
+
+
+def canonical_hash(grammar: str | nltk.CFG | nltk.PCFG | CompiledGrammar) -> str:
+    """
+    The hash of the canonical form of a grammar.\\
+    Two grammars have the same canonical hash iff they are the same up to renaming their symbols and reordering their rules.
+    """
+
+    grammar = compile_grammar(grammar)
+
+    digest = grammar.cache.get('canonical_hash')
+    if digest is None:
+        digest = grammar.cache['canonical_hash'] = hashlib.sha1(canonical_form(grammar).encode('utf-8')).hexdigest()
+
+    return digest
+
+
+class GrammarSet:
+    """
+    A set of grammars up to renaming, by their canonical hashes, to skip grammars that were seen before in O(1).\\
+    With a `path`, the hashes are read from that file and every new hash is appended to it, so the set is kept between runs.
+    - path (`str`): a text file with one canonical hash per line, created if it does not exist
+    """
+
+    def __init__(self, path: str | None = None):
+
+        self.path = path
+        self._hashes = set()
+
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self._hashes.update(line.strip() for line in f if line.strip())
+
+    def add(self, grammar: str | nltk.CFG | nltk.PCFG | CompiledGrammar) -> bool:
+        """Add a grammar. Returns True if no grammar with the same canonical form was in the set."""
+
+        digest = canonical_hash(grammar)
+        if digest in self._hashes:
+            return False
+
+        self._hashes.add(digest)
+        if self.path is not None:
+            with open(self.path, 'a') as f:
+                f.write(digest + '\n')
+
+        return True
+
+    def __contains__(self, grammar: str | nltk.CFG | nltk.PCFG | CompiledGrammar) -> bool:
+        return canonical_hash(grammar) in self._hashes
+
+    def __len__(self) -> int:
+        return len(self._hashes)
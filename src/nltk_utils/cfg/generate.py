@@ -1,8 +1,19 @@
-import nltk
+from __future__ import annotations
+
 import random
-import itertools
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from nltk_utils.derivation import get_engine
+from nltk_utils.language import enumerate_language
+from nltk_utils.recognizers import CYKRecognizer, EarleyRecognizer, get_cyk_recognizer, get_earley_recognizer, recognize_many
+from nltk_utils.sampling import derive_length, get_count_table
+from nltk_utils.utils import CompiledGrammar, compile_grammar, to_cfg
 
-from nltk_utils.utils import to_cfg
+# nltk is slow to import, it is only loaded when nltk objects or parsers are asked for
+if TYPE_CHECKING:
+    import nltk
 
 # this grammar can be used to generate a random grammar
 # before generating rules, insert terminal and nonterminal symbols
@@ -16,7 +27,14 @@ meta_grammar = [
 ]
 
 # generate a random valid sentence from the grammar
-def generate_random_sentence(grammar: str | nltk.CFG, join_char=' '):
+def generate_random_sentence(grammar: str | nltk.CFG | CompiledGrammar, join_char=' ', engine='rewrite', rng=random):
+    """
+    Generate a random sentence from the given CFG grammar, every production of a nonterminal is equally likely.
+    - engine (`str`): the derivation engine, see `nltk_utils.derivation.ENGINES`.
+    `'rewrite'` expands a random nonterminal on every step and reproduces the sentences of earlier versions for a fixed seed,
+    `'stack'` uses a leftmost derivation with O(1) sampling and is faster, with the same distribution.
+    - rng: the random number generator, the `random` module or a `random.Random` instance
+    """
 
     # how often to try to generate a valid sentence
     # if we fail, we raise a ValueError
@@ -26,46 +44,60 @@ def generate_random_sentence(grammar: str | nltk.CFG, join_char=' '):
     # after this many iterations, we give up and try again
     max_iterations = 10000
 
-    # Ensure the grammar is an CFG object
-    grammar = to_cfg(grammar)
+    # Ensure the grammar is compiled, strings are only parsed once
+    grammar = compile_grammar(grammar, probabilistic=False)
+    derive = get_engine(engine)
 
     for current_try in range(max_tries):
 
-        current_iteration = 0
-        sentence = [grammar.start()]
-
-        # as long as there are non-terminals in the sentence
-        while any(nltk.grammar.is_nonterminal(symbol) for symbol in sentence):
-
-            # find the non-terminals
-            non_terminals = [i for i, symbol in enumerate(sentence) if nltk.grammar.is_nonterminal(symbol)]
-
-            if not non_terminals:
-                break  # we are done, there are only non-terminals in the sentence
-
-            # randomly choose a non-terminal to expand
-            nt_index = random.choice(non_terminals)
-            symbol = sentence[nt_index]
-
-            # randomly choose a production for the non-terminal
-            productions = grammar.productions(lhs=symbol)
-            
-            production = random.choice(productions)
-
-            # replace the non-terminal with the production
-            sentence = sentence[:nt_index] + list(production.rhs()) + sentence[nt_index+1:]
+        sentence = derive(grammar, max_iterations, rng)
 
-            # avoid infinite loops
-            current_iteration += 1
-            if current_iteration > max_iterations:
-                break
-        
         # if the sentence is valid, return it
-        if not any(nltk.grammar.is_nonterminal(symbol) for symbol in sentence):
-            return join_char.join(str(symbol) for symbol in sentence)
+        if sentence is not None:
+            return join_char.join(grammar.terminals[symbol] for symbol in sentence)
 
     raise ValueError("The grammar is too complex to generate a valid sentence.")
 
+# generate a sentence of a given length, every derivation of that length is equally likely
+def generate_uniform_sentence(grammar: str | nltk.CFG | CompiledGrammar, length: int | None = None, join_char=' ', rng=random,
+                              min_length: int | None = None, max_length: int | None = None) -> str:
+    """
+    Generate a random sentence with exactly `length` terminals, uniformly among all derivations of that length.\\
+    `generate_random_sentence` picks every production with the same probability, which strongly favors short derivations.
+    Here the number of derivations of every length is counted per nonterminal with exact integers (see `count_derivations`),
+    and the derivation is drawn top-down in proportion to these counts, so no sentence is ever rejected.
+    For an unambiguous grammar this is uniform over the sentences of that length.
+    - length (`int`): the number of terminals
+    - min_length, max_length (`int`): instead of `length`, draw uniformly among all derivations with `min_length..max_length` terminals
+    - rng: the random number generator, the `random` module or a `random.Random` instance
+    """
+
+    # Ensure the grammar is compiled, strings are only parsed once
+    grammar = compile_grammar(grammar, probabilistic=False)
+
+    if length is None and max_length is None:
+        raise ValueError("Either length or max_length must be given.")
+
+    sentence = derive_length(grammar, length, min_length, max_length, rng, table=get_count_table(grammar))
+    return join_char.join(grammar.terminals[symbol] for symbol in sentence)
+
+# counts the derivations of every length
+def count_derivations(grammar: str | nltk.CFG | CompiledGrammar, max_length: int) -> list[int]:
+    """
+    Return the number of derivations of the start symbol with exactly `0..max_length` terminals, as exact integers.\\
+    For an unambiguous grammar these are the numbers of sentences of every length.
+    The counts are computed once per grammar and extended when a longer `max_length` is asked for.
+    """
+
+    # Ensure the grammar is compiled, strings are only parsed once
+    grammar = compile_grammar(grammar, probabilistic=False)
+
+    table = get_count_table(grammar)
+    if max_length > table.max_length:
+        table.extend(max_length)
+
+    return table.inside[grammar.start][:max_length + 1]
+
 # this function generates a random grammar
 def generate_random_grammar(terminals, nonterminals, n_rules=5):
     assert n_rules >= len(nonterminals), "There must be at least as many rules as nonterminals (n_rules >= len(nonterminals))"
@@ -118,8 +150,22 @@ def generate_random_grammar(terminals, nonterminals, n_rules=5):
     return random_rules
 
 # checks if a sentence is in the grammar
-def sentence_in_grammar(sentence: str, grammar: str | nltk.CFG) -> bool:
-    
+def sentence_in_grammar(sentence: str, grammar: str | nltk.CFG | CompiledGrammar, parser='auto') -> bool:
+    """
+    Check if the grammar generates the sentence, every character of the sentence is a terminal.
+    - parser (`str`): `'cyk'` uses the bitset CYK recognizer, which needs a grammar in Chomsky normal form (unary rules are fine),
+    `'earley'` uses nltk's `EarleyChartParser`. `'auto'` uses CYK whenever the grammar allows it.
+    The CYK recognizer is built once per grammar and cached.
+    """
+
+    if parser not in ('auto', 'cyk', 'earley'):
+        raise ValueError(f"Unknown parser '{parser}', choose one of ['auto', 'cyk', 'earley'].")
+
+    if parser != 'earley':
+        compiled = compile_grammar(grammar, probabilistic=False)
+        if parser == 'cyk' or CYKRecognizer.supports(compiled):
+            return get_cyk_recognizer(compiled).recognize(list(sentence))
+
     # Ensure the grammar is an CFG object
     grammar = to_cfg(grammar)
     
@@ -127,37 +173,61 @@ def sentence_in_grammar(sentence: str, grammar: str | nltk.CFG) -> bool:
     tokens = list(sentence)
     
     # Initialize the parser with the given grammar
-    parser = nltk.parse.EarleyChartParser(grammar)
+    from nltk.parse import EarleyChartParser
+    parser = EarleyChartParser(grammar)
     
     # Attempt to parse the tokenized sentence
     try:
-        # Generate all possible parse trees for the sentence
-        for parse in parser.parse(tokens):
-            # If at least one parse tree is found, the sentence can be generated by the grammar
-            return True
+        chart = parser.chart_parse(tokens)
     except ValueError as e:
         # Catch and handle the case where the sentence contains tokens not in the grammar
         return False
     
-    # If no parse trees are found, the sentence cannot be generated by the grammar
+    # The sentence can be generated by the grammar if there is a complete edge for the start symbol that spans it.
+    # Extracting the parse trees is not needed, and nltk refuses to do so for highly ambiguous sentences
+    for edge in chart.select(start=0, end=len(tokens), is_complete=True, lhs=grammar.start()):
+        return True
+    
+    # If no such edge is found, the sentence cannot be generated by the grammar
     return False
 
-# a generator that generates all valid strings for a given grammar until a given length
-def generate_valid_strings(terminals, grammar: str | nltk.CFG, max_length=5):
-    
-    # Ensure the grammar is an CFG object
-    grammar = to_cfg(grammar)
+# checks many sentences at once, sharing the chart of common prefixes
+def sentences_in_grammar(sentences, grammar: str | nltk.CFG | CompiledGrammar, parser='auto', chunk_size=65536) -> np.ndarray:
+    """
+    Check for every sentence if the grammar generates it, like `sentence_in_grammar`, and return a boolean NumPy array.\\
+    The sentences are checked in sorted order, so the chart columns of a prefix shared by several sentences are only computed once.
+    `sentences` can be a list or a streaming iterator, it is read `chunk_size` sentences at a time.
+    - parser (`str`): `'cyk'` uses the bitset CYK recognizer, which needs a grammar in Chomsky normal form (unary rules are fine),
+    `'earley'` uses an Earley recognizer on the compiled grammar. `'auto'` uses CYK whenever the grammar allows it.
+    Grammars with empty productions are checked one sentence at a time with nltk.
+    """
+
+    if parser not in ('auto', 'cyk', 'earley'):
+        raise ValueError(f"Unknown parser '{parser}', choose one of ['auto', 'cyk', 'earley'].")
 
-    # Iterate over all lengths of strings
-    for length in range(1, max_length + 1):
-        # Generate all combinations with repetition of the current length
-        for word in itertools.product(terminals, repeat=length):
-            # Join the characters to form a string
-            sentence = ''.join(word)
+    # Ensure the grammar is compiled, strings are only parsed once
+    compiled = compile_grammar(grammar, probabilistic=False)
 
-            # Check if the sentence is in the grammar
-            in_grammar = sentence_in_grammar(sentence, grammar)
+    if parser == 'cyk' or (parser == 'auto' and CYKRecognizer.supports(compiled)):
+        recognizer = get_cyk_recognizer(compiled)
+    elif EarleyRecognizer.supports(compiled):
+        recognizer = get_earley_recognizer(compiled)
+    else:
+        return np.fromiter((sentence_in_grammar(sentence, compiled, parser='earley') for sentence in sentences), dtype=np.bool_)
 
-            # If the sentence is in the grammar, yield it
-            if in_grammar:
-                yield sentence
\ No newline at end of file
+    return recognize_many(recognizer, sentences, chunk_size)
+
+# a generator that generates all valid strings for a given grammar until a given length
+def generate_valid_strings(terminals, grammar: str | nltk.CFG | CompiledGrammar, max_length=5):
+    """
+    Yield all strings of the grammar made of `terminals` with at most `max_length` characters, shortest first.\\
+    The strings are built from the grammar with dynamic programming instead of parsing every combination of terminals,
+    they come in the same order as before: by length, then in `itertools.product(terminals)` order.
+    """
+
+    # Ensure the grammar is compiled, strings are only parsed once
+    grammar = compile_grammar(grammar, probabilistic=False)
+
+    for word in enumerate_language(grammar, max_length, terminals=list(terminals)):
+        # Join the characters to form a string
+        yield ''.join(word)
\ No newline at end of file
@@ -0,0 +1,24 @@
+import math
+import random
+from collections import Counter
+
+from nltk_utils.cfg.generate import count_derivations, generate_uniform_sentence
+
+def test_count_derivations_are_catalan_numbers():
+    counts = count_derivations('S -> S S | "a"', 60)
+    assert counts[0] == 0
+    assert all(counts[n] == math.comb(2 * (n - 1), n - 1) // n for n in range(1, 61))
+
+def test_uniform_sentence_is_uniform_over_derivations():
+    # an unambiguous grammar, the 5 sentences of length 10 must be equally likely
+    grammar = 'S -> A\nA -> "a" A "b" A | "c"'
+    assert count_derivations(grammar, 10)[10] == 5
+
+    random.seed(0)
+    n = 10000
+    counts = Counter(generate_uniform_sentence(grammar, 10, '') for _ in range(n))
+    assert len(counts) == 5 and all(len(sentence) == 10 for sentence in counts)
+
+    # chi-square against the uniform distribution, 4 degrees of freedom, 0.1% critical value is 18.5
+    chi2 = sum((count - n / 5) ** 2 / (n / 5) for count in counts.values())
+    assert chi2 < 18.5
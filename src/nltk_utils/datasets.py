@@ -1,23 +1,335 @@
-import nltk
 import os
-from tqdm import tqdm
+import gzip
+import json
+import lzma
+import random
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import numpy as np
 
-from nltk_utils.utils import generate_nonterminals, generate_terminals, to_grammar
-from nltk_utils.graphs import is_transient
-from nltk_utils.pcfg.generate import generate_pcfg, generate_sentence_pcfg
+from nltk_utils import instrumentation
+from nltk_utils.canonical import GrammarSet
+from nltk_utils.dedup import SentenceDeduplicator
+from nltk_utils.store import GrammarCatalog, grammar_sizes, load_compiled, save_compiled
+from nltk_utils.derivation import Derivation
+from nltk_utils.utils import compile_grammar, generate_nonterminals, generate_terminals, to_grammar
+from nltk_utils.pcfg.generate import generate_pcfg, generate_sentence_pcfg, generate_sentences_batch
 
 # Saving documents
-def generate_document_pcfg(grammar, n_sentences=5, token_join_char=' ', sentence_join_char='.'):
+def generate_document_pcfg(grammar, n_sentences=5, token_join_char=' ', sentence_join_char='.', engine='rewrite', rng=random):
     """Generate a document from the grammar by generating sentences."""
-    sentences = [generate_sentence_pcfg(grammar, join_char=token_join_char) for _ in range(n_sentences)]
+    grammar = compile_grammar(grammar, probabilistic=True)
+    sentences = [generate_sentence_pcfg(grammar, join_char=token_join_char, engine=engine, rng=rng) for _ in range(n_sentences)]
     return sentence_join_char.join(sentences) + sentence_join_char
 
-def generate_documents_pcfg(grammar, n_documents=5, n_sentences=5, token_join_char=' ', sentence_join_char='.', filename_prefix='document'):
-    """Generate multiple documents from the grammar and save them to files."""
-    for i in tqdm(range(n_documents)):
-        document = generate_document_pcfg(grammar, n_sentences, token_join_char, sentence_join_char)
-        filename = f'{filename_prefix}_{i+1}.txt'
-        save_document(document, filename)
+def generate_documents_pcfg(grammar, n_documents=5, n_sentences=5, token_join_char=' ', sentence_join_char='.', filename_prefix='document',
+                            n_workers=1, seed=None, shard_size=1000, engine='rewrite', writer: 'CorpusWriter | None' = None,
+                            dedup: 'SentenceDeduplicator | str | None' = None, checkpoint: str | None = None,
+                            seen: GrammarSet | None = None):
+    """
+    Generate multiple documents from the grammar and save them to files.\\
+    With `n_workers > 1` or a `seed`, the documents are split into shards of `shard_size` documents.
+    Every shard has its own random number generator seeded from `seed` and the shard index,
+    so the documents are byte-identical no matter how many workers generate them.
+    - n_workers (`int`): the number of worker processes. With instrumentation enabled, their counters are merged
+    into the counters of this process, see `nltk_utils.instrumentation`.
+    - seed: the root seed. If `None`, it is drawn from the `random` module.
+    - shard_size (`int`): the number of documents per shard
+    - engine (`str`): the derivation engine, see `generate_sentence_pcfg`
+    - writer (`CorpusWriter`): write the documents into the shards of this writer, in order, instead of one file per document.
+    The writer is not closed.
+    - dedup (`SentenceDeduplicator | str`): only keep sentences that were not generated before, `'exact'`, `'bloom'`
+    or a `SentenceDeduplicator` (e.g. a Bloom filter with another false-positive rate, or one shared between runs).
+    The documents are filled with distinct sentences, generation stops early when the deduplicator is saturated,
+    so fewer than `n_documents` documents may be written. The distinct sentences that are left over then,
+    fewer than `n_sentences`, are dropped: every document has exactly `n_sentences` sentences.
+    Returns the deduplicator, its `stats()` has the duplicate rate and `saturated` tells if generation stopped early.
+    The deduplicator must be able to saturate (`min_yield > 0`), a finite language would be sampled forever otherwise.
+    - checkpoint (`str`): the path of a JSON checkpoint, makes the run resumable. After every shard that is written out,
+    the completed shards and the state of the writer (records, byte offsets and file sizes) are saved atomically.
+    Running the same call again after a crash skips the completed shards, cuts the writer's files back to the checkpoint
+    and continues, the output is identical to an uninterrupted run. The root seed is kept in the checkpoint,
+    the random number generator of every shard is derived from it. Not supported with `dedup`.
+    - seen (`GrammarSet`): skip grammars that are in this set up to renaming their symbols, nothing is generated for them
+    and None is returned. Otherwise the grammar is added to the set once all documents are written, a run that fails
+    is not skipped next time. A run that continues from an existing checkpoint is never skipped.
+    """
+
+    # compile the grammar once instead of parsing it for every sentence
+    grammar = compile_grammar(grammar, probabilistic=True)
+
+    if seen is not None and grammar in seen and not (checkpoint is not None and os.path.exists(checkpoint)):
+        print("Skipping a grammar that was seen before")
+        return None
+
+    result = _generate_documents(grammar, n_documents, n_sentences, token_join_char, sentence_join_char, filename_prefix,
+                                 n_workers, seed, shard_size, engine, writer, dedup, checkpoint)
+
+    if seen is not None:
+        seen.add(grammar)
+
+    return result
+
+def _generate_documents(grammar, n_documents, n_sentences, token_join_char, sentence_join_char, filename_prefix,
+                        n_workers, seed, shard_size, engine, writer, dedup, checkpoint):
+    """Generate the documents of `generate_documents_pcfg` from a compiled grammar. Returns the deduplicator, if any."""
+
+    # tqdm is only imported by the process that shows the progress, not by the workers
+    from tqdm import tqdm
+
+    if dedup is not None:
+        if checkpoint is not None:
+            raise ValueError("Checkpoints are not supported with deduplication, the deduplicator can not be restored.")
+        if isinstance(dedup, str):
+            dedup = SentenceDeduplicator(dedup)
+        if dedup.min_yield <= 0:
+            raise ValueError("The deduplicator never saturates (min_yield = 0), generation would not stop on a finite language.")
+        if seed is None:
+            seed = random.getrandbits(64)
+        _generate_documents_dedup(grammar, dedup, n_documents, n_sentences, token_join_char, sentence_join_char,
+                                  filename_prefix, n_workers, seed, shard_size, engine, writer)
+        return dedup
+
+    if n_workers == 1 and seed is None and checkpoint is None:
+        for i in tqdm(range(n_documents)):
+            document = generate_document_pcfg(grammar, n_sentences, token_join_char, sentence_join_char, engine=engine)
+            if writer is not None:
+                writer.write(document)
+                continue
+            filename = f'{filename_prefix}_{i+1}.txt'
+            save_document(document, filename)
+        return
+
+    job = None
+    if checkpoint is not None:
+        job = _load_checkpoint(checkpoint, grammar, n_documents, n_sentences, token_join_char, sentence_join_char,
+                               filename_prefix, seed, shard_size, engine, writer)
+        seed = job['seed']
+
+    if seed is None:
+        seed = random.getrandbits(64)
+
+    shards = [(start, min(start + shard_size, n_documents)) for start in range(0, n_documents, shard_size)]
+    document_args = (n_sentences, token_join_char, sentence_join_char, engine)
+
+    # shards that a checkpoint says are complete are not generated again
+    if job is None:
+        completed = set()
+    elif writer is None:
+        completed = set(job['completed'])
+    else:
+        completed = set(range(job['next_shard']))
+
+    # shards can finish out of order, a writer gets them in order
+    pending = {}
+    next_shard = min(set(range(len(shards))) - completed, default=len(shards))
+
+    def save_checkpoint():
+        if job is None:
+            return
+        if writer is None:
+            job['completed'] = sorted(completed)
+        else:
+            job['next_shard'] = next_shard
+            job['writer'] = writer.checkpoint()
+        job['documents'] = sum(shards[index][1] - shards[index][0] for index in completed)
+        _save_checkpoint(checkpoint, job)
+
+    def save_shard(index, documents):
+        nonlocal next_shard
+
+        if writer is None:
+            for i, document in enumerate(documents, start=shards[index][0]):
+                save_document(document, f'{filename_prefix}_{i+1}.txt')
+            completed.add(index)
+            save_checkpoint()
+            return
+
+        pending[index] = documents
+        while next_shard in pending:
+            writer.write_many(pending.pop(next_shard))
+            completed.add(next_shard)
+            next_shard += 1
+            save_checkpoint()
+
+    todo = [index for index in range(len(shards)) if index not in completed]
+    initial = sum(shards[index][1] - shards[index][0] for index in completed)
+
+    with tqdm(total=n_documents, initial=initial, unit='doc') as progress:
+        if n_workers == 1:
+            _init_worker(grammar)
+            for index in todo:
+                start, stop = shards[index]
+                save_shard(index, _generate_shard(shard_seed(seed, index), stop - start, document_args))
+                progress.update(stop - start)
+            return
+
+        # the grammar is sent to every worker once, the tasks only carry the shard parameters.
+        # at most 2 shards per worker are submitted or waiting for the writer at a time, so memory does not grow with n_documents
+        window = 2 * n_workers
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(grammar, instrumentation.enabled)) as executor:
+            futures = {}
+            submitted = 0
+            while submitted < len(todo) or futures:
+                while submitted < len(todo) and len(futures) + len(pending) < window:
+                    index = todo[submitted]
+                    futures[executor.submit(_worker_task, _generate_shard, shard_seed(seed, index), shards[index][1] - shards[index][0], document_args)] = index
+                    submitted += 1
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    documents = _worker_result(future)
+                    save_shard(futures.pop(future), documents)
+                    progress.update(len(documents))
+
+def _load_checkpoint(path: str, grammar, n_documents, n_sentences, token_join_char, sentence_join_char,
+                     filename_prefix, seed, shard_size, engine, writer) -> dict:
+    """
+    Load the checkpoint of a job and restore the writer, or start a new job if there is no checkpoint yet.\\
+    Raises a ValueError if the checkpoint belongs to a job with other parameters.
+    """
+
+    params = {
+        'grammar': grammar.content_hash,
+        'n_documents': n_documents,
+        'n_sentences': n_sentences,
+        'token_join_char': token_join_char,
+        'sentence_join_char': sentence_join_char,
+        'filename_prefix': filename_prefix if writer is None else None,
+        'shard_size': shard_size,
+        'engine': engine,
+        'writer': None if writer is None else {'directory': os.path.abspath(writer.directory), 'prefix': writer.prefix,
+                                               'format': writer.format, 'compression': writer.compression,
+                                               'max_shard_bytes': writer.max_shard_bytes},
+    }
+
+    if not os.path.exists(path):
+        job = {'params': params, 'seed': random.getrandbits(64) if seed is None else seed, 'documents': 0}
+        if writer is None:
+            job['completed'] = []
+        else:
+            job['next_shard'] = 0
+            job['writer'] = writer.checkpoint()
+        _save_checkpoint(path, job)
+        return job
+
+    with open(path) as f:
+        job = json.load(f)
+
+    if job['params'] != params:
+        changed = [key for key in params if job['params'].get(key) != params[key]]
+        raise ValueError(f"The checkpoint {path} belongs to a job with other parameters: {changed}.")
+    if seed is not None and seed != job['seed']:
+        raise ValueError(f"The checkpoint {path} was written with the seed {job['seed']!r}, not {seed!r}.")
+
+    if writer is not None:
+        writer.restore(job['writer'])
+
+    return job
+
+def _save_checkpoint(path: str, job: dict) -> None:
+    """Write the checkpoint to a temporary file and move it over the old one, a crash leaves either the old or the new checkpoint."""
+    temporary = f'{path}.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(job, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+def _generate_documents_dedup(grammar, dedup: SentenceDeduplicator, n_documents, n_sentences, token_join_char, sentence_join_char,
+                              filename_prefix, n_workers, seed, shard_size, engine, writer):
+    """
+    Generate sentences in shards, drop the duplicates and group the distinct sentences into documents.\\
+    The number of shards is not known in advance, so they are generated in rounds of `n_workers` shards
+    and deduplicated in shard order, the output only depends on the seed.
+    """
+
+    from tqdm import tqdm
+
+    sentence_args = (token_join_char, engine)
+    sentences_per_shard = shard_size * n_sentences
+    distinct = []
+    n_written = 0
+
+    def save(sentences):
+        nonlocal n_written
+        document = sentence_join_char.join(sentences) + sentence_join_char
+        if writer is not None:
+            writer.write(document)
+        else:
+            save_document(document, f'{filename_prefix}_{n_written+1}.txt')
+        n_written += 1
+
+    def consume(sentences) -> bool:
+        """Deduplicate one shard of sentences and save the full documents. Returns True when generation is done."""
+        for sentence in sentences:
+            if dedup.add(sentence):
+                distinct.append(sentence)
+                if len(distinct) == n_sentences:
+                    save(distinct)
+                    distinct.clear()
+                    progress.update(1)
+                    if n_written == n_documents:
+                        return True
+        return dedup.saturated
+
+    shard = 0
+    with tqdm(total=n_documents, unit='doc') as progress:
+        if n_workers == 1:
+            _init_worker(grammar)
+            while not consume(_generate_sentence_shard(shard_seed(seed, shard), sentences_per_shard, sentence_args)):
+                shard += 1
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(grammar, instrumentation.enabled)) as executor:
+                done = False
+                while not done:
+                    futures = [executor.submit(_worker_task, _generate_sentence_shard, shard_seed(seed, index), sentences_per_shard, sentence_args)
+                               for index in range(shard, shard + n_workers)]
+                    shard += n_workers
+                    for future in futures:
+                        if consume(_worker_result(future)):
+                            done = True
+                            break
+                    if done:
+                        for future in futures:
+                            future.cancel()
+
+def shard_seed(seed, shard: int) -> str:
+    """Derive the seed of a shard from the root seed. String seeds are hashed by `random.Random`, so this is stable across processes."""
+    return f'{seed}:{shard}'
+
+# the grammar of a worker process, set once by the pool initializer
+_worker_grammar = None
+
+def _init_worker(grammar, instrumented: bool | None = None):
+    global _worker_grammar
+    _worker_grammar = grammar
+    # only worker processes get the instrumentation flag of the parent. A forked worker starts with a copy
+    # of the counters of the parent, it clears them to only send back what it records itself
+    if instrumented is not None:
+        instrumentation.reset()
+        if instrumented:
+            instrumentation.enable()
+
+def _worker_task(function, *args):
+    """Run a task in a worker process, returns its result and the counters it recorded, see `instrumentation.take`."""
+    return function(*args), instrumentation.take() if instrumentation.enabled else None
+
+def _worker_result(future):
+    """The result of a `_worker_task`, its counters are merged into the counters of this process."""
+    result, counters = future.result()
+    if counters is not None:
+        instrumentation.merge(counters)
+    return result
+
+def _generate_shard(seed, n_documents, document_args):
+    """Generate the documents of one shard with its own random number generator."""
+    rng = random.Random(seed)
+    return [generate_document_pcfg(_worker_grammar, *document_args, rng=rng) for _ in range(n_documents)]
+
+def _generate_sentence_shard(seed, n_sentences, sentence_args):
+    """Generate the sentences of one shard with its own random number generator, for deduplication."""
+    rng = random.Random(seed)
+    join_char, engine = sentence_args
+    return [generate_sentence_pcfg(_worker_grammar, join_char=join_char, engine=engine, rng=rng) for _ in range(n_sentences)]
 
 def save_document(document, filename):
     """Save the document to a file."""
@@ -29,46 +341,447 @@ def save_document(document, filename):
     with open('documents/' + filename, 'w') as file:
         file.write(document)
 
-def save_documents(documents, suffix: str = "default"):
+def save_documents(documents, suffix: str = "default", writer: 'CorpusWriter | None' = None):
+    """
+    Save a list of documents to `documents/documents_{suffix}.txt`.
+    If a `CorpusWriter` is given, the documents are streamed into its shards instead.
+    """
+
+    if writer is not None:
+        writer.write_many(documents)
+        return
+
     with open(f'documents/documents_{suffix}.txt', "w") as f:
         f.write(str(documents))
 
+class CorpusWriter:
+    """
+    Stream documents into size-bounded shard files instead of one file per document.\\
+    Shards are named `{prefix}_{index:05d}.txt` (one document per line) or `.jsonl` (`{"id": ..., "text": ...}` per line),
+    optionally with `.gz` or `.xz` compression. Records are collected in a write buffer and flushed in large blocks.
+    On `close()`, `manifest.json` is written with the record count and byte offsets of every shard.
+    `checkpoint()` and `restore()` let a crashed run continue where it stopped, see `generate_documents_pcfg`.
+    - directory (`str`): the output folder, created if it does not exist
+    - prefix (`str`): the file name prefix of the shards
+    - format (`str`): `'txt'` or `'jsonl'`
+    - compression (`str | None`): `None`, `'gzip'` or `'lzma'`
+    - max_shard_bytes (`int`): start a new shard once a shard holds this many (uncompressed) bytes
+    - buffer_size (`int`): the size of the write buffer in bytes
+    """
+
+    formats = ('txt', 'jsonl')
+    compressions = {None: '', 'gzip': '.gz', 'lzma': '.xz'}
+
+    def __init__(self, directory: str = 'documents', prefix: str = 'corpus', format: str = 'txt', compression: str | None = None,
+                 max_shard_bytes: int = 256 * 2**20, buffer_size: int = 8 * 2**20):
+
+        if format not in self.formats:
+            raise ValueError(f"Unknown format '{format}', choose one of {list(self.formats)}.")
+        if compression not in self.compressions:
+            raise ValueError(f"Unknown compression '{compression}', choose one of {list(self.compressions)}.")
+
+        self.directory = directory
+        self.prefix = prefix
+        self.format = format
+        self.compression = compression
+        self.max_shard_bytes = max_shard_bytes
+        self.buffer_size = buffer_size
+
+        os.makedirs(directory, exist_ok=True)
+
+        self.shards = []
+        self.n_records = 0
+        self.n_bytes = 0
+
+        self._file = None
+        self._buffer = []
+        self._buffer_bytes = 0
+        # after a checkpoint the last shard is closed, the next record is appended to it
+        self._reopen = False
+
+    def write(self, document: str) -> None:
+        """Append one document to the corpus."""
+
+        if self.format == 'jsonl':
+            record = json.dumps({'id': self.n_records, 'text': document}, ensure_ascii=False) + '\n'
+        else:
+            if '\n' in document:
+                raise ValueError("Documents in the 'txt' format must not contain newlines.")
+            record = document + '\n'
+        record = record.encode('utf-8')
+
+        # a record never spans two shards, a shard holds at least one record
+        if (self._file is None and not self._reopen) or (self.shards[-1]['bytes'] + len(record) > self.max_shard_bytes and self.shards[-1]['records'] > 0):
+            self._next_shard()
+        elif self._reopen:
+            self._reopen = False
+            self._file = self._open(os.path.join(self.directory, self.shards[-1]['file']), 'ab')
+
+        shard = self.shards[-1]
+        shard['records'] += 1
+        shard['bytes'] += len(record)
+        self.n_records += 1
+        self.n_bytes += len(record)
+
+        self._buffer.append(record)
+        self._buffer_bytes += len(record)
+        if self._buffer_bytes >= self.buffer_size:
+            self._flush()
+
+    def write_many(self, documents) -> None:
+        """Append all documents of an iterable to the corpus."""
+        for document in documents:
+            self.write(document)
+
+    def close(self) -> dict:
+        """Flush and close the last shard and write the manifest. Returns the manifest."""
+
+        self._close_shard()
+
+        manifest = {
+            'format': self.format,
+            'compression': self.compression,
+            'records': self.n_records,
+            'bytes': self.n_bytes,
+            'shards': self.shards,
+        }
+        with open(os.path.join(self.directory, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+        return manifest
+
+    def checkpoint(self) -> dict:
+        """
+        Flush the records written so far to disk and return the state of the writer, see `restore`.\\
+        A compressed shard is closed, which ends a gzip member or an xz stream, and the next record starts a new one
+        in the same file. Both formats read concatenated members as one stream.
+        """
+
+        if self._file is not None:
+            self._close_shard()
+            self._reopen = True
+            with open(os.path.join(self.directory, self.shards[-1]['file']), 'rb') as f:
+                os.fsync(f.fileno())
+
+        return {
+            'records': self.n_records,
+            'bytes': self.n_bytes,
+            'shards': [dict(shard) for shard in self.shards],
+        }
+
+    def restore(self, state: dict) -> None:
+        """
+        Continue a corpus from a checkpoint: the last shard file is cut back to its size at the checkpoint,
+        shard files that were started after the checkpoint are deleted.
+        """
+
+        if self._file is not None or self.n_records:
+            raise ValueError("Only a new writer can be restored from a checkpoint.")
+
+        self.n_records = state['records']
+        self.n_bytes = state['bytes']
+        self.shards = [dict(shard) for shard in state['shards']]
+
+        if self.shards:
+            with open(os.path.join(self.directory, self.shards[-1]['file']), 'r+b') as f:
+                f.truncate(self.shards[-1]['compressed_bytes'])
+            self._reopen = True
+
+        index = len(self.shards)
+        while True:
+            path = os.path.join(self.directory, f'{self.prefix}_{index:05d}.{self.format}{self.compressions[self.compression]}')
+            if not os.path.exists(path):
+                break
+            os.remove(path)
+            index += 1
+
+    def _open(self, path: str, mode: str):
+        # gzip headers get a fixed timestamp, so the same records always give the same bytes
+        if self.compression == 'gzip':
+            return gzip.GzipFile(path, mode, mtime=0)
+        if self.compression == 'lzma':
+            return lzma.open(path, mode)
+        return open(path, mode)
+
+    def _next_shard(self) -> None:
+        self._close_shard()
+        self._reopen = False
+
+        filename = f'{self.prefix}_{len(self.shards):05d}.{self.format}{self.compressions[self.compression]}'
+        self.shards.append({
+            'file': filename,
+            'first_record': self.n_records,
+            'records': 0,
+            'offset': self.n_bytes,     # byte offset of the shard in the uncompressed corpus
+            'bytes': 0,
+        })
+
+        self._file = self._open(os.path.join(self.directory, filename), 'wb')
+
+    def _flush(self) -> None:
+        if self._buffer:
+            self._file.write(b''.join(self._buffer))
+            self._buffer = []
+            self._buffer_bytes = 0
+
+    def _close_shard(self) -> None:
+        if self._file is not None:
+            self._flush()
+            self._file.close()
+            self._file = None
+            self.shards[-1]['compressed_bytes'] = os.path.getsize(os.path.join(self.directory, self.shards[-1]['file']))
+
+    def __enter__(self) -> 'CorpusWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+# Binary token corpora
+def token_vocabulary(grammar, separator='.', eos='<EOS>') -> list[str]:
+    """
+    The vocabulary of a token corpus: the terminals of the grammar in compiled order,
+    followed by the sentence separator and the end-of-document token.
+    """
+    grammar = compile_grammar(grammar, probabilistic=True)
+    return grammar.terminals + [separator, eos]
+
+def generate_token_corpus(grammar, directory: str, n_documents=5, n_sentences=5, seed=None, separator='.', eos='<EOS>', batch_size=65536,
+                          seen: GrammarSet | None = None, derivations: bool = False) -> 'TokenCorpus | None':
+    """
+    Generate documents straight into a pre-tokenized binary corpus, without building any strings.\\
+    The corpus folder holds:
+    - `tokens.bin`: all token ids back to back, as `uint8` or `uint16` depending on the vocabulary size.
+    Every sentence is followed by the separator id, every document by the end-of-document id,
+    so a document reads like `"a b c.d e."` in the text format.
+    - `sentence_offsets.npy`: the token index where every sentence starts, plus the total number of tokens
+    - `document_offsets.npy`: the index of the first sentence of every document, plus the total number of sentences
+    - `meta.json`: the vocabulary, the dtype and the special token ids
+    The sentences are sampled with `generate_sentences_batch`.
+    - seen (`GrammarSet`): skip grammars that are in this set up to renaming their symbols and return None, see `generate_documents_pcfg`
+    - derivations (`bool`): also write the derivation of every sentence, see `Derivation`:
+    `productions.bin` (`int32` production ids in preorder), `spans.bin` (`int32` pairs `[start, end)` in tokens of the sentence),
+    `derivation_offsets.npy` (the first node of every sentence, plus the total number of nodes) and `grammar.grammar`,
+    the compiled grammar the production ids refer to (see `nltk_utils.store`).
+    """
+
+    from tqdm import tqdm
+
+    if n_sentences < 1:
+        raise ValueError(f"A document needs at least one sentence, got n_sentences={n_sentences}.")
+
+    grammar = compile_grammar(grammar, probabilistic=True)
+    if seen is not None and grammar in seen:
+        print("Skipping a grammar that was seen before")
+        return None
+
+    vocab = token_vocabulary(grammar, separator, eos)
+    separator_id, eos_id = len(vocab) - 2, len(vocab) - 1
+
+    if len(vocab) <= 2**8:
+        dtype = np.uint8
+    elif len(vocab) <= 2**16:
+        dtype = np.uint16
+    else:
+        raise ValueError("The vocabulary is too large for a uint16 token corpus.")
+
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    # generate whole documents in chunks of about batch_size sentences
+    documents_per_chunk = max(1, batch_size // n_sentences)
+
+    sentence_offsets = [np.zeros(1, dtype=np.int64)]
+    n_tokens = 0
+
+    derivation_offsets = [np.zeros(1, dtype=np.int64)]
+    n_nodes = 0
+    if derivations:
+        save_compiled(grammar, os.path.join(directory, 'grammar.grammar'))
+        productions_file = open(os.path.join(directory, 'productions.bin'), 'wb')
+        spans_file = open(os.path.join(directory, 'spans.bin'), 'wb')
+
+    with open(os.path.join(directory, 'tokens.bin'), 'wb') as f:
+        for chunk_start in tqdm(range(0, n_documents, documents_per_chunk), unit='chunk'):
+            n_chunk = min(documents_per_chunk, n_documents - chunk_start)
+            batch = generate_sentences_batch(grammar, n_chunk * n_sentences, seed=rng, batch_size=batch_size, derivations=derivations)
+
+            if derivations:
+                productions_file.write(batch.derivations.productions.tobytes())
+                spans_file.write(batch.derivations.spans.tobytes())
+                derivation_offsets.append(n_nodes + batch.derivations.offsets[1:])
+                n_nodes += len(batch.derivations.productions)
+
+            # every sentence is followed by a separator, every document by an end-of-document token
+            sentence = np.arange(n_chunk * n_sentences)
+            lengths = np.diff(batch.offsets)
+            shift = sentence + sentence // n_sentences
+            sentence_starts = batch.offsets[:-1] + shift
+
+            tokens = np.empty(len(batch.tokens) + n_chunk * (n_sentences + 1), dtype=dtype)
+            tokens[np.arange(len(batch.tokens)) + np.repeat(shift, lengths)] = batch.tokens
+            tokens[sentence_starts + lengths] = separator_id
+            tokens[sentence_starts[n_sentences - 1::n_sentences] + lengths[n_sentences - 1::n_sentences] + 1] = eos_id
+
+            f.write(tokens.tobytes())
+            # the first sentence of a chunk starts where the previous chunk ends
+            sentence_offsets.append(n_tokens + sentence_starts[1:])
+            sentence_offsets.append(np.array([n_tokens + len(tokens)], dtype=np.int64))
+            n_tokens += len(tokens)
+
+    sentence_offsets = np.concatenate(sentence_offsets)
+    np.save(os.path.join(directory, 'sentence_offsets.npy'), sentence_offsets)
+    np.save(os.path.join(directory, 'document_offsets.npy'), np.arange(n_documents + 1, dtype=np.int64) * n_sentences)
+
+    if derivations:
+        productions_file.close()
+        spans_file.close()
+        np.save(os.path.join(directory, 'derivation_offsets.npy'), np.concatenate(derivation_offsets))
+
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        json.dump({
+            'vocab': vocab,
+            'dtype': np.dtype(dtype).name,
+            'separator_id': separator_id,
+            'eos_id': eos_id,
+            'documents': n_documents,
+            'sentences': n_documents * n_sentences,
+            'tokens': n_tokens,
+            'grammar': grammar.content_hash,
+            'derivations': derivations,
+        }, f, indent=2)
+
+    # only a grammar whose corpus is complete counts as seen, a run that fails is not skipped next time
+    if seen is not None:
+        seen.add(grammar)
+
+    return TokenCorpus(directory)
+
+class TokenCorpus:
+    """
+    A pre-tokenized binary corpus written by `generate_token_corpus`.\\
+    The token ids and offsets are memory-mapped, so documents and sentences are returned as views without copying.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+        with open(os.path.join(directory, 'meta.json')) as f:
+            self.meta = json.load(f)
+
+        self.vocab = self.meta['vocab']
+        self.separator_id = self.meta['separator_id']
+        self.eos_id = self.meta['eos_id']
+
+        self.tokens = np.memmap(os.path.join(directory, 'tokens.bin'), dtype=self.meta['dtype'], mode='r')
+        self.sentence_offsets = np.load(os.path.join(directory, 'sentence_offsets.npy'), mmap_mode='r')
+        self.document_offsets = np.load(os.path.join(directory, 'document_offsets.npy'), mmap_mode='r')
+
+        # the derivations are mapped as well, the grammar is only loaded for `tree`
+        self.productions = self.spans = self.derivation_offsets = None
+        self._grammar = None
+        if self.meta.get('derivations'):
+            self.productions = np.memmap(os.path.join(directory, 'productions.bin'), dtype=np.int32, mode='r')
+            self.spans = np.memmap(os.path.join(directory, 'spans.bin'), dtype=np.int32, mode='r').reshape(-1, 2)
+            self.derivation_offsets = np.load(os.path.join(directory, 'derivation_offsets.npy'), mmap_mode='r')
+
+    def __len__(self) -> int:
+        """The number of documents."""
+        return len(self.document_offsets) - 1
+
+    def document(self, i: int) -> np.ndarray:
+        """The token ids of document `i`, including separators and the end-of-document token."""
+        return self.tokens[self.sentence_offsets[self.document_offsets[i]]:self.sentence_offsets[self.document_offsets[i+1]]]
+
+    def sentence(self, j: int) -> np.ndarray:
+        """The token ids of sentence `j`, without its separator."""
+        start, stop = self.sentence_offsets[j], self.sentence_offsets[j+1]
+        stop -= 2 if self.tokens[stop - 1] == self.eos_id else 1
+        return self.tokens[start:stop]
+
+    def derivation(self, j: int) -> Derivation:
+        """The derivation of sentence `j`, its spans index the tokens of `sentence(j)`."""
+        if self.productions is None:
+            raise ValueError("The corpus was generated without derivations.")
+        start, stop = self.derivation_offsets[j], self.derivation_offsets[j+1]
+        return Derivation(self.productions[start:stop], self.spans[start:stop])
+
+    @property
+    def grammar(self):
+        """The compiled grammar of the derivations, loaded on first use."""
+        if self._grammar is None:
+            self._grammar = load_compiled(os.path.join(self.directory, 'grammar.grammar'))
+        return self._grammar
+
+    def tree(self, j: int):
+        """The `nltk.Tree` of the derivation of sentence `j`, it is only built here."""
+        return self.derivation(j).to_tree(self.grammar)
+
+    def decode(self, token_ids, token_join_char=' ') -> str:
+        """Turn token ids back into text in the format of `generate_document_pcfg`."""
+        text = []
+        for token in token_ids:
+            if token == self.eos_id:
+                continue
+            if token == self.separator_id:
+                # the separator replaces the space after the last token of a sentence
+                if text and text[-1] == token_join_char:
+                    text.pop()
+                text.append(self.vocab[token])
+            else:
+                text.append(self.vocab[token])
+                text.append(token_join_char)
+        # a sentence without its separator
+        if text and text[-1] == token_join_char:
+            text.pop()
+        return ''.join(text)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.document(i)
+
 # Saving/Loading Grammars
 def save_grammar_standardized_pcfg(n_terminals: int = 5, n_nonterminals: int = 5, n_rules: int = 5, prob_terminal: float = 0.5):
+    """
+    Generate one standardized PCFG and save it as `grammars/grammar_{n_terminals}_{n_nonterminals}_{n_rules}.txt`.\\
+    For many grammars over a grid of parameters, use `nltk_utils.sweep.run_sweep`.
+    """
 
     # generate the grammar
     terminals = generate_terminals(n_terminals)
     nonterminals = generate_nonterminals(n_nonterminals)
 
-    grammar = None
-    while grammar is None or is_transient(grammar):
-        grammar = generate_pcfg(terminals, nonterminals, n_rules, prob_terminal)
-
-        if is_transient(grammar):
-            print("Transient grammar, retrying...")
+    # the constructive method makes every nonterminal reachable and productive, so the grammar is always transient
+    grammar = generate_pcfg(terminals, nonterminals, n_rules, prob_terminal, method='constructive')
 
     print(grammar)
 
     suffix = f"{n_terminals}_{n_nonterminals}_{n_rules}"
     save_grammar(grammar, suffix)
 
-def save_grammar(grammar: str) -> None:
+def save_grammar(grammar: str, suffix: str | None = None, catalog: 'GrammarCatalog | None' = None) -> None:
     """
     Save a grammar to a file. The filename will be `grammars/grammar_{n_terminals}_{n_nonterminals}_{n_rules}.txt`.
+    - suffix (`str`): use `grammars/grammar_{suffix}.txt` instead, the counts are not taken from the grammar then
+    - catalog (`GrammarCatalog`): also store the compiled grammar in this catalog, under its content hash.
+    Unlike the text file, it is never overwritten by another grammar with the same counts.
     """
 
-    grammar = to_grammar(grammar)
+    if catalog is not None:
+        catalog.add(grammar, params=None if suffix is None else {'suffix': suffix})
 
-    # get the number of terminals, nonterminals and rules
-    n_terminals = len(set(term for rule in grammar.productions() for term in rule.rhs() if isinstance(term, str)))
-    n_nonterminals = len(set(rule.lhs() for rule in grammar.productions())) - 1 # -1 because the start symbol S is not counted
-    n_rules = len(grammar.productions()) - 1 # -1 because the start rule S -> A is not counted
+    if suffix is None:
+        # the number of terminals, nonterminals and rules, without the start symbol and the start rule
+        n_terminals, n_nonterminals, n_rules = grammar_sizes(grammar)
+        suffix = f"{n_terminals}_{n_nonterminals}_{n_rules}"
+
+    grammar = to_grammar(grammar)
 
     # create the folder if it does not exist
     if not os.path.exists('grammars'):
         os.makedirs('grammars')
 
-    with open(f'grammars/grammar_{n_terminals}_{n_nonterminals}_{n_rules}.txt', "w") as f:
+    with open(f'grammars/grammar_{suffix}.txt', "w") as f:
         f.write(str(grammar))
 
 def load_grammar(suffix: str = "default") -> str:
@@ -0,0 +1,158 @@
+import hashlib
+import math
+from collections import deque
+
+# Sentence deduplication for large corpus runs.
+# Sentences are reduced to 64-bit blake2b fingerprints. The exact mode keeps every fingerprint in a set,
+# the approximate mode keeps a Bloom filter of fixed size: it never misses a duplicate, but a new sentence
+# is taken for a duplicate with probability `false_positive_rate` once `capacity` sentences have been added.
+
+
+def fingerprint(sentence: str) -> int:
+    """The 64-bit blake2b fingerprint of a sentence."""
+    return int.from_bytes(hashlib.blake2b(sentence.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class BloomFilter:
+    """
+    A Bloom filter over 64-bit fingerprints, sized for `capacity` items at the given false-positive rate.\\
+    The bit positions come from double hashing of the two 32-bit halves of the fingerprint.
+    - capacity (`int`): the number of items the false-positive rate is guaranteed for
+    - false_positive_rate (`float`): the probability that an item that was never added is reported as present
+    """
+
+    def __init__(self, capacity: int = 10_000_000, false_positive_rate: float = 0.001):
+
+        if capacity < 1:
+            raise ValueError("The capacity of a Bloom filter must be at least 1.")
+        if not 0 < false_positive_rate < 1:
+            raise ValueError("The false-positive rate must be between 0 and 1.")
+
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+
+        # optimal number of bits and hash functions for n items at rate p: m = -n ln p / ln(2)^2, k = m / n ln 2
+        self.n_bits = max(64, math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.n_hashes = max(1, round(self.n_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.n_bits + 7) // 8)
+
+    def add(self, key: int) -> bool:
+        """Add a fingerprint. Returns True if it was (probably) not in the filter before."""
+
+        low, high = key & 0xFFFFFFFF, key >> 32 | 1
+        bits, n_bits = self.bits, self.n_bits
+        new = False
+        for i in range(self.n_hashes):
+            position = (low + i * high) % n_bits
+            byte, mask = position >> 3, 1 << (position & 7)
+            if not bits[byte] & mask:
+                bits[byte] |= mask
+                new = True
+        return new
+
+    def __contains__(self, key: int) -> bool:
+        low, high = key & 0xFFFFFFFF, key >> 32 | 1
+        return all(self.bits[position >> 3] >> (position & 7) & 1
+                   for position in ((low + i * high) % self.n_bits for i in range(self.n_hashes)))
+
+    @property
+    def n_bytes(self) -> int:
+        return len(self.bits)
+
+
+class SentenceDeduplicator:
+    """
+    Drop sentences that were seen before and keep track of the duplicate rate.\\
+    The yield is the fraction of new sentences among the last `window` sentences. Once it falls below `min_yield`,
+    the grammar has (nearly) run out of distinct sentences and `saturated` becomes True.
+    - mode (`str`): `'exact'` for a set of fingerprints, `'bloom'` for a Bloom filter of bounded memory
+    - capacity (`int`): the expected number of distinct sentences, sizes the Bloom filter
+    - false_positive_rate (`float`): the false-positive rate of the Bloom filter at `capacity` sentences
+    - window (`int`): the number of recent sentences the yield is measured over
+    - min_yield (`float`): the yield below which the deduplicator is saturated, 0 never saturates.
+    A grammar with a finite language would otherwise be sampled forever once all its sentences were seen.
+    """
+
+    modes = ('exact', 'bloom')
+
+    def __init__(self, mode: str = 'exact', capacity: int = 10_000_000, false_positive_rate: float = 0.001,
+                 window: int = 100_000, min_yield: float = 0.001):
+
+        if mode not in self.modes:
+            raise ValueError(f"Unknown dedup mode '{mode}', choose one of {list(self.modes)}.")
+
+        self.mode = mode
+        self.window = window
+        self.min_yield = min_yield
+
+        if mode == 'exact':
+            self._seen = set()
+        else:
+            self._seen = BloomFilter(capacity, false_positive_rate)
+
+        self.n_sentences = 0
+        self.n_distinct = 0
+
+        # 1 for every new sentence among the last `window` sentences
+        self._recent = deque()
+        self._recent_distinct = 0
+
+    def add(self, sentence: str) -> bool:
+        """Record a sentence. Returns True if it was not seen before."""
+
+        key = fingerprint(sentence)
+        if self.mode == 'exact':
+            new = key not in self._seen
+            if new:
+                self._seen.add(key)
+        else:
+            new = self._seen.add(key)
+
+        self.n_sentences += 1
+        self.n_distinct += new
+
+        self._recent.append(new)
+        self._recent_distinct += new
+        if len(self._recent) > self.window:
+            self._recent_distinct -= self._recent.popleft()
+
+        return new
+
+    def filter(self, sentences) -> list[str]:
+        """The sentences of an iterable that were not seen before, in order."""
+        return [sentence for sentence in sentences if self.add(sentence)]
+
+    @property
+    def n_duplicates(self) -> int:
+        return self.n_sentences - self.n_distinct
+
+    @property
+    def duplicate_rate(self) -> float:
+        """The fraction of all sentences so far that were duplicates."""
+        return self.n_duplicates / self.n_sentences if self.n_sentences else 0.0
+
+    @property
+    def recent_yield(self) -> float:
+        """The fraction of new sentences among the last `window` sentences."""
+        return self._recent_distinct / len(self._recent) if self._recent else 1.0
+
+    @property
+    def saturated(self) -> bool:
+        """True once a full window of sentences had a yield below `min_yield`."""
+        return len(self._recent) >= self.window and self.recent_yield < self.min_yield
+
+    def stats(self) -> dict:
+        """The counts and rates of the deduplicator, e.g. for logging."""
+        stats = {
+            'mode': self.mode,
+            'sentences': self.n_sentences,
+            'distinct': self.n_distinct,
+            'duplicates': self.n_duplicates,
+            'duplicate_rate': self.duplicate_rate,
+            'recent_yield': self.recent_yield,
+            'saturated': self.saturated,
+        }
+        if self.mode == 'bloom':
+            stats['bloom_bytes'] = self._seen.n_bytes
+            stats['bloom_hashes'] = self._seen.n_hashes
+        return stats
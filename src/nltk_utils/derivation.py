@@ -0,0 +1,242 @@
+from __future__ import annotations
+
+import random
+from typing import TYPE_CHECKING, NamedTuple
+
+import numpy as np
+
+from nltk_utils import instrumentation
+from nltk_utils.utils import CompiledGrammar
+
+if TYPE_CHECKING:
+    import nltk
+
+# Derivation engines turn the start symbol of a compiled grammar into a list of terminal ids.
+# They return None if the derivation needed more than max_iterations expansions.
+# With instrumentation enabled, they record the number of expansions of every derivation.
+# Given a `productions` list, they also record the derivation: the production ids of its nonterminal nodes in preorder.
+# That is all it takes to rebuild the tree, see `Derivation`.
+
+
+def derive_rewrite(grammar: CompiledGrammar, max_iterations: int = 10000, rng=random, productions: list | None = None) -> list[int] | None:
+    """
+    Derive a sentence by repeatedly expanding a uniformly chosen nonterminal of the sentential form.\\
+    This consumes the random number generator exactly like the original rewrite loop,
+    so the same seed gives the same sentence. Instead of rescanning and rebuilding the sentence on every step,
+    the open nonterminals are kept in a list of tree nodes in sentence order and the yield is read off at the end.
+    """
+
+    # a node is [symbol, children], children is None while the node is still open
+    root = [grammar.start, None]
+    open_nodes = [root]
+
+    current_iteration = 0
+    while open_nodes:
+
+        # randomly choose a non-terminal to expand, same as random.choice(non_terminals)
+        index = rng.randrange(len(open_nodes))
+        node = open_nodes[index]
+
+        production = grammar.sample_production(node[0], rng)
+        children = [[symbol, None] if symbol >= 0 else symbol for symbol in grammar.rhs_tuples[production]]
+        node[1] = children
+        # the symbol of an expanded node is not needed anymore, keep its production for the derivation instead
+        if productions is not None:
+            node[0] = production
+
+        # replace the node with its nonterminal children, keeping the sentence order
+        open_nodes[index:index+1] = [child for child in children if type(child) is list]
+
+        # avoid infinite loops
+        current_iteration += 1
+        if current_iteration > max_iterations and open_nodes:
+            if instrumentation.enabled:
+                instrumentation.record_expansions(grammar.content_hash, current_iteration)
+            return None
+
+    if instrumentation.enabled:
+        instrumentation.record_expansions(grammar.content_hash, current_iteration)
+
+    # read the terminals off the tree, left to right. The nodes are visited in preorder
+    sentence = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if type(node) is list:
+            if productions is not None:
+                productions.append(node[0])
+            stack.extend(reversed(node[1]))
+        else:
+            sentence.append(~node)
+
+    return sentence
+
+
+def derive_stack(grammar: CompiledGrammar, max_iterations: int = 10000, rng=random, productions: list | None = None) -> list[int] | None:
+    """
+    Derive a sentence with a leftmost derivation on an explicit stack.\\
+    Terminals are emitted as soon as they are popped and productions are sampled in O(1) with alias tables,
+    so a sentence costs O(number of expansions). The distribution is the same as `derive_rewrite`,
+    but the random number generator is consumed differently, so seeded sentences differ between the engines.
+    """
+
+    alias_prob, alias = grammar.alias_tables()
+    prod_offsets = grammar.prod_offsets
+    reversed_rhs = grammar.reversed_rhs
+    draw = rng.random
+
+    sentence = []
+    stack = [grammar.start]
+    pop, push, emit = stack.pop, stack.extend, sentence.append
+
+    current_iteration = 0
+    while stack:
+        symbol = pop()
+
+        if symbol < 0:
+            emit(~symbol)
+            continue
+
+        # avoid infinite loops
+        current_iteration += 1
+        if current_iteration > max_iterations + 1:
+            if instrumentation.enabled:
+                instrumentation.record_expansions(grammar.content_hash, current_iteration - 1)
+            return None
+
+        lo = prod_offsets[symbol]
+        n = prod_offsets[symbol + 1] - lo
+        if not n:
+            raise ValueError(f"The nonterminal {grammar.nonterminals[symbol]} has no productions.")
+
+        u = draw() * n
+        k = int(u)
+        production = lo + k
+        if u - k >= alias_prob[production]:
+            production = alias[production]
+
+        # a leftmost derivation expands the nodes in preorder
+        if productions is not None:
+            productions.append(production)
+
+        push(reversed_rhs[production])
+
+    if instrumentation.enabled:
+        instrumentation.record_expansions(grammar.content_hash, current_iteration)
+
+    return sentence
+
+
+ENGINES = {
+    'rewrite': derive_rewrite,
+    'stack': derive_stack,
+}
+
+def get_engine(engine: str):
+    """
+    Return the derivation engine with the given name, see `ENGINES`.
+    """
+
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine '{engine}', choose one of {list(ENGINES)}.")
+
+    return ENGINES[engine]
+
+
+class Derivation(NamedTuple):
+    """
+    A derivation tree as flat arrays, for sentence `i` of a batch see `DerivationBatch`.\\
+    - `productions[k]`: the production of the `k`-th nonterminal node in preorder
+    - `spans[k]`: the tokens `[start, end)` of the sentence below that node
+    The tree is only built on request, with `to_tree`.
+    """
+    productions: np.ndarray
+    spans: np.ndarray
+
+    @classmethod
+    def from_productions(cls, grammar: CompiledGrammar, productions: list[int]) -> 'Derivation':
+        """The derivation with the productions recorded by an engine, the spans are computed from the grammar."""
+        return cls(np.array(productions, dtype=np.int32), derivation_spans(grammar, productions))
+
+    def to_tree(self, grammar: CompiledGrammar) -> nltk.Tree:
+        """Build the `nltk.Tree` of the derivation, with the nonterminal names as labels and the terminals as leaves."""
+
+        from nltk import Tree
+
+        productions = self.productions.tolist()
+        if not productions:
+            raise ValueError("The derivation is empty.")
+
+        # a frame is (label, children, the symbols of the right-hand side that are left), built iteratively for deep trees
+        root = []
+        stack = [(None, root, iter([grammar.lhs[productions[0]]]))]
+        k = 0
+        while stack:
+            label, children, symbols = stack[-1]
+            symbol = next(symbols, None)
+            if symbol is None:
+                stack.pop()
+                if label is not None:
+                    stack[-1][1].append(Tree(label, children))
+            elif symbol < 0:
+                children.append(grammar.terminals[~symbol])
+            else:
+                if k == len(productions) or grammar.lhs[productions[k]] != symbol:
+                    raise ValueError("The productions are not a derivation of this grammar.")
+                stack.append((grammar.nonterminals[symbol], [], iter(grammar.rhs_tuples[productions[k]])))
+                k += 1
+
+        return root[0]
+
+
+def derivation_spans(grammar: CompiledGrammar, productions: list[int]) -> np.ndarray:
+    """
+    The spans `[start, end)` of the nodes of a derivation given by its productions in preorder, as an `(n, 2)` array.\\
+    Every terminal is one token, so the spans follow from the right-hand sides alone.
+    """
+
+    spans = np.zeros((len(productions), 2), dtype=np.int32)
+    if not len(productions):
+        return spans
+
+    # the stack holds the symbols left to derive, and for every open node the tuple (node,) that closes its span
+    stack = [grammar.lhs[productions[0]]]
+    position = 0
+    k = 0
+    while stack:
+        item = stack.pop()
+        if type(item) is tuple:
+            spans[item[0], 1] = position
+        elif item < 0:
+            position += 1
+        else:
+            if k == len(productions) or grammar.lhs[productions[k]] != item:
+                raise ValueError("The productions are not a derivation of this grammar.")
+            spans[k, 0] = position
+            stack.append((k,))
+            stack.extend(grammar.reversed_rhs[productions[k]])
+            k += 1
+
+    return spans
+
+
+class DerivationBatch(NamedTuple):
+    """
+    The derivations of a batch of sentences as ragged arrays: the nodes of sentence `i` are `offsets[i]:offsets[i+1]`
+    of `productions` and `spans`, see `Derivation`.
+    """
+    productions: np.ndarray
+    spans: np.ndarray
+    offsets: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def derivation(self, i: int) -> Derivation:
+        """The derivation of sentence `i`, as views of the arrays."""
+        start, stop = self.offsets[i], self.offsets[i+1]
+        return Derivation(self.productions[start:stop], self.spans[start:stop])
+
+    def tree(self, i: int, grammar: CompiledGrammar) -> nltk.Tree:
+        """The `nltk.Tree` of sentence `i`."""
+        return self.derivation(i).to_tree(grammar)
@@ -1,36 +1,367 @@
+from __future__ import annotations
+
 from collections import defaultdict
-from nltk_utils.utils import to_grammar
-import nltk
-from networkx import DiGraph, simple_cycles
+from functools import cached_property
+from typing import TYPE_CHECKING, NamedTuple
+from nltk_utils.utils import CompiledGrammar, compile_grammar, to_grammar
+
+# nltk is slow to import, it is only loaded when nltk objects or parsers are asked for
+if TYPE_CHECKING:
+    import nltk
 
 
-def build_transition_graph(grammar: str | nltk.CFG | nltk.PCFG) -> dict[str, list[str]]:
+class Recursion(NamedTuple):
+    """
+    How a nonterminal `A` is recursive, see `GrammarAnalysis.recursion`.
+    - component (`int`): the index of the strongly connected component of `A` in `GrammarAnalysis.components`
+    - left (`bool`): `A =>+ A β` with `β` non-empty
+    - right (`bool`): `A =>+ α A` with `α` non-empty
+    - self_embedding (`bool`): `A =>+ α A β` with both `α` and `β` non-empty
+    - mutual (`bool`): `A` is in a component with other nonterminals
+    - unary (`bool`): `A =>+ A` through unary rules only, e.g. `A -> A`
+    """
+    component: int
+    left: bool
+    right: bool
+    self_embedding: bool
+    mutual: bool
+    unary: bool = False
+
+    @property
+    def kind(self) -> str:
+        """
+        `'non-recursive'`, `'self-embedding'`, `'left'`, `'right'` or `'unary'` if the only recursion is a cycle of unary rules.\\
+        A unary cycle next to another recursion, like in `A -> A "a" | A`, does not change the kind.
+        """
+        if self.self_embedding:
+            return 'self-embedding'
+        if self.left:
+            return 'left'
+        if self.right:
+            return 'right'
+        if self.unary:
+            return 'unary'
+        return 'non-recursive'
+
+
+def _strongly_connected_components(adjacency: list[list[int]]) -> list[list[int]]:
+    """
+    Tarjan's algorithm without recursion, O(V + E).\\
+    The components come in reverse topological order: every component comes after the components it has edges to.
+    """
+
+    n = len(adjacency)
+    index, low = [-1] * n, [0] * n
+    on_stack = [False] * n
+    stack, components = [], []
+    counter = 0
+
+    for root in range(n):
+        if index[root] != -1:
+            continue
+
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        work = [(root, 0)]
+
+        while work:
+            node, i = work[-1]
+            children = adjacency[node]
+
+            if i < len(children):
+                work[-1] = (node, i + 1)
+                child = children[i]
+                if index[child] == -1:
+                    index[child] = low[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    on_stack[child] = True
+                    work.append((child, 0))
+                elif on_stack[child] and index[child] < low[node]:
+                    low[node] = index[child]
+                continue
+
+            # all children are done, pass the low link up and pop the component if node is its root
+            work.pop()
+            if work and low[node] < low[work[-1][0]]:
+                low[work[-1][0]] = low[node]
+
+            if low[node] == index[node]:
+                component = []
+                while True:
+                    symbol = stack.pop()
+                    on_stack[symbol] = False
+                    component.append(symbol)
+                    if symbol == node:
+                        break
+                components.append(component)
+
+    return components
+
+
+class GrammarAnalysis:
+    """
+    Reachability and productivity of the nonterminals of a grammar, computed on the compiled grammar in a single pass each.\\
+    The adjacency (nonterminals on the right-hand sides of every nonterminal) and the reverse dependencies
+    (the productions every nonterminal occurs in) are built once, every result is computed on first access and cached.
+    Use `get_grammar_analysis` to share one analysis per grammar and start symbol.
+    - start (`str`): the start symbol, like the `start` argument of the functions below
+    """
+
+    def __init__(self, grammar: str | nltk.CFG | nltk.PCFG | CompiledGrammar, start='S'):
+
+        self.grammar = compile_grammar(grammar)
+        self.start = start
+
+        grammar = self.grammar
+        n_nonterminals = len(grammar.nonterminals)
+
+        # children[A]: the nonterminals on the right-hand sides of A, in production order
+        # uses[B]: the productions B occurs in, once per occurrence
+        self.children = [[] for _ in range(n_nonterminals)]
+        self.uses = [[] for _ in range(n_nonterminals)]
+        self.n_nonterminal_children = [0] * grammar.n_productions
+
+        for production, rhs in enumerate(grammar.rhs_tuples):
+            for symbol in rhs:
+                if symbol >= 0:
+                    self.children[grammar.lhs[production]].append(symbol)
+                    self.uses[symbol].append(production)
+                    self.n_nonterminal_children[production] += 1
+
+        self.has_productions = [grammar.prod_offsets[A] < grammar.prod_offsets[A + 1] for A in range(n_nonterminals)]
+
+    def _names(self, symbols) -> set[str]:
+        return {self.grammar.nonterminals[symbol] for symbol in symbols}
+
+    @cached_property
+    def reachable(self) -> set[str]:
+        """The nonterminals reachable from the start symbol, including the start symbol."""
+
+        start = self.grammar.nonterminal_index.get(self.start)
+        if start is None:
+            return {self.start}
+
+        seen = [False] * len(self.grammar.nonterminals)
+        seen[start] = True
+        stack = [start]
+        while stack:
+            for child in self.children[stack.pop()]:
+                if not seen[child]:
+                    seen[child] = True
+                    stack.append(child)
+
+        return self._names(symbol for symbol, is_seen in enumerate(seen) if is_seen)
+
+    @cached_property
+    def unreachable(self) -> set[str]:
+        """The nonterminals with productions that are not reachable from the start symbol."""
+        return self._names(symbol for symbol, has in enumerate(self.has_productions) if has) - self.reachable
+
+    @cached_property
+    def absorbing(self) -> set[str]:
+        """The nonterminals with a production that has no nonterminals on its right-hand side."""
+        return self._names(self.grammar.lhs[p] for p, count in enumerate(self.n_nonterminal_children) if count == 0)
+
+    @cached_property
+    def productive(self) -> set[str]:
+        """
+        The nonterminals that derive a terminal string.\\
+        Worklist algorithm: every production counts its nonterminals that are not known to be productive yet,
+        a nonterminal that becomes productive decrements the productions it occurs in, and a production that reaches zero
+        makes its left-hand side productive. Every production is touched once per symbol, so this is O(size of the grammar).
+        """
+
+        grammar = self.grammar
+        remaining = list(self.n_nonterminal_children)
+        productive = [False] * len(grammar.nonterminals)
+
+        worklist = []
+        for production, count in enumerate(remaining):
+            symbol = grammar.lhs[production]
+            if count == 0 and not productive[symbol]:
+                productive[symbol] = True
+                worklist.append(symbol)
+
+        while worklist:
+            for production in self.uses[worklist.pop()]:
+                remaining[production] -= 1
+                symbol = grammar.lhs[production]
+                if remaining[production] == 0 and not productive[symbol]:
+                    productive[symbol] = True
+                    worklist.append(symbol)
+
+        return self._names(symbol for symbol, is_productive in enumerate(productive) if is_productive)
+
+    @cached_property
+    def unproductive(self) -> set[str]:
+        """The nonterminals with productions that are not productive, together with the unreachable ones."""
+        with_productions = self._names(symbol for symbol, has in enumerate(self.has_productions) if has)
+        return (with_productions - self.productive) | self.unreachable
+
+    @cached_property
+    def _components(self) -> tuple[list[list[int]], list[int]]:
+        # Tarjan gives the components sinks first, reverse them so that every component comes before its dependencies
+        components = _strongly_connected_components(self.children)[::-1]
+        component_of = [0] * len(self.grammar.nonterminals)
+        for i, component in enumerate(components):
+            for symbol in component:
+                component_of[symbol] = i
+        return components, component_of
+
+    @cached_property
+    def components(self) -> list[set[str]]:
+        """
+        The strongly connected components of the nonterminal graph, in topological order:
+        a nonterminal only depends on nonterminals in its own component or in later components.
+        """
+        return [self._names(component) for component in self._components[0]]
+
+    @cached_property
+    def recursion(self) -> dict[str, Recursion]:
+        """
+        Classify every nonterminal by its recursion, in O(size of the grammar).\\
+        An occurrence of `B` at position `i` of a production `A -> X1 ... Xk` is an edge `A -> B` that adds symbols
+        on the right (`i = 1`), on the left (`i = k`) or on both sides, a unary rule adds nothing.
+        `A` is left (right) recursive if it is on a cycle of edges that only add on the right (left) and at least one edge
+        adds something, these cycles are found as components of the subgraph of those edges. In a component every edge
+        lies on a cycle through every nonterminal, so it is enough that one edge of the component is not a unary rule.
+        A cycle of unary rules alone makes `A` unary recursive.
+        Within a component every pair of edges lies on a common closed walk, so if a component has edges that add
+        on the left and edges that add on the right, all of its nonterminals are self-embedding.
+        Empty productions are not taken into account.
+        """
+
+        grammar = self.grammar
+        n_nonterminals = len(grammar.nonterminals)
+        components, component_of = self._components
+
+        # edges inside components, by the side they add symbols to. Unary rules add nothing, they are in both lists
+        # and in unary_edges. The left and right edges of longer rules are also kept as pairs, to find their components
+        left_edges = [[] for _ in range(n_nonterminals)]
+        right_edges = [[] for _ in range(n_nonterminals)]
+        unary_edges = [[] for _ in range(n_nonterminals)]
+        long_left_edges, long_right_edges = [], []
+        cyclic = [len(component) > 1 for component in components]
+        adds_left = [False] * len(components)
+        adds_right = [False] * len(components)
+
+        for production, rhs in enumerate(grammar.rhs_tuples):
+            lhs = grammar.lhs[production]
+            for position, symbol in enumerate(rhs):
+                if symbol < 0 or component_of[symbol] != component_of[lhs]:
+                    continue
+
+                component = component_of[lhs]
+                if symbol == lhs:
+                    cyclic[component] = True
+
+                first, last = position == 0, position == len(rhs) - 1
+                if first and last:
+                    unary_edges[lhs].append(symbol)
+                if first:
+                    left_edges[lhs].append(symbol)
+                    if not last:
+                        long_left_edges.append((lhs, symbol))
+                else:
+                    adds_left[component] = True
+                if last:
+                    right_edges[lhs].append(symbol)
+                    if not first:
+                        long_right_edges.append((lhs, symbol))
+                else:
+                    adds_right[component] = True
+
+        def on_cycle(edges: list[list[int]], required: list[tuple[int, int]] | None = None) -> list[bool]:
+            # the nonterminals on a cycle of `edges`, with `required` only those whose component contains one of these edges
+            result = [False] * n_nonterminals
+            components = _strongly_connected_components(edges)
+            if required is not None:
+                component_index = [0] * n_nonterminals
+                for i, component in enumerate(components):
+                    for symbol in component:
+                        component_index[symbol] = i
+                cycles = {component_index[lhs] for lhs, symbol in required if component_index[lhs] == component_index[symbol]}
+            for i, component in enumerate(components):
+                if required is not None and i not in cycles:
+                    continue
+                if len(component) > 1 or component[0] in edges[component[0]]:
+                    for symbol in component:
+                        result[symbol] = True
+            return result
+
+        left, right = on_cycle(left_edges, long_left_edges), on_cycle(right_edges, long_right_edges)
+        unary = on_cycle(unary_edges)
+
+        recursion = {}
+        for symbol in range(n_nonterminals):
+            component = component_of[symbol]
+            recursion[grammar.nonterminals[symbol]] = Recursion(
+                component=component,
+                left=left[symbol],
+                right=right[symbol],
+                self_embedding=cyclic[component] and adds_left[component] and adds_right[component],
+                mutual=len(components[component]) > 1,
+                unary=unary[symbol],
+            )
+
+        return recursion
+
+    @cached_property
+    def transient(self) -> bool:
+        """True if every reachable nonterminal is productive, see `is_transient`."""
+        return self.unproductive == self.unreachable
+
+    def transition_graph(self) -> dict[str, list[str]]:
+        """The transition graph of `build_transition_graph`."""
+
+        grammar = self.grammar
+        graph = defaultdict(list)
+        for symbol, has in enumerate(self.has_productions):
+            if has:
+                graph[grammar.nonterminals[symbol]].extend(grammar.nonterminals[child] for child in self.children[symbol])
+        return graph
+
+
+def get_grammar_analysis(grammar: str | nltk.CFG | nltk.PCFG | CompiledGrammar, start='S') -> GrammarAnalysis:
+    """Return the analysis of a grammar, it is computed once per compiled grammar and start symbol."""
+
+    compiled = compile_grammar(grammar)
+    key = ('graph_analysis', start)
+
+    analysis = compiled.cache.get(key)
+    if analysis is None:
+        analysis = compiled.cache[key] = GrammarAnalysis(compiled, start=start)
+
+    return analysis
+
+
+def build_transition_graph(grammar: str | nltk.CFG | nltk.PCFG | CompiledGrammar) -> dict[str, list[str]]:
     """
     Build a transition graph from the grammar for Markov chain analysis.
     This version includes all rules in the graph.
+    The keys are in the order of the compiled grammar: the start symbol, then the nonterminals in order of their first
+    appearance anywhere in the grammar, not in the order of their first rule as before the graph came from `GrammarAnalysis`.
     """
 
-    grammar = to_grammar(grammar)
-    
-    graph = defaultdict(list)
-    for production in grammar.productions():
-        lhs = str(production.lhs())
-        rhs_symbols = [str(rhs) for rhs in production.rhs() if nltk.grammar.is_nonterminal(rhs)]
-        graph[lhs].extend(rhs_symbols)
-    return graph
+    return get_grammar_analysis(grammar).transition_graph()
 
-def build_transient_transition_graph(grammar: str | nltk.CFG | nltk.PCFG) -> dict[str, list[str]]:
+def build_transient_transition_graph(grammar: str | nltk.CFG | nltk.PCFG | CompiledGrammar) -> dict[str, list[str]]:
     """
     Build a transition graph from the grammar for Markov chain analysis.
     This version removes rules with self-loops and duplicates in the graph.
     """
 
+    from nltk.grammar import is_nonterminal
+
     grammar = to_grammar(grammar)
     
     graph = defaultdict(list)
     for production in grammar.productions():
         lhs = str(production.lhs())
-        rhs_symbols = [str(rhs) for rhs in production.rhs() if nltk.grammar.is_nonterminal(rhs)]
+        rhs_symbols = [str(rhs) for rhs in production.rhs() if is_nonterminal(rhs)]
 
         # remove duplicates
         rhs_symbols = list(set(rhs_symbols))
@@ -65,89 +396,58 @@ def get_unreachable_states(graph, start='S') -> set[str]:
     reachable = get_reachable_states(graph, start=start)
     return set(graph.keys()) - reachable
 
-def find_absorbing_states(grammar: str | nltk.CFG | nltk.PCFG) -> set[str]:
+def get_strongly_connected_components(grammar: str | nltk.CFG | nltk.PCFG | CompiledGrammar) -> list[set[str]]:
+    """Return the strongly connected components of the nonterminals, every component before the ones it depends on."""
+    return list(get_grammar_analysis(grammar).components)
+
+def classify_recursion(grammar: str | nltk.CFG | nltk.PCFG | CompiledGrammar) -> dict[str, Recursion]:
+    """Return for every nonterminal how it is recursive, see `GrammarAnalysis.recursion`."""
+    return dict(get_grammar_analysis(grammar).recursion)
+
+def find_absorbing_states(grammar: str | nltk.CFG | nltk.PCFG | CompiledGrammar) -> set[str]:
     """Identify terminal symbols (absorbing states) in the grammar."""
-    return {str(production.lhs()) for production in grammar.productions() if all(not nltk.grammar.is_nonterminal(rhs) for rhs in production.rhs())}
+    return set(get_grammar_analysis(grammar).absorbing)
 
 
-def get_unproductive_rules(grammar: str | nltk.CFG | nltk.PCFG, start='S'):
+def get_unproductive_rules(grammar: str | nltk.CFG | nltk.PCFG | CompiledGrammar, start='S'):
     """
-    Return the unproductive rules of a grammar.
+    Return the unproductive rules of a grammar, the nonterminals that can't derive a terminal string or can't be reached.
     See here https://zerobone.net/blog/cs/non-productive-cfg-rules/
     """
 
-    grammar = to_grammar(grammar)
-    graph = build_transition_graph(grammar)
-    unreachable_states = set(nltk.Nonterminal(state) for state in get_unreachable_states(graph, start=start))
-
-    # Initialize the set of productive non-terminals with those that directly produce terminals
-    productive = set()
-    for production in grammar.productions():
-        if all(isinstance(sym, str) or not isinstance(sym, nltk.Nonterminal) for sym in production.rhs()):
-            productive.add(production.lhs())
-
-    # Iteratively update the set of productive non-terminals
-    changes = True
-    while changes:
-        changes = False
-        for production in grammar.productions():
-            if production.lhs() not in productive:
-                if all(sym in productive or not isinstance(sym, nltk.Nonterminal) for sym in production.rhs()):
-                    productive.add(production.lhs())
-                    changes = True
-
-    # Check if there are any non-terminals that are not in the productive set
-    non_productive = set(production.lhs() for production in grammar.productions()) - productive
-
-    # add all unreachable states to the non-productive set
-    non_productive.update(unreachable_states)
-
-    # The grammar has unproductive rules if the non_productive set is not empty
-    return non_productive
+    from nltk import Nonterminal
+    return set(Nonterminal(symbol) for symbol in get_grammar_analysis(grammar, start=start).unproductive)
 
-def has_unproductive_rules(grammar: str | nltk.CFG | nltk.PCFG, start='S') -> bool:
+def has_unproductive_rules(grammar: str | nltk.CFG | nltk.PCFG | CompiledGrammar, start='S') -> bool:
     """Returns True if a grammar has at least one unproductive rule."""
-    return bool(get_unproductive_rules(grammar, start=start))
+    return bool(get_grammar_analysis(grammar, start=start).unproductive)
 
-def is_transient(grammar: str | nltk.CFG | nltk.PCFG, start='S') -> bool:
+def is_transient(grammar: str | nltk.CFG | nltk.PCFG | CompiledGrammar, start='S') -> bool:
     """
     Check if a grammar is transient, meaning that the start symbol will always be reduced into a terminal string.
     A grammar is transient iff its unproductive rules are the unreachable states.
     If a grammar is non-transient, it is cyclic and can never be reduced to a terminal string.
     """
 
-    grammar = to_grammar(grammar)
-    graph = build_transition_graph(grammar)
-
-    unreachable_states = set(nltk.Nonterminal(state) for state in get_unreachable_states(graph, start=start))
-    unproductive_rules = get_unproductive_rules(grammar)
-
-    return unproductive_rules == unreachable_states
+    return get_grammar_analysis(grammar, start=start).transient
 
 def print_graph(grammar, start='S') -> None:
     """
     Print the transition graph, reachable states, absorbing states, and unproductive rules of a grammar.
     """
 
-    grammar = to_grammar(grammar)
-    
-    graph = build_transition_graph(grammar)
-    reachable_states = get_reachable_states(graph, start=start)
-    unreachable_states = get_unreachable_states(graph, start=start)
-    absorbing_states = find_absorbing_states(grammar)
-    unproductive_rules = [str(rule) for rule in get_unproductive_rules(grammar)]
-    transient = is_transient(grammar)
+    analysis = get_grammar_analysis(grammar, start=start)
 
     # sort the lists
-    reachable_states = sorted(reachable_states)
-    unreachable_states = sorted(unreachable_states)
-    absorbing_states = sorted(absorbing_states)
-    unproductive_rules = sorted(unproductive_rules)
+    reachable_states = sorted(analysis.reachable)
+    unreachable_states = sorted(analysis.unreachable)
+    absorbing_states = sorted(analysis.absorbing)
+    unproductive_rules = sorted(analysis.unproductive)
 
-    print("Graph:             ", graph)
+    print("Graph:             ", analysis.transition_graph())
     print("Reachable states:  ", reachable_states)
     print("Unreachable states:", unreachable_states)
     print("Unproductive Rules:", unproductive_rules)
     print("Absorbing states:  ", absorbing_states)
     
-    print("Is Transient:      ", transient)
\ No newline at end of file
+    print("Is Transient:      ", analysis.transient)
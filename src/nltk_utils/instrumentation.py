@@ -0,0 +1,206 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Optional counters for the hot paths of the sampler and the parsers, per grammar.
+# Everything is off by default: instrumented code checks `instrumentation.enabled` once per sentence or parse
+# and does nothing else, so the overhead when disabled is a single attribute lookup.
+#
+#   from nltk_utils import instrumentation
+#   instrumentation.enable()
+#   instrumentation.start_dump('metrics.prom', interval=10, format='prometheus')
+#   ... generate a corpus ...
+#   print(instrumentation.snapshot())
+#
+# Grammars are identified by the content hash of their compiled grammar. Counters live in the process that records them:
+# the worker processes of `generate_documents_pcfg` send theirs back with every shard (`take`), and the parent adds them
+# to its own (`merge`), so the snapshot of the parent covers the whole run.
+
+enabled = False
+
+# counter name -> help text, the counters every grammar has
+COUNTERS = {
+    'sentences': 'sentences sampled by generate_sentence_pcfg',
+    'sampling_seconds': 'time spent in generate_sentence_pcfg',
+    'derivations': 'derivations run by the derivation engines, including aborted ones',
+    'expansions': 'nonterminals expanded by the derivation engines',
+    'retries': 'derivations started again after an abort',
+    'aborts': 'derivations aborted at the max_iterations cap',
+    'failures': 'sentences given up after max_tries aborts',
+    'parses': 'grammars parsed from text or nltk objects, cache misses of compile_grammar',
+    'parse_seconds': 'time spent parsing grammars in compile_grammar',
+    'to_pcfg_calls': 'calls of to_pcfg',
+    'to_pcfg_seconds': 'time spent in to_pcfg',
+    'recognitions': 'sentences checked by a recognizer or parser',
+    'chart_columns': 'chart columns computed by the recognizers',
+    'chart_items': 'non-empty chart cells (CYK), items (Earley) or edges (nltk)',
+}
+
+_lock = threading.Lock()
+_grammars: dict[str, dict[str, float]] = {}
+_max_expansions: dict[str, int] = {}
+
+_dump_thread = None
+_dump_stop = None
+
+
+def enable() -> None:
+    """Start recording counters."""
+    global enabled
+    enabled = True
+
+
+def disable() -> None:
+    """Stop recording counters, the counters recorded so far are kept."""
+    global enabled
+    enabled = False
+
+
+def reset() -> None:
+    """Clear all counters."""
+    with _lock:
+        _grammars.clear()
+        _max_expansions.clear()
+
+
+def record(grammar: str, counter: str, value: float = 1) -> None:
+    """
+    Add `value` to a counter of a grammar.\\
+    Callers check `enabled` first, so this is only reached when instrumentation is on.
+    - grammar (`str`): the content hash of the grammar
+    """
+    with _lock:
+        counters = _grammars.get(grammar)
+        if counters is None:
+            counters = _grammars[grammar] = dict.fromkeys(COUNTERS, 0)
+        counters[counter] += value
+
+
+def record_expansions(grammar: str, expansions: int) -> None:
+    """Record one derivation with `expansions` expansions."""
+    record(grammar, 'derivations')
+    record(grammar, 'expansions', expansions)
+    with _lock:
+        if expansions > _max_expansions.get(grammar, 0):
+            _max_expansions[grammar] = expansions
+
+
+def take() -> dict:
+    """The raw counters recorded so far, without the derived rates, and clear them. See `merge`."""
+    with _lock:
+        state = {'counters': {grammar: dict(counters) for grammar, counters in _grammars.items()},
+                 'max_expansions': dict(_max_expansions)}
+        _grammars.clear()
+        _max_expansions.clear()
+        return state
+
+
+def merge(state: dict) -> None:
+    """Add the counters of `take` in another process to the counters of this process."""
+    with _lock:
+        for grammar, values in state['counters'].items():
+            counters = _grammars.get(grammar)
+            if counters is None:
+                counters = _grammars[grammar] = dict.fromkeys(COUNTERS, 0)
+            for counter, value in values.items():
+                counters[counter] += value
+        for grammar, expansions in state['max_expansions'].items():
+            if expansions > _max_expansions.get(grammar, 0):
+                _max_expansions[grammar] = expansions
+
+
+@contextmanager
+def timer(grammar: str, counter: str):
+    """Add the time spent in the block to a counter, in seconds."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(grammar, counter, time.perf_counter() - start)
+
+
+def snapshot() -> dict[str, dict[str, float]]:
+    """
+    The counters of every grammar, plus the derived rates:
+    - `expansions_per_sentence` (aborted derivations included, they are part of the cost), `max_expansions`
+    - `sentences_per_second`: sentences over the time spent sampling them
+    - `chart_items_per_recognition`
+    """
+
+    with _lock:
+        result = {}
+        for grammar, counters in _grammars.items():
+            stats = dict(counters)
+            stats['expansions_per_sentence'] = counters['expansions'] / counters['sentences'] if counters['sentences'] else 0.0
+            stats['max_expansions'] = _max_expansions.get(grammar, 0)
+            stats['sentences_per_second'] = counters['sentences'] / counters['sampling_seconds'] if counters['sampling_seconds'] else 0.0
+            stats['chart_items_per_recognition'] = counters['chart_items'] / counters['recognitions'] if counters['recognitions'] else 0.0
+            result[grammar] = stats
+        return result
+
+
+def to_json() -> str:
+    return json.dumps({'time': time.time(), 'grammars': snapshot()}, indent=2)
+
+
+def to_prometheus(prefix: str = 'cfg') -> str:
+    """The counters in the Prometheus text exposition format, one series per grammar."""
+
+    grammars = snapshot()
+    lines = []
+    derived = ['expansions_per_sentence', 'max_expansions', 'sentences_per_second', 'chart_items_per_recognition']
+
+    for name in list(COUNTERS) + derived:
+        metric = f'{prefix}_{name}' + ('_total' if name in COUNTERS else '')
+        if name in COUNTERS:
+            lines.append(f'# HELP {metric} {COUNTERS[name]}')
+        lines.append(f'# TYPE {metric} {"counter" if name in COUNTERS else "gauge"}')
+        for grammar, stats in grammars.items():
+            lines.append(f'{metric}{{grammar="{grammar[:12]}"}} {stats[name]:g}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def dump(path: str, format: str = 'json') -> None:
+    """
+    Write the counters to a file, `'json'` or `'prometheus'` (text format, e.g. for the node exporter textfile collector).\\
+    The file is replaced atomically, so readers never see a half-written dump.
+    """
+
+    if format not in ('json', 'prometheus'):
+        raise ValueError(f"Unknown format '{format}', choose one of ['json', 'prometheus'].")
+
+    text = to_json() if format == 'json' else to_prometheus()
+    temporary = f'{path}.tmp'
+    with open(temporary, 'w') as f:
+        f.write(text)
+    os.replace(temporary, path)
+
+
+def start_dump(path: str, interval: float = 10.0, format: str = 'json') -> None:
+    """Dump the counters to `path` every `interval` seconds from a background thread, until `stop_dump()`."""
+
+    global _dump_thread, _dump_stop
+    stop_dump()
+
+    _dump_stop = threading.Event()
+
+    def run(stop):
+        while not stop.wait(interval):
+            dump(path, format)
+        dump(path, format)
+
+    _dump_thread = threading.Thread(target=run, args=(_dump_stop,), daemon=True)
+    _dump_thread.start()
+
+
+def stop_dump() -> None:
+    """Stop the periodic dump, the counters are dumped one last time."""
+
+    global _dump_thread, _dump_stop
+    if _dump_thread is not None:
+        _dump_stop.set()
+        _dump_thread.join()
+        _dump_thread = _dump_stop = None
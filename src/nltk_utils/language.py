@@ -0,0 +1,97 @@
+from nltk_utils.utils import CompiledGrammar
+
+
+def enumerate_language(grammar: CompiledGrammar, max_length: int, terminals: list[str] | None = None):
+    """
+    Yield every sentence of the grammar up to `max_length` terminals, as tuples of terminal strings.\\
+    The language is built bottom-up: for every nonterminal and length `k` the set of strings it derives
+    is computed from the sets of shorter strings, unary rules are propagated until nothing changes.
+    The cost depends on the size of the language, not on the number of possible strings.
+    Sentences are yielded by length, and within one length in the order of `itertools.product(terminals, repeat=k)`.
+    - terminals (`list[str]`): only use these terminals, and in this order. Defaults to the terminals of the grammar.
+    """
+
+    if terminals is None:
+        terminals = grammar.terminals
+
+    # grammar terminal id -> position in `terminals`, so the strings sort like itertools.product
+    order = {terminal: i for i, terminal in enumerate(terminals)}
+    terminal_order = [order.get(terminal) for terminal in grammar.terminals]
+
+    if any(len(rhs) == 0 for rhs in grammar.rhs_tuples):
+        raise ValueError("Empty productions are not supported.")
+
+    # only the nonterminals reachable from the start symbol matter
+    reachable = {grammar.start}
+    stack = [grammar.start]
+    while stack:
+        symbol = stack.pop()
+        for production in range(grammar.prod_offsets[symbol], grammar.prod_offsets[symbol + 1]):
+            for rhs_symbol in grammar.rhs_tuples[production]:
+                if rhs_symbol >= 0 and rhs_symbol not in reachable:
+                    reachable.add(rhs_symbol)
+                    stack.append(rhs_symbol)
+
+    productions = [p for p in range(grammar.n_productions) if grammar.lhs[p] in reachable]
+    unary = [p for p in productions if len(grammar.rhs_tuples[p]) == 1 and grammar.rhs_tuples[p][0] >= 0]
+    other = [p for p in productions if not (len(grammar.rhs_tuples[p]) == 1 and grammar.rhs_tuples[p][0] >= 0)]
+
+    unary_parents = {}
+    for p in unary:
+        unary_parents.setdefault(grammar.rhs_tuples[p][0], []).append(grammar.lhs[p])
+
+    # strings[A][k]: the strings of length k derived by A, as tuples of positions in `terminals`
+    strings = {symbol: [set()] for symbol in reachable}
+    suffixes = {}
+
+    def symbol_strings(symbol: int, k: int) -> set[tuple]:
+        if symbol >= 0:
+            return strings[symbol][k]
+        position = terminal_order[~symbol]
+        return {(position,)} if k == 1 and position is not None else set()
+
+    def suffix_strings(production: int, start: int, k: int) -> set[tuple]:
+        """The strings of length k derived by rhs[start:] of a production."""
+
+        rhs = grammar.rhs_tuples[production]
+        if start == len(rhs) - 1:
+            return symbol_strings(rhs[start], k)
+
+        key = (production, start, k)
+        if key in suffixes:
+            return suffixes[key]
+
+        result = set()
+        rest = len(rhs) - start - 1
+        for length in range(1, k - rest + 1):
+            heads = symbol_strings(rhs[start], length)
+            if not heads:
+                continue
+            tails = suffix_strings(production, start + 1, k - length)
+            for head in heads:
+                for tail in tails:
+                    result.add(head + tail)
+
+        suffixes[key] = result
+        return result
+
+    for k in range(1, max_length + 1):
+        for symbol in reachable:
+            strings[symbol].append(set())
+
+        # productions with at least two symbols only need shorter strings
+        for production in other:
+            strings[grammar.lhs[production]][k] |= suffix_strings(production, 0, k)
+
+        # unary rules A -> B: propagate the strings of B to A until nothing changes
+        queue = list(reachable)
+        while queue:
+            symbol = queue.pop()
+            for parent in unary_parents.get(symbol, []):
+                before = len(strings[parent][k])
+                strings[parent][k] |= strings[symbol][k]
+                if len(strings[parent][k]) > before:
+                    queue.append(parent)
+
+        for sentence in sorted(strings[grammar.start][k]):
+            yield tuple(terminals[position] for position in sentence)
@@ -0,0 +1,412 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, NamedTuple
+
+import numpy as np
+
+from nltk_utils.utils import CompiledGrammar, compile_grammar
+
+if TYPE_CHECKING:
+    import nltk
+
+# Statistics of the derivations of a PCFG, computed from the grammar instead of by sampling.
+# A PCFG is a branching process: every nonterminal is replaced by the symbols of a random production.
+# All functions take the same grammars as generate_sentence_pcfg and use the same production probabilities
+# (the probabilities of every nonterminal are normalized, like the samplers do).
+
+
+class PCFGStats(NamedTuple):
+    """
+    The analytic statistics of a PCFG, see `analyze_pcfg`.
+    """
+    spectral_radius: float
+    criticality: str
+    termination_probability: float
+    expected_length: float
+    expected_expansions: float
+
+
+def _arrays(grammar: CompiledGrammar) -> dict:
+    """The productions of the grammar as NumPy arrays, built once and cached on the compiled grammar."""
+
+    arrays = grammar.cache.get('analysis')
+    if arrays is not None:
+        return arrays
+
+    n_nonterminals = len(grammar.nonterminals)
+    lhs = np.array(grammar.lhs, dtype=np.int64)
+
+    # production probabilities, normalized per nonterminal
+    weights = np.ones(len(lhs)) if grammar.probs is None else np.array(grammar.probs, dtype=np.float64)
+    totals = np.bincount(lhs, weights=weights, minlength=n_nonterminals)
+    probs = weights / np.where(totals > 0, totals, 1.0)[lhs] if len(lhs) else weights
+
+    # right-hand sides padded with `n_nonterminals`, terminals are mapped to the padding as well:
+    # with x extended by a 1 at index `n_nonterminals`, prod(x[rhs]) only multiplies the nonterminals
+    rhs_length = np.array([len(rhs) for rhs in grammar.rhs_tuples], dtype=np.int64)
+    width = max(1, int(rhs_length.max())) if len(rhs_length) else 1
+    rhs = np.full((len(lhs), width), n_nonterminals, dtype=np.int64)
+    for production, symbols in enumerate(grammar.rhs_tuples):
+        for position, symbol in enumerate(symbols):
+            if symbol >= 0:
+                rhs[production, position] = symbol
+    n_terminal_children = np.array([sum(symbol < 0 for symbol in symbols) for symbols in grammar.rhs_tuples], dtype=np.float64)
+
+    # the nonterminals reachable from the start symbol
+    reachable = np.zeros(n_nonterminals, dtype=bool)
+    reachable[grammar.start] = True
+    stack = [grammar.start]
+    while stack:
+        symbol = stack.pop()
+        for production in range(grammar.prod_offsets[symbol], grammar.prod_offsets[symbol + 1]):
+            for child in grammar.rhs_tuples[production]:
+                if child >= 0 and not reachable[child]:
+                    reachable[child] = True
+                    stack.append(child)
+
+    arrays = grammar.cache['analysis'] = {
+        'n': n_nonterminals,
+        'lhs': lhs,
+        'probs': probs,
+        'rhs': rhs,
+        'rhs_length': rhs_length,
+        'terminals': n_terminal_children,
+        'reachable': reachable,
+    }
+    return arrays
+
+
+def _generating_function(arrays: dict, x: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Evaluate `f_A(x) = sum_p prob_p * prod_{B in rhs_p} x_B` and its Jacobian at `x`.
+    """
+
+    n, lhs, probs, rhs = arrays['n'], arrays['lhs'], arrays['probs'], arrays['rhs']
+
+    values = np.append(x, 1.0)[rhs]
+    f = np.bincount(lhs, weights=probs * values.prod(axis=1), minlength=n)
+
+    # d/dx_B of a product is the product of all other factors: exclusive prefix times exclusive suffix products
+    ones = np.ones((len(lhs), 1))
+    prefix = np.cumprod(np.hstack([ones, values[:, :-1]]), axis=1)
+    suffix = np.cumprod(np.hstack([ones, values[:, :0:-1]]), axis=1)[:, ::-1]
+    index = lhs[:, None] * (n + 1) + rhs
+    jacobian = np.bincount(index.ravel(), weights=(probs[:, None] * prefix * suffix).ravel(), minlength=n * (n + 1))
+
+    return f, jacobian.reshape(n, n + 1)[:, :n]
+
+
+def mean_matrix(grammar: str | nltk.PCFG | CompiledGrammar) -> np.ndarray:
+    """
+    Return the mean matrix `M` of the grammar: `M[A, B]` is the expected number of `B`s produced by one expansion of `A`.
+    """
+
+    arrays = _arrays(compile_grammar(grammar, probabilistic=True))
+    return _generating_function(arrays, np.ones(arrays['n']))[1]
+
+
+def _reachable_mean(arrays: dict) -> tuple[np.ndarray, float]:
+    """
+    The mean matrix restricted to the reachable nonterminals and its spectral radius.\\
+    Both are cached in `arrays`, so the statistics of `analyze_pcfg` and `can_sample` share one eigenvalue computation.
+    """
+
+    if 'reachable_mean' not in arrays:
+        reachable = arrays['reachable']
+        matrix = _generating_function(arrays, np.ones(arrays['n']))[1][np.ix_(reachable, reachable)]
+        arrays['reachable_mean'] = matrix
+        arrays['spectral_radius'] = float(np.abs(np.linalg.eigvals(matrix)).max())
+
+    return arrays['reachable_mean'], arrays['spectral_radius']
+
+
+def spectral_radius(grammar: str | nltk.PCFG | CompiledGrammar) -> float:
+    """
+    Return the spectral radius of the mean matrix, restricted to the nonterminals reachable from the start symbol.\\
+    Below 1 the grammar is subcritical: derivations terminate and have a finite expected length.
+    Above 1 it is supercritical: derivations can grow forever, this is where `generate_sentence_pcfg` hits `max_iterations`.
+    """
+
+    return _reachable_mean(_arrays(compile_grammar(grammar, probabilistic=True)))[1]
+
+
+def criticality(grammar: str | nltk.PCFG | CompiledGrammar, tol=1e-9) -> str:
+    """
+    Classify the grammar as `'subcritical'`, `'critical'` or `'supercritical'` by its spectral radius.
+    """
+
+    radius = spectral_radius(grammar)
+    if radius < 1.0 - tol:
+        return 'subcritical'
+    if radius > 1.0 + tol:
+        return 'supercritical'
+    return 'critical'
+
+
+def termination_probabilities(grammar: str | nltk.PCFG | CompiledGrammar, tol=1e-12, max_iterations=200) -> np.ndarray:
+    """
+    Return for every nonterminal the probability that a derivation starting from it terminates.\\
+    This is the least fixed point of `x = f(x)`, where `f_A(x) = sum_p prob_p * prod_{B in rhs_p} x_B`.
+    Newton's method started at `x = 0` converges to it monotonically, quadratically unless the grammar is critical.
+    """
+
+    arrays = _arrays(compile_grammar(grammar, probabilistic=True))
+    identity = np.eye(arrays['n'])
+
+    x = np.zeros(arrays['n'])
+    for _ in range(max_iterations):
+        f, jacobian = _generating_function(arrays, x)
+        try:
+            step = np.linalg.solve(identity - jacobian, f - x)
+        except np.linalg.LinAlgError:
+            # singular for unary cycles that never leave, fall back to a least squares step
+            step = np.linalg.lstsq(identity - jacobian, f - x, rcond=None)[0]
+
+        x_next = np.clip(x + step, 0.0, 1.0)
+        if np.abs(x_next - x).max() < tol:
+            return x_next
+        x = x_next
+
+    return x
+
+
+def _expectations(arrays: dict, costs: np.ndarray) -> np.ndarray:
+    """
+    Solve `e = costs + M e` on the reachable nonterminals, the expected total cost of a derivation.\\
+    The expectations are infinite for the nonterminals of a grammar that is not subcritical.
+    """
+
+    reachable = arrays['reachable']
+    matrix, radius = _reachable_mean(arrays)
+
+    result = np.full(arrays['n'], np.nan)
+    if radius >= 1.0:
+        result[reachable] = np.inf
+        return result
+
+    result[reachable] = np.linalg.solve(np.eye(len(matrix)) - matrix, costs[reachable])
+    return result
+
+
+def expected_length(grammar: str | nltk.PCFG | CompiledGrammar) -> float:
+    """
+    Return the expected number of terminals of a sentence, `inf` if the grammar is not subcritical.
+    """
+
+    grammar = compile_grammar(grammar, probabilistic=True)
+    arrays = _arrays(grammar)
+    costs = np.bincount(arrays['lhs'], weights=arrays['probs'] * arrays['terminals'], minlength=arrays['n'])
+
+    return float(_expectations(arrays, costs)[grammar.start])
+
+
+def expected_expansions(grammar: str | nltk.PCFG | CompiledGrammar) -> float:
+    """
+    Return the expected number of expansions of a derivation, `inf` if the grammar is not subcritical.\\
+    This is what `generate_sentence_pcfg` compares against `max_iterations`.
+    """
+
+    grammar = compile_grammar(grammar, probabilistic=True)
+    arrays = _arrays(grammar)
+
+    return float(_expectations(arrays, np.ones(arrays['n']))[grammar.start])
+
+
+def length_distributions(grammar: str | nltk.PCFG | CompiledGrammar, max_length: int) -> np.ndarray:
+    """
+    Return `D` with `D[A, n]` the probability that a derivation starting from nonterminal `A` yields exactly `n` terminals.\\
+    Every symbol yields at least one terminal, so the distribution of a right-hand side at length `n` is a convolution
+    of distributions at shorter lengths. Only unary rules `A -> B` stay at the same length, they are solved as a linear system.
+    Costs O(max_length^2 * len(rhs)) vectorized over the productions.
+    """
+
+    grammar = compile_grammar(grammar, probabilistic=True)
+    arrays = _arrays(grammar)
+    n, lhs, probs, rhs_length = arrays['n'], arrays['lhs'], arrays['probs'], arrays['rhs_length']
+
+    if (rhs_length == 0).any():
+        raise ValueError("Empty productions are not supported.")
+
+    # the rows of `symbols` are the length distributions of the nonterminals, the last row is the one of a terminal
+    symbols = np.zeros((n + 1, max_length + 1))
+    if max_length >= 1:
+        symbols[n, 1] = 1.0
+
+    unary = np.zeros((n, n))
+    terminal_rules = np.zeros(n)
+
+    # every production with at least two symbols is a chain of slots, slot j is the distribution of rhs[:j+1]
+    slot_symbol, slot_previous, last_slots, last_probs, last_lhs = [], [], [], [], []
+    for production, rhs in enumerate(grammar.rhs_tuples):
+        rows = [symbol if symbol >= 0 else n for symbol in rhs]
+        if len(rows) == 1:
+            if rows[0] == n:
+                terminal_rules[lhs[production]] += probs[production]
+            else:
+                unary[lhs[production], rows[0]] += probs[production]
+            continue
+
+        for position, row in enumerate(rows):
+            slot_previous.append(len(slot_symbol) - 1 if position else -1)
+            slot_symbol.append(row)
+        last_slots.append(len(slot_symbol) - 1)
+        last_probs.append(probs[production])
+        last_lhs.append(lhs[production])
+
+    slot_symbol = np.array(slot_symbol, dtype=np.int64)
+    slot_previous = np.array(slot_previous, dtype=np.int64)
+    first = slot_previous < 0
+    first_symbol = slot_symbol[first]
+    rest, rest_symbol, rest_previous = np.flatnonzero(~first), slot_symbol[~first], slot_previous[~first]
+    last_slots, last_probs, last_lhs = np.array(last_slots, dtype=np.int64), np.array(last_probs), np.array(last_lhs, dtype=np.int64)
+    slots = np.zeros((len(slot_symbol), max_length + 1))
+
+    # (I - U)^-1 propagates the distributions through unary rules
+    try:
+        propagate = np.linalg.inv(np.eye(n) - unary)
+    except np.linalg.LinAlgError:
+        # a closed unary cycle never yields anything, sum the series I + U + U^2 + ... instead
+        propagate, power = np.eye(n), unary.copy()
+        for _ in range(64):
+            propagate = propagate + power @ propagate
+            power = power @ power
+
+    for length in range(1, max_length + 1):
+        # convolutions only need the distributions of shorter lengths
+        if len(rest):
+            slots[rest, length] = (slots[rest_previous, 1:length] * symbols[rest_symbol, length-1:0:-1]).sum(axis=1)
+
+        direct = np.bincount(last_lhs, weights=last_probs * slots[last_slots, length], minlength=n)
+        if length == 1:
+            direct += terminal_rules
+
+        symbols[:n, length] = propagate @ direct
+        slots[first, length] = symbols[first_symbol, length]
+
+    return symbols[:n]
+
+
+def length_distribution(grammar: str | nltk.PCFG | CompiledGrammar, max_length: int) -> np.ndarray:
+    """
+    Return the probabilities that a sentence has exactly `0..max_length` terminals.\\
+    The rest of the probability mass is on longer sentences and on derivations that never terminate.
+    """
+
+    grammar = compile_grammar(grammar, probabilistic=True)
+    return length_distributions(grammar, max_length)[grammar.start]
+
+
+def analyze_pcfg(grammar: str | nltk.PCFG | CompiledGrammar) -> PCFGStats:
+    """
+    Compute the analytic statistics of a grammar, without sampling a single sentence.
+    """
+
+    grammar = compile_grammar(grammar, probabilistic=True)
+    radius = spectral_radius(grammar)
+
+    return PCFGStats(
+        spectral_radius=radius,
+        criticality=criticality(grammar),
+        termination_probability=float(termination_probabilities(grammar)[grammar.start]),
+        expected_length=expected_length(grammar),
+        expected_expansions=expected_expansions(grammar),
+    )
+
+
+def can_sample(grammar: str | nltk.PCFG | CompiledGrammar, min_termination=0.99, max_expected_expansions=1000.0) -> bool:
+    """
+    Screen a grammar before sampling from it.\\
+    A grammar passes if a derivation terminates with probability at least `min_termination`
+    and, for a subcritical grammar, needs at most `max_expected_expansions` expansions on average.
+    Supercritical grammars that pass only waste the derivations that don't terminate.
+    """
+
+    grammar = compile_grammar(grammar, probabilistic=True)
+
+    if termination_probabilities(grammar)[grammar.start] < min_termination:
+        return False
+
+    if criticality(grammar) == 'supercritical':
+        return True
+
+    return expected_expansions(grammar) <= max_expected_expansions
+
+
+def can_sample_many(grammars: list[str | nltk.PCFG | CompiledGrammar], min_termination=0.99,
+                    max_expected_expansions=1000.0, tol=1e-12, max_iterations=200) -> np.ndarray:
+    """
+    `can_sample` for a batch of grammars, returns a boolean array in the order of `grammars`.\\
+    The grammars are stacked into block-diagonal systems, padded to the largest number of nonterminals: padded
+    nonterminals have no productions and are not reachable, so they change none of the results. The Newton steps
+    of `termination_probabilities`, the spectral radii and the expected expansions of the whole batch are then
+    a few stacked NumPy calls instead of several small calls per grammar.
+    """
+
+    grammars = [compile_grammar(grammar, probabilistic=True) for grammar in grammars]
+    if not grammars:
+        return np.zeros(0, dtype=bool)
+
+    batch = [_arrays(grammar) for grammar in grammars]
+    size = len(batch)
+    n = max(1, max(arrays['n'] for arrays in batch))
+    width = max(arrays['rhs'].shape[1] for arrays in batch)
+
+    # the productions of all grammars with global nonterminals `b * n + A`, right-hand sides padded with the
+    # index `size * n` of the extra 1 like in `_generating_function`. Local indices are kept for the Jacobian
+    owner = np.concatenate([np.full(len(arrays['lhs']), b, dtype=np.int64) for b, arrays in enumerate(batch)])
+    lhs = np.concatenate([arrays['lhs'] for arrays in batch])
+    probs = np.concatenate([arrays['probs'] for arrays in batch])
+    rhs = np.full((len(lhs), width), n, dtype=np.int64)
+    row = 0
+    for arrays in batch:
+        local = arrays['rhs']
+        rhs[row:row + len(local), :local.shape[1]] = np.where(local == arrays['n'], n, local)
+        row += len(local)
+    padding = rhs == n
+    global_rhs = np.where(padding, size * n, owner[:, None] * n + rhs)
+    global_lhs = owner * n + lhs
+    jacobian_index = (owner[:, None] * n + lhs[:, None]) * (n + 1) + rhs
+
+    def generating_function(x: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        values = np.append(x.ravel(), 1.0)[global_rhs]
+        f = np.bincount(global_lhs, weights=probs * values.prod(axis=1), minlength=size * n)
+        ones = np.ones((len(lhs), 1))
+        prefix = np.cumprod(np.hstack([ones, values[:, :-1]]), axis=1)
+        suffix = np.cumprod(np.hstack([ones, values[:, :0:-1]]), axis=1)[:, ::-1]
+        jacobian = np.bincount(jacobian_index.ravel(), weights=(probs[:, None] * prefix * suffix).ravel(), minlength=size * n * (n + 1))
+        return f.reshape(size, n), jacobian.reshape(size, n, n + 1)[:, :, :n]
+
+    identity = np.broadcast_to(np.eye(n), (size, n, n))
+    starts = np.array([grammar.start for grammar in grammars], dtype=np.int64)
+
+    # Newton's method of termination_probabilities on all grammars at once
+    x = np.zeros((size, n))
+    for _ in range(max_iterations):
+        f, jacobian = generating_function(x)
+        try:
+            step = np.linalg.solve(identity - jacobian, (f - x)[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            step = (np.linalg.pinv(identity - jacobian) @ (f - x)[..., None])[..., 0]
+        x_next = np.clip(x + step, 0.0, 1.0)
+        converged = np.abs(x_next - x).max() < tol
+        x = x_next
+        if converged:
+            break
+    termination = x[np.arange(size), starts]
+
+    # the mean matrices restricted to the reachable nonterminals, the rest of a matrix is zero
+    reachable = np.zeros((size, n), dtype=bool)
+    for b, arrays in enumerate(batch):
+        reachable[b, :arrays['n']] = arrays['reachable']
+    matrix = generating_function(np.ones((size, n)))[1] * (reachable[:, :, None] & reachable[:, None, :])
+    radius = np.abs(np.linalg.eigvals(matrix)).max(axis=1)
+
+    # expected expansions, only the subcritical grammars have finite ones
+    expansions = np.full(size, np.inf)
+    subcritical = np.flatnonzero(radius < 1.0)
+    if len(subcritical):
+        solved = np.linalg.solve(identity[subcritical] - matrix[subcritical], reachable[subcritical, :, None].astype(np.float64))[..., 0]
+        expansions[subcritical] = solved[np.arange(len(subcritical)), starts[subcritical]]
+
+    supercritical = radius > 1.0 + 1e-9
+    return (termination >= min_termination) & (supercritical | (expansions <= max_expected_expansions))
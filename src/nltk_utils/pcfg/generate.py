@@ -1,9 +1,21 @@
-import nltk
-from nltk import PCFG
+from __future__ import annotations
+
 import random
-import itertools
+import time
+from typing import TYPE_CHECKING, NamedTuple
+
+import numpy as np
+
+from nltk_utils import instrumentation
+from nltk_utils.derivation import Derivation, DerivationBatch, get_engine
+from nltk_utils.language import enumerate_language
+from nltk_utils.recognizers import CYKRecognizer, EarleyRecognizer, get_cyk_recognizer, get_earley_recognizer, recognize_many
+from nltk_utils.sampling import derive_length
+from nltk_utils.utils import CompiledGrammar, compile_grammar, format_probability, register_compiled, to_pcfg
 
-from nltk_utils.utils import to_pcfg
+# nltk is slow to import, it is only loaded when nltk objects or parsers are asked for
+if TYPE_CHECKING:
+    import nltk
 
 
 # example grammar
@@ -27,9 +39,23 @@ meta_grammar = [
 ]
 
 # generate a random valid sentence from the grammar
-def generate_sentence_pcfg(grammar: str | nltk.PCFG, join_char=' '):
+def generate_sentence_pcfg(grammar: str | nltk.PCFG | CompiledGrammar, join_char=' ', engine='rewrite', rng=random,
+                           length: int | None = None, min_length: int | None = None, max_length: int | None = None,
+                           derivation: bool = False):
     """
     Generate a random sentence from the given PCFG grammar.
+    - engine (`str`): the derivation engine, see `nltk_utils.derivation.ENGINES`.
+    `'rewrite'` expands a random nonterminal on every step and reproduces the sentences of earlier versions for a fixed seed,
+    `'stack'` uses a leftmost derivation with O(1) alias sampling and is faster, with the same distribution.
+    - rng: the random number generator, the `random` module or a `random.Random` instance
+    - length (`int`): only generate sentences with exactly this many terminals
+    - min_length, max_length (`int`): only generate sentences with `min_length..max_length` terminals, `max_length` is required.
+    Not together with `length`.
+    With a length condition the sentence is drawn exactly from the distribution of the grammar conditioned on the length,
+    using inside probabilities that are computed once per grammar (see `nltk_utils.sampling`), and `engine` is not used.
+    Raises a ValueError if the grammar has no sentence of the requested length.
+    - derivation (`bool`): also record the derivation of the sentence and return `(sentence, Derivation)`.
+    The derivation is kept as arrays of production ids, `Derivation.to_tree` builds the `nltk.Tree` when it is needed.
     """
 
     # how often to try to generate a valid sentence
@@ -40,48 +66,56 @@ def generate_sentence_pcfg(grammar: str | nltk.PCFG, join_char=' '):
     # after this many iterations, we give up and try again
     max_iterations = 10000
 
-    # Ensure the grammar is a PCFG object
-    grammar = to_pcfg(grammar)
+    # Ensure the grammar is compiled, strings are only parsed once
+    grammar = compile_grammar(grammar, probabilistic=True)
 
-    for current_try in range(max_tries):
+    if instrumentation.enabled:
+        start_time = time.perf_counter()
 
-        current_iteration = 0
-        sentence = [grammar.start()]
+    # conditioned on the length, every derivation succeeds
+    if length is not None or min_length is not None or max_length is not None:
+        productions = [] if derivation else None
+        sentence = derive_length(grammar, length, min_length, max_length, rng, productions=productions)
+        if instrumentation.enabled:
+            _record_sentence(grammar, start_time)
+        return _sentence_result(grammar, sentence, join_char, productions)
 
-        # as long as there are non-terminals in the sentence
-        while any(nltk.grammar.is_nonterminal(symbol) for symbol in sentence):
+    derive = get_engine(engine)
 
-            # find the non-terminals
-            non_terminals = [i for i, symbol in enumerate(sentence) if nltk.grammar.is_nonterminal(symbol)]
+    for current_try in range(max_tries):
 
-            if not non_terminals:
-                break  # we are done, there are only non-terminals in the sentence
+        productions = [] if derivation else None
+        sentence = derive(grammar, max_iterations, rng, productions)
 
-            # randomly choose a non-terminal to expand
-            nt_index = random.choice(non_terminals)
-            symbol = sentence[nt_index]
+        # if the sentence is valid, return it
+        if sentence is not None:
+            if instrumentation.enabled:
+                _record_sentence(grammar, start_time)
+            return _sentence_result(grammar, sentence, join_char, productions)
 
-            # randomly choose a production for the non-terminal
-            # this is weighted by the probability of the production
-            productions = grammar.productions(lhs=symbol)
-            production = random.choices(productions, weights=[p.prob() for p in productions])[0]
+        if instrumentation.enabled:
+            instrumentation.record(grammar.content_hash, 'aborts')
+            if current_try + 1 < max_tries:
+                instrumentation.record(grammar.content_hash, 'retries')
 
-            # replace the non-terminal with the production
-            sentence = sentence[:nt_index] + list(production.rhs()) + sentence[nt_index+1:]
-
-            # avoid infinite loops
-            current_iteration += 1
-            if current_iteration > max_iterations:
-                break
-        
-        # if the sentence is valid, return it
-        if not any(nltk.grammar.is_nonterminal(symbol) for symbol in sentence):
-            return join_char.join(str(symbol) for symbol in sentence)
+    if instrumentation.enabled:
+        instrumentation.record(grammar.content_hash, 'failures')
+        instrumentation.record(grammar.content_hash, 'sampling_seconds', time.perf_counter() - start_time)
 
     raise ValueError("The grammar is too complex to generate a valid sentence.")
 
+def _sentence_result(grammar: CompiledGrammar, sentence: list[int], join_char: str, productions: list | None):
+    text = join_char.join(grammar.terminals[symbol] for symbol in sentence)
+    if productions is None:
+        return text
+    return text, Derivation.from_productions(grammar, productions)
+
+def _record_sentence(grammar: CompiledGrammar, start_time: float):
+    instrumentation.record(grammar.content_hash, 'sentences')
+    instrumentation.record(grammar.content_hash, 'sampling_seconds', time.perf_counter() - start_time)
+
 # this function generates a random grammar
-def generate_pcfg(terminals, nonterminals, n_rules=5, prob_terminal=0.5) -> str:
+def generate_pcfg(terminals, nonterminals, n_rules=5, prob_terminal=0.5, method='direct', rng=random) -> str:
     """
     Generate a random PCFG grammar with the given terminals and nonterminals.
     The grammar will have n_rules rules that are all in chomsky normal form.
@@ -90,8 +124,142 @@ def generate_pcfg(terminals, nonterminals, n_rules=5, prob_terminal=0.5) -> str:
     - nonterminals (`list[str]`): a list of nonterminal symbols
     - n_rules (`int`): the number of rules in the grammar
     - prob_terminal (`float`): the probability of a rule being a terminal rule
+    - method (`str`): `'direct'` samples the rules directly in O(n_rules) and also puts the compiled grammar into the cache,
+    `'constructive'` does the same, but the first rule of every nonterminal comes from a random spanning tree,
+    so every nonterminal is reachable from `S` and productive (the grammar is transient) without any rejection,
+    `'meta'` derives every rule from a meta-grammar like earlier versions did, and reproduces their grammars for a fixed seed.
+    Both draw the rules and probabilities from the same distribution and give the same string format,
+    but only `'direct'` rejects duplicate rules (the duplicate check of `'meta'` never matches, it is kept as it was).
+    - rng: the random number generator, the `random` module or a `random.Random` instance
+    """
+
+    if method in ('direct', 'constructive'):
+        return _generate_pcfg_direct(terminals, nonterminals, n_rules, prob_terminal, rng, constructive=method == 'constructive')[0]
+    if method == 'meta':
+        return _generate_pcfg_meta(terminals, nonterminals, n_rules, prob_terminal, rng)
+
+    raise ValueError(f"Unknown method '{method}', choose one of ['direct', 'constructive', 'meta'].")
+
+def generate_pcfg_compiled(terminals, nonterminals, n_rules=5, prob_terminal=0.5, method='direct', rng=random) -> CompiledGrammar:
+    """
+    Generate a random PCFG grammar like `generate_pcfg`, but return the compiled grammar.\\
+    The rules are sampled straight into the compiled representation, nltk is never involved.
+    - method (`str`): `'direct'` or `'constructive'`, see `generate_pcfg`
     """
 
+    if method not in ('direct', 'constructive'):
+        raise ValueError(f"Unknown method '{method}', choose one of ['direct', 'constructive'].")
+
+    return _generate_pcfg_direct(terminals, nonterminals, n_rules, prob_terminal, rng, constructive=method == 'constructive')[1]
+
+def _spanning_rules(terminals, nonterminals, rng) -> list[tuple]:
+    """
+    One rule per nonterminal that makes every nonterminal reachable from `nonterminals[0]` and productive.\\
+    The nonterminals are put into a random tree where every node has at most two children:
+    a leaf gets a terminal rule `A -> "a"`, a node with two children `A -> B C`, and a node with one child `A -> B X`
+    where `X` is a random node that comes after `A` in the tree order. Every rule only uses nonterminals that come later,
+    so productivity follows bottom-up, and every nonterminal is reachable through its parent.
+    """
+
+    order = list(dict.fromkeys(nonterminals))
+    rest = order[1:]
+    rng.shuffle(rest)
+    order[1:] = rest
+
+    # attach every node to a random earlier node that has less than two children
+    children = {nonterminal: [] for nonterminal in order}
+    open_nodes = [order[0], order[0]]
+    for nonterminal in order[1:]:
+        index = rng.randrange(len(open_nodes))
+        open_nodes[index], open_nodes[-1] = open_nodes[-1], open_nodes[index]
+        children[open_nodes.pop()].append(nonterminal)
+        open_nodes += [nonterminal, nonterminal]
+
+    rules = []
+    for i, nonterminal in enumerate(order):
+        nonterminal_children = children[nonterminal]
+        if not nonterminal_children:
+            rhs = ((rng.choice(terminals), False),)
+        else:
+            if len(nonterminal_children) == 1:
+                nonterminal_children = nonterminal_children + [order[rng.randrange(i + 1, len(order))]]
+            rng.shuffle(nonterminal_children)
+            rhs = tuple((child, True) for child in nonterminal_children)
+        rules.append((nonterminal, rhs))
+
+    # list the rules in the order of `nonterminals`, like the other methods
+    position = {nonterminal: i for i, nonterminal in enumerate(nonterminals)}
+    rules.sort(key=lambda rule: position[rule[0]])
+
+    return rules
+
+def _generate_pcfg_direct(terminals, nonterminals, n_rules, prob_terminal, rng, constructive=False) -> tuple[str, CompiledGrammar]:
+
+    assert n_rules >= len(nonterminals), "There must be at least as many rules as nonterminals (n_rules >= len(nonterminals))"
+
+    # a right-hand side is a tuple of (symbol, is_nonterminal) pairs, like CompiledGrammar.from_productions expects
+    def random_rhs():
+        if rng.random() < prob_terminal:
+            return ((rng.choice(terminals), False),)
+        return ((rng.choice(nonterminals), True), (rng.choice(nonterminals), True))
+
+    # the first rules start with the nonterminals, so that every nonterminal has at least one rule
+    if constructive:
+        rules = _spanning_rules(terminals, nonterminals, rng)
+    else:
+        rules = [(nonterminal, random_rhs()) for nonterminal in nonterminals]
+    seen = set(rules)
+
+    # duplicates are rejected below, so there must be enough distinct rules that random_rhs can draw:
+    # only terminal rules with prob_terminal 1, only binary rules with prob_terminal 0
+    n_lhs, n_terminals, n_nonterminals = len(set(nonterminals)), len(set(terminals)), len(set(nonterminals))
+    n_drawable = n_lhs * ((n_terminals if prob_terminal > 0 else 0) + (n_nonterminals ** 2 if prob_terminal < 1 else 0))
+    n_extra = sum(1 for rule in seen if (rule[1][0][1] and prob_terminal >= 1) or (not rule[1][0][1] and prob_terminal <= 0))
+    if n_rules > n_drawable + n_extra:
+        raise ValueError(f"There are only {n_drawable + n_extra} distinct rules with {n_terminals} terminals, {n_nonterminals} nonterminals "
+                         f"and prob_terminal {prob_terminal}, {n_rules} were requested (n_rules too large).")
+
+    # the other rules get a random left-hand side, duplicates are rejected
+    while len(rules) < n_rules:
+        rule = (rng.choice(nonterminals), random_rhs())
+        if rule not in seen:
+            seen.add(rule)
+            rules.append(rule)
+
+    rules_by_lhs = {}
+    for rule in rules:
+        rules_by_lhs.setdefault(rule[0], []).append(rule)
+
+    # now we assign probabilities to the rules, in the same way as the meta-grammar method
+    productions = []
+    for nonterminal in dict.fromkeys(nonterminals):
+        nonterminal_rules = rules_by_lhs.get(nonterminal, [])
+        prob_sum = 0
+
+        for j, (lhs, rhs) in enumerate(nonterminal_rules):
+            if j < len(nonterminal_rules) - 1:
+                prob = (rng.random() * (1 - prob_sum)) / 2.0
+            else:
+                prob = 1 - prob_sum
+            prob_sum += prob
+
+            if rhs[0][1]:
+                rule = f'{lhs} -> {rhs[0][0]} {rhs[1][0]} [{format_probability(prob)}]'
+            else:
+                rule = f'{lhs} -> "{rhs[0][0]}" [{format_probability(prob)}]'
+            productions.append((rule, (lhs, rhs, prob)))
+
+    # sort the rules and add the starting rule to the beginning of the list
+    productions.sort(key=lambda production: production[0])
+    productions.insert(0, (f'S -> {nonterminals[0]} [1.0]', ('S', ((nonterminals[0], True),), 1.0)))
+
+    text = '\n'.join(rule for rule, production in productions)
+    compiled = CompiledGrammar.from_productions('S', [production for rule, production in productions], probabilistic=True)
+    register_compiled(text, compiled)
+
+    return text, compiled
+
+def _generate_pcfg_meta(terminals, nonterminals, n_rules, prob_terminal, rng) -> str:
 
     assert n_rules >= len(nonterminals), "There must be at least as many rules as nonterminals (n_rules >= len(nonterminals))"
 
@@ -123,7 +291,7 @@ def generate_pcfg(terminals, nonterminals, n_rules=5, prob_terminal=0.5) -> str:
     # so that every nonterminal has at least one rule
     for nonterminal in nonterminals:
         # generate one CONTENT and build the rule like this:
-        random_content = generate_sentence_pcfg(meta_rules, join_char='')
+        random_content = generate_sentence_pcfg(meta_rules, join_char='', rng=rng)
         # replace the first character of the content with the nonterminal
         random_rule = nonterminal + random_content[1:]
 
@@ -133,7 +301,7 @@ def generate_pcfg(terminals, nonterminals, n_rules=5, prob_terminal=0.5) -> str:
         random_rules.append(random_rule)
 
     while len(random_rules) < n_rules:
-        random_rule = generate_sentence_pcfg(meta_rules, join_char='')
+        random_rule = generate_sentence_pcfg(meta_rules, join_char='', rng=rng)
 
         if random_rule not in random_rules:
             random_rule = random_rule.replace('#', '"')
@@ -168,14 +336,14 @@ def generate_pcfg(terminals, nonterminals, n_rules=5, prob_terminal=0.5) -> str:
             # the next random number is between 0 and 1
             # we use this to assign a probability to the rule
             if j < len(rules) - 1:
-                prob = (random.random() * (1 - prob_sum)) / 2.0    # divide by 2 to make the probabilities more equally distributed
+                prob = (rng.random() * (1 - prob_sum)) / 2.0    # divide by 2 to make the probabilities more equally distributed
             else:
                 # the last rule gets the rest of the probability
                 prob = 1 - prob_sum
             
             prob_sum += prob
 
-            rule = rule.replace('+', str(prob))
+            rule = rule.replace('+', format_probability(prob))
             finished_rules.append(rule)
         
         finished_nonterminals.append(nonterminal)
@@ -193,8 +361,25 @@ def generate_pcfg(terminals, nonterminals, n_rules=5, prob_terminal=0.5) -> str:
     return finished_rules
 
 # checks if a sentence is in the grammar
-def sentence_in_pcfg(sentence: str, grammar: str | nltk.CFG) -> bool:
-    
+def sentence_in_pcfg(sentence: str, grammar: str | nltk.CFG | CompiledGrammar, parser='auto') -> bool:
+    """
+    Check if the grammar generates the sentence, every character of the sentence is a terminal.
+    - parser (`str`): `'cyk'` uses the bitset CYK recognizer, which needs a grammar in Chomsky normal form (unary rules are fine),
+    `'earley'` uses nltk's `EarleyChartParser`. `'auto'` uses CYK whenever the grammar allows it.
+    The CYK recognizer is built once per grammar and cached.
+    """
+
+    if parser not in ('auto', 'cyk', 'earley'):
+        raise ValueError(f"Unknown parser '{parser}', choose one of ['auto', 'cyk', 'earley'].")
+
+    if parser != 'earley':
+        compiled = compile_grammar(grammar, probabilistic=True)
+        if parser == 'cyk' or CYKRecognizer.supports(compiled):
+            return get_cyk_recognizer(compiled).recognize(list(sentence))
+
+    # the content hash of the grammar, to record the chart size under
+    key = compile_grammar(grammar, probabilistic=True).content_hash if instrumentation.enabled else None
+
     # Ensure the grammar is an CFG object
     grammar = to_pcfg(grammar)
     
@@ -202,37 +387,285 @@ def sentence_in_pcfg(sentence: str, grammar: str | nltk.CFG) -> bool:
     tokens = list(sentence)
     
     # Initialize the parser with the given grammar
-    parser = nltk.parse.EarleyChartParser(grammar)
+    from nltk.parse import EarleyChartParser
+    parser = EarleyChartParser(grammar)
     
     # Attempt to parse the tokenized sentence
     try:
-        # Generate all possible parse trees for the sentence
-        for parse in parser.parse(tokens):
-            # If at least one parse tree is found, the sentence can be generated by the grammar
-            return True
+        chart = parser.chart_parse(tokens)
     except ValueError as e:
         # Catch and handle the case where the sentence contains tokens not in the grammar
         return False
+
+    if key is not None:
+        instrumentation.record(key, 'recognitions')
+        instrumentation.record(key, 'chart_columns', len(tokens) + 1)
+        instrumentation.record(key, 'chart_items', chart.num_edges())
+    
+    # The sentence can be generated by the grammar if there is a complete edge for the start symbol that spans it.
+    # Extracting the parse trees is not needed, and nltk refuses to do so for highly ambiguous sentences
+    for edge in chart.select(start=0, end=len(tokens), is_complete=True, lhs=grammar.start()):
+        return True
     
-    # If no parse trees are found, the sentence cannot be generated by the grammar
+    # If no such edge is found, the sentence cannot be generated by the grammar
     return False
 
+# checks many sentences at once, sharing the chart of common prefixes
+def sentences_in_pcfg(sentences, grammar: str | nltk.PCFG | CompiledGrammar, parser='auto', chunk_size=65536) -> np.ndarray:
+    """
+    Check for every sentence if the grammar generates it, like `sentence_in_pcfg`, and return a boolean NumPy array.\\
+    The sentences are checked in sorted order, so the chart columns of a prefix shared by several sentences are only computed once.
+    `sentences` can be a list or a streaming iterator, it is read `chunk_size` sentences at a time.
+    - parser (`str`): `'cyk'` uses the bitset CYK recognizer, which needs a grammar in Chomsky normal form (unary rules are fine),
+    `'earley'` uses an Earley recognizer on the compiled grammar. `'auto'` uses CYK whenever the grammar allows it.
+    Grammars with empty productions are checked one sentence at a time with nltk.
+    """
+
+    if parser not in ('auto', 'cyk', 'earley'):
+        raise ValueError(f"Unknown parser '{parser}', choose one of ['auto', 'cyk', 'earley'].")
+
+    # Ensure the grammar is compiled, strings are only parsed once
+    compiled = compile_grammar(grammar, probabilistic=True)
+
+    if parser == 'cyk' or (parser == 'auto' and CYKRecognizer.supports(compiled)):
+        recognizer = get_cyk_recognizer(compiled)
+    elif EarleyRecognizer.supports(compiled):
+        recognizer = get_earley_recognizer(compiled)
+    else:
+        return np.fromiter((sentence_in_pcfg(sentence, compiled, parser='earley') for sentence in sentences), dtype=np.bool_)
+
+    return recognize_many(recognizer, sentences, chunk_size)
+
 # a generator that generates all valid strings for a given grammar until a given length
-def generate_sentences_pcfg(terminals, grammar: str | nltk.CFG, max_length=5):
-    
-    # Ensure the grammar is an CFG object
-    grammar = to_pcfg(grammar)
+def generate_sentences_pcfg(terminals, grammar: str | nltk.CFG | CompiledGrammar, max_length=5):
+    """
+    Yield all strings of the grammar made of `terminals` with at most `max_length` characters, shortest first.\\
+    The strings are built from the grammar with dynamic programming instead of parsing every combination of terminals,
+    they come in the same order as before: by length, then in `itertools.product(terminals)` order.
+    """
 
-    # Iterate over all lengths of strings
-    for length in range(1, max_length + 1):
-        # Generate all combinations with repetition of the current length
-        for word in itertools.product(terminals, repeat=length):
-            # Join the characters to form a string
-            sentence = ''.join(word)
+    # Ensure the grammar is compiled, strings are only parsed once
+    grammar = compile_grammar(grammar, probabilistic=True)
 
-            # Check if the sentence is in the grammar
-            in_grammar = sentence_in_pcfg(sentence, grammar)
+    for word in enumerate_language(grammar, max_length, terminals=list(terminals)):
+        # Join the characters to form a string
+        yield ''.join(word)
+
+class SentenceBatch(NamedTuple):
+    """
+    A ragged array of sentences: sentence `i` is `tokens[offsets[i]:offsets[i+1]]`.\\
+    Tokens are indices into `terminals`. `derivations` has the derivation of every sentence if it was recorded.
+    """
+    tokens: np.ndarray
+    offsets: np.ndarray
+    terminals: list[str]
+    derivations: DerivationBatch | None = None
+
+    def sentence(self, i: int, join_char=' ') -> str:
+        """Decode sentence `i` into a string."""
+        return join_char.join(self.terminals[t] for t in self.tokens[self.offsets[i]:self.offsets[i+1]])
+
+    def to_strings(self, join_char=' ') -> list[str]:
+        """Decode all sentences into strings, like `generate_sentence_pcfg` would return them."""
+        terminals = np.array(self.terminals, dtype=object)
+        words = terminals[self.tokens].tolist()
+        return [join_char.join(words[self.offsets[i]:self.offsets[i+1]]) for i in range(len(self.offsets) - 1)]
+
+# generate many sentences at once, advancing all derivations in lockstep
+def generate_sentences_batch(grammar: str | nltk.PCFG | CompiledGrammar, n: int, seed=None, batch_size=65536,
+                             derivations: bool = False) -> SentenceBatch:
+    """
+    Generate `n` random sentences from the given PCFG grammar with NumPy.\\
+    The derivation trees are grown one level per step: all open nonterminals of all sentences draw their productions
+    in one vectorized call. Only the open nonterminals are carried from step to step, the terminals are put into place
+    once all trees are complete. Since the grammar is context-free this gives the same distribution as
+    `generate_sentence_pcfg`, including the retries of derivations that need more than 10000 expansions.
+    - n (`int`): the number of sentences
+    - seed: seed for `numpy.random.default_rng`
+    - batch_size (`int`): how many derivations are grown together, this bounds the memory use
+    - derivations (`bool`): also return the derivation of every sentence, as a `DerivationBatch`.
+    The trees are grown anyway, recording them only sorts their nodes into preorder.
+    """
+
+    # same limits as generate_sentence_pcfg
+    max_tries = 5
+    max_iterations = 10000
 
-            # If the sentence is in the grammar, yield it
-            if in_grammar:
-                yield sentence
\ No newline at end of file
+    grammar = compile_grammar(grammar, probabilistic=True)
+    rng = np.random.default_rng(seed)
+
+    n_nonterminals = len(grammar.nonterminals)
+    prod_offsets = np.array(grammar.prod_offsets, dtype=np.int64)
+    rhs = np.array(grammar.rhs, dtype=np.int64)
+    rhs_offsets = np.array(grammar.rhs_offsets, dtype=np.int64)
+    rhs_len = np.diff(rhs_offsets)
+
+    # the productions of nonterminal A get the keys A + (cumulative probability), so that a single
+    # searchsorted for A + u with u ~ U[0, 1) picks a production of A for every nonterminal at once
+    lhs = np.array(grammar.lhs, dtype=np.int64)
+    cum_weights = np.array(grammar.cum_weights, dtype=np.float64)
+    totals = np.ones(n_nonterminals)
+    has_productions = prod_offsets[1:] > prod_offsets[:-1]
+    totals[has_productions] = cum_weights[prod_offsets[1:][has_productions] - 1]
+    keys = lhs + cum_weights / totals[lhs] if len(lhs) else np.zeros(0)
+
+    token_chunks, length_chunks = [], []
+    production_chunks, span_chunks, node_count_chunks = [], [], []
+
+    for batch_start in range(0, n, batch_size):
+        m = min(n, batch_start + batch_size) - batch_start
+
+        # every nonterminal node of the derivation trees gets an id, in order of creation
+        node_owner = [np.arange(m)]
+        node_attempt = [np.zeros(m, dtype=np.int64)]
+        n_nodes = m
+        root = np.arange(m)
+
+        # the open nonterminals
+        frontier_symbol = np.full(m, grammar.start, dtype=np.int64)
+        frontier_node = np.arange(m)
+        frontier_owner = np.arange(m)
+
+        tries = np.zeros(m, dtype=np.int64)
+        expansions = np.zeros(m, dtype=np.int64)
+
+        # per step: the expanded nodes, and for their children the index of the parent, the symbol and the node id
+        levels = []
+
+        while len(frontier_symbol):
+            if not has_productions[frontier_symbol].all():
+                symbol = frontier_symbol[~has_productions[frontier_symbol]][0]
+                raise ValueError(f"The nonterminal {grammar.nonterminals[symbol]} has no productions.")
+
+            expansions += np.bincount(frontier_owner, minlength=m)
+
+            # draw a production for every open nonterminal
+            productions = np.searchsorted(keys, frontier_symbol + rng.random(len(frontier_symbol)), side='right')
+            productions = np.minimum(productions, prod_offsets[frontier_symbol + 1] - 1)
+
+            # the children of the expanded nodes
+            counts = rhs_len[productions]
+            child_parent = np.repeat(np.arange(len(productions)), counts)
+            position = np.arange(len(child_parent)) - np.repeat(np.cumsum(counts) - counts, counts)
+            child_symbol = rhs[rhs_offsets[productions][child_parent] + position]
+
+            is_nonterminal = child_symbol >= 0
+            child_node = np.full(len(child_symbol), -1, dtype=np.int64)
+            child_node[is_nonterminal] = np.arange(n_nodes, n_nodes + int(is_nonterminal.sum()))
+            n_nodes += int(is_nonterminal.sum())
+
+            levels.append((frontier_node, productions, child_parent, child_symbol, child_node))
+
+            frontier_symbol = child_symbol[is_nonterminal]
+            frontier_node = child_node[is_nonterminal]
+            frontier_owner = frontier_owner[child_parent][is_nonterminal]
+            node_owner.append(frontier_owner)
+            node_attempt.append(tries[frontier_owner])
+
+            # each open nonterminal needs at least one more expansion,
+            # a derivation is aborted as soon as it can't finish within the iteration limit
+            aborted = expansions + np.bincount(frontier_owner, minlength=m) > max_iterations + 1
+            if aborted.any():
+                tries[aborted] += 1
+                if (tries >= max_tries).any():
+                    raise ValueError("The grammar is too complex to generate a valid sentence.")
+
+                # aborted derivations start again from the start symbol
+                restart = np.flatnonzero(aborted)
+                keep = ~aborted[frontier_owner]
+                root[restart] = np.arange(n_nodes, n_nodes + len(restart))
+                n_nodes += len(restart)
+                expansions[restart] = 0
+
+                frontier_symbol = np.concatenate([frontier_symbol[keep], np.full(len(restart), grammar.start, dtype=np.int64)])
+                frontier_node = np.concatenate([frontier_node[keep], root[restart]])
+                frontier_owner = np.concatenate([frontier_owner[keep], restart])
+                node_owner.append(restart)
+                node_attempt.append(tries[restart])
+
+        node_owner = np.concatenate(node_owner)
+        node_attempt = np.concatenate(node_attempt)
+
+        # bottom-up: the number of terminals below every node
+        length = np.zeros(n_nodes, dtype=np.int64)
+        child_lengths = []
+        for nodes, _, child_parent, child_symbol, child_node in reversed(levels):
+            child_length = np.where(child_node >= 0, length[child_node], 1)
+            length[nodes] = np.bincount(child_parent, weights=child_length, minlength=len(nodes)).astype(np.int64)
+            child_lengths.append(child_length)
+        child_lengths.reverse()
+
+        # top-down: the position of every node in the output, the sentences are stored back to back
+        sentence_lengths = length[root]
+        start = np.zeros(n_nodes, dtype=np.int64)
+        start[root] = np.cumsum(sentence_lengths) - sentence_lengths
+        tokens = np.zeros(int(sentence_lengths.sum()), dtype=np.int32)
+
+        for (nodes, _, child_parent, child_symbol, child_node), child_length in zip(levels, child_lengths):
+            # position of every child within its parent
+            before = np.cumsum(child_length) - child_length
+            first_child = np.concatenate([[0], np.cumsum(np.bincount(child_parent, minlength=len(nodes)))])[:-1]
+            child_start = start[nodes][child_parent] + before - np.concatenate([before, [0]])[first_child][child_parent]
+
+            # only the last attempt of every derivation ends up in the output
+            final = node_attempt[nodes][child_parent] == tries[node_owner[nodes][child_parent]]
+            is_nonterminal = child_node >= 0
+            start[child_node[is_nonterminal & final]] = child_start[is_nonterminal & final]
+            is_terminal = ~is_nonterminal & final
+            tokens[child_start[is_terminal]] = ~child_symbol[is_terminal]
+
+        token_chunks.append(tokens)
+        length_chunks.append(sentence_lengths)
+
+        if derivations:
+            node_production = np.full(n_nodes, -1, dtype=np.int64)
+            for nodes, productions, *_ in levels:
+                node_production[nodes] = productions
+
+            # bottom-up: the number of nonterminal nodes in every subtree
+            size = np.ones(n_nodes, dtype=np.int64)
+            child_sizes = []
+            for nodes, _, child_parent, child_symbol, child_node in reversed(levels):
+                child_size = np.where(child_node >= 0, size[child_node], 0)
+                size[nodes] = 1 + np.bincount(child_parent, weights=child_size, minlength=len(nodes)).astype(np.int64)
+                child_sizes.append(child_size)
+            child_sizes.reverse()
+
+            # top-down: the preorder rank of every node, one past its parent and after the subtrees of its earlier siblings.
+            # Unlike the positions, this also orders the subtrees that yield no terminals
+            rank = np.zeros(n_nodes, dtype=np.int64)
+            rank[root] = np.cumsum(size[root]) - size[root]
+            for (nodes, _, child_parent, child_symbol, child_node), child_size in zip(levels, child_sizes):
+                before = np.cumsum(child_size) - child_size
+                first_child = np.concatenate([[0], np.cumsum(np.bincount(child_parent, minlength=len(nodes)))])[:-1]
+                child_rank = rank[nodes][child_parent] + 1 + before - np.concatenate([before, [0]])[first_child][child_parent]
+                is_nonterminal = child_node >= 0
+                rank[child_node[is_nonterminal]] = child_rank[is_nonterminal]
+
+            # only the nodes of the last attempts are in the derivations, their ranks are 0..(number of nodes - 1)
+            final = np.flatnonzero(node_attempt == tries[node_owner])
+            order = np.empty(len(final), dtype=np.int64)
+            order[rank[final]] = final
+
+            sentence_start = start[root][node_owner[order]]
+            production_chunks.append(node_production[order])
+            span_chunks.append(np.stack([start[order] - sentence_start, start[order] - sentence_start + length[order]], axis=1))
+            node_count_chunks.append(np.bincount(node_owner[order], minlength=m))
+
+    tokens = np.concatenate(token_chunks) if token_chunks else np.zeros(0, dtype=np.int32)
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    if length_chunks:
+        np.cumsum(np.concatenate(length_chunks), out=offsets[1:])
+
+    batch_derivations = None
+    if derivations:
+        node_offsets = np.zeros(n + 1, dtype=np.int64)
+        if node_count_chunks:
+            np.cumsum(np.concatenate(node_count_chunks), out=node_offsets[1:])
+        batch_derivations = DerivationBatch(
+            np.concatenate(production_chunks).astype(np.int32) if production_chunks else np.zeros(0, dtype=np.int32),
+            np.concatenate(span_chunks).astype(np.int32) if span_chunks else np.zeros((0, 2), dtype=np.int32),
+            node_offsets,
+        )
+
+    return SentenceBatch(tokens, offsets, grammar.terminals, batch_derivations)
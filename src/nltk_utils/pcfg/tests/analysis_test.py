@@ -0,0 +1,64 @@
+import math
+import random
+
+import numpy as np
+
+from nltk_utils.pcfg.analysis import analyze_pcfg, can_sample, can_sample_many, length_distribution, termination_probabilities
+from nltk_utils.pcfg.generate import generate_pcfg
+from nltk_utils.utils import generate_nonterminals, generate_terminals
+
+def binary_grammar(p):
+    return f'S -> S S [{p}] | "a" [{1 - p}]'
+
+def test_termination_probability_of_binary_branching():
+    # the least solution of x = p x^2 + (1 - p)
+    for p in [0.2, 0.4, 0.6, 0.8]:
+        assert math.isclose(termination_probabilities(binary_grammar(p))[0], min(1.0, (1 - p) / p), rel_tol=1e-9)
+
+def test_length_distribution_is_catalan():
+    # a sentence of n terminals has Catalan(n-1) derivations with n-1 binary and n terminal rules
+    p = 0.3
+    distribution = length_distribution(binary_grammar(p), 10)
+    assert distribution[0] == 0.0
+    for n in range(1, 11):
+        expected = math.comb(2 * (n - 1), n - 1) / n * p ** (n - 1) * (1 - p) ** n
+        assert math.isclose(distribution[n], expected, rel_tol=1e-9)
+
+def test_expectations_and_screening():
+    # E[L] = (1 - p) + 2 p E[L] for the binary grammar, unary rules and longer right-hand sides are handled as well
+    stats = analyze_pcfg(binary_grammar(0.3))
+    assert stats.criticality == 'subcritical'
+    assert math.isclose(stats.expected_length, 0.7 / (1 - 0.6))
+    assert can_sample(binary_grammar(0.3))
+
+    grammar = 'S -> A [1.0]\nA -> "a" "b" A [0.5] | B [0.5]\nB -> "c" [1.0]'
+    assert math.isclose(analyze_pcfg(grammar).expected_length, 3.0)
+    assert math.isclose(length_distribution(grammar, 5)[3], 0.25)
+
+    stats = analyze_pcfg(binary_grammar(0.7))
+    assert stats.criticality == 'supercritical' and stats.expected_length == math.inf
+    assert not can_sample(binary_grammar(0.7))
+
+def test_spectral_radius_is_computed_once(monkeypatch):
+    calls = []
+    eigvals = np.linalg.eigvals
+    monkeypatch.setattr(np.linalg, 'eigvals', lambda matrix: calls.append(matrix) or eigvals(matrix))
+    stats = analyze_pcfg('S -> S S [0.3] | "a" [0.4] | "b" [0.3]')
+    assert len(calls) == 1
+    assert stats.criticality == 'subcritical'
+
+def test_can_sample_many_matches_can_sample():
+    # grammars of different sizes in one batch, with unreachable and unproductive nonterminals and unary cycles
+    rng = random.Random(0)
+    grammars = [binary_grammar(p) for p in [0.2, 0.45, 0.5, 0.55, 0.8]]
+    grammars += ['S -> A [1.0]\nA -> A [0.5] | "a" [0.5]\nB -> B [1.0]', 'S -> A [1.0]\nA -> B [1.0]\nB -> A [1.0]']
+    for _ in range(200):
+        n_nonterminals = rng.randint(1, 8)
+        grammars.append(generate_pcfg(generate_terminals(3), generate_nonterminals(n_nonterminals), rng.randint(n_nonterminals, 3 * n_nonterminals),
+                                      rng.choice([0.3, 0.5]), method='direct', rng=rng))
+
+    expected = [can_sample(grammar) for grammar in grammars]
+    assert 0 < sum(expected) < len(grammars)
+    for start in range(0, len(grammars), 16):
+        assert can_sample_many(grammars[start:start + 16]).tolist() == expected[start:start + 16]
+    assert can_sample_many([]).tolist() == []
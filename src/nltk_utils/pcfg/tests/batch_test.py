@@ -0,0 +1,48 @@
+import math
+import random
+from collections import Counter
+
+import numpy as np
+from nltk_utils.pcfg.generate import generate_sentence_pcfg, generate_sentences_batch
+
+# every production starts with its own terminal, so terminal counts are production counts
+grammar_string = '\n'.join([
+    'S -> A [1.0]',
+    'A -> "a" [0.4] | "b" A B [0.35] | "c" B [0.25]',
+    'B -> "d" [0.55] | "e" A [0.45]',
+])
+
+def chi_square_p_value(counts_a: Counter, counts_b: Counter) -> float:
+    """Two-sample chi-square test for equal sample sizes, p-value by the Wilson-Hilferty approximation."""
+    categories = set(counts_a) | set(counts_b)
+    statistic = sum((counts_a[c] - counts_b[c]) ** 2 / (counts_a[c] + counts_b[c]) for c in categories)
+    k = len(categories) - 1
+    z = ((statistic / k) ** (1 / 3) - (1 - 2 / (9 * k))) / math.sqrt(2 / (9 * k))
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+def test_batch_matches_generate_sentence_pcfg():
+    n = 20000
+
+    random.seed(0)
+    expected = [generate_sentence_pcfg(grammar_string, '') for _ in range(n)]
+    batch = generate_sentences_batch(grammar_string, n, seed=0)
+    sentences = batch.to_strings('')
+
+    assert len(sentences) == n
+    assert np.all(np.diff(batch.offsets) >= 1)
+
+    # sentence lengths, long sentences are pooled
+    lengths_expected = Counter(min(len(s), 15) for s in expected)
+    lengths_batch = Counter(min(len(s), 15) for s in sentences)
+    assert chi_square_p_value(lengths_expected, lengths_batch) > 1e-3
+
+    # production usage
+    usage_expected = Counter(''.join(expected))
+    usage_batch = Counter(''.join(sentences))
+    assert chi_square_p_value(usage_expected, usage_batch) > 1e-3
+
+def test_batch_is_deterministic():
+    a = generate_sentences_batch(grammar_string, 1000, seed=42, batch_size=100)
+    b = generate_sentences_batch(grammar_string, 1000, seed=42, batch_size=100)
+    assert np.array_equal(a.tokens, b.tokens) and np.array_equal(a.offsets, b.offsets)
+    assert a.sentence(0, '') == a.to_strings('')[0]
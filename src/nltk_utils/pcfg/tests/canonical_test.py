@@ -0,0 +1,81 @@
+import random
+
+import pytest
+from nltk_utils.canonical import GrammarSet, canonical_form, canonical_hash
+from nltk_utils.datasets import CorpusWriter, generate_documents_pcfg, generate_token_corpus
+from nltk_utils.pcfg.generate import generate_pcfg
+from nltk_utils.store import GrammarCatalog
+from nltk_utils.utils import compile_grammar, generate_nonterminals, generate_terminals
+
+def rename(grammar, rng):
+    """The same grammar with shuffled symbol names and rules."""
+    compiled = compile_grammar(grammar)
+    nonterminals = [f'X{i}' for i in range(len(compiled.nonterminals))]
+    terminals = [f'w{i}' for i in range(len(compiled.terminals))]
+    rng.shuffle(nonterminals)
+    rng.shuffle(terminals)
+    nonterminals[compiled.start] = 'S'
+
+    rules = []
+    for production, rhs in enumerate(compiled.rhs_tuples):
+        symbols = [nonterminals[symbol] if symbol >= 0 else f'"{terminals[~symbol]}"' for symbol in rhs]
+        rules.append(f'{nonterminals[compiled.lhs[production]]} -> {" ".join(symbols)} [{compiled.probs[production]}]')
+    start = [rule for rule in rules if rule.startswith('S ->')]
+    rest = [rule for rule in rules if not rule.startswith('S ->')]
+    rng.shuffle(start)
+    rng.shuffle(rest)
+    return '\n'.join(start + rest)
+
+def test_canonical_hash_is_invariant_to_renaming():
+    rng = random.Random(0)
+    for _ in range(100):
+        n_nonterminals = rng.randint(2, 6)
+        grammar = generate_pcfg(generate_terminals(rng.randint(2, 5)), generate_nonterminals(n_nonterminals),
+                                rng.randint(n_nonterminals, 3 * n_nonterminals), 0.5, method='direct', rng=rng)
+        renamed = rename(grammar, rng)
+        assert canonical_form(renamed) == canonical_form(grammar)
+
+        # the canonical form is a grammar with the same canonical form
+        assert canonical_hash(canonical_form(grammar)) == canonical_hash(grammar)
+
+def test_ties_are_broken_exactly():
+    # A and B can only be told apart by which terminal they produce, refinement alone leaves them tied
+    first = 'S -> A [0.5] | B [0.5]\nA -> "a" [0.5] | A B [0.5]\nB -> "b" [0.5] | B A [0.5]'
+    second = 'S -> B [0.5] | A [0.5]\nA -> "b" [0.5] | A B [0.5]\nB -> "a" [0.5] | B A [0.5]'
+    assert canonical_hash(first) == canonical_hash(second)
+
+    # a different structure with the same symbol colors after refinement
+    third = 'S -> A [0.5] | B [0.5]\nA -> "a" [0.5] | A A [0.5]\nB -> "b" [0.5] | B B [0.5]'
+    assert canonical_hash(first) != canonical_hash(third)
+
+    # many interchangeable nonterminals, the automorphisms keep the search small
+    symmetric = 'S -> ' + ' | '.join(f'A{i}' for i in range(10)) + '\n' + '\n'.join(f'A{i} -> "a{i}" | "b{i}"' for i in range(10))
+    assert canonical_form(symmetric).count('\n') == 29
+
+def test_probabilities_matter():
+    assert canonical_hash('S -> A [1.0]\nA -> "a" [0.4] | A A [0.6]') != canonical_hash('S -> A [1.0]\nA -> "a" [0.6] | A A [0.4]')
+
+def test_skip_seen_grammars(tmp_path):
+    grammar = 'S -> A [1.0]\nA -> "a" [0.6] | A "b" [0.4]'
+    seen = GrammarSet(str(tmp_path / 'seen.txt'))
+    assert generate_token_corpus(grammar, str(tmp_path / 'first'), seed=0, seen=seen) is not None
+    assert generate_token_corpus(rename(grammar, random.Random(1)), str(tmp_path / 'second'), seed=0, seen=seen) is None
+    assert grammar in GrammarSet(str(tmp_path / 'seen.txt'))
+
+    # a grammar is only seen once its corpus is written, a run that fails does not count
+    class FailingWriter(CorpusWriter):
+        def write(self, document):
+            raise RuntimeError('disk full')
+
+    other = 'S -> A [1.0]\nA -> "a" [0.5] | A "b" [0.5]'
+    with pytest.raises(RuntimeError):
+        generate_documents_pcfg(other, n_documents=3, writer=FailingWriter(str(tmp_path / 'failed')), seen=seen)
+    assert other not in seen
+    with CorpusWriter(str(tmp_path / 'written')) as writer:
+        generate_documents_pcfg(other, n_documents=3, writer=writer, seen=seen)
+    assert other in seen and writer.n_records == 3
+
+    with GrammarCatalog(str(tmp_path / 'catalog.sqlite')) as catalog:
+        content_hash = catalog.add(grammar)
+        assert catalog.find_isomorphic(rename(grammar, random.Random(2))) == content_hash
+        assert catalog.find_isomorphic('S -> A [1.0]\nA -> "a" [0.5] | A "b" [0.5]') is None
@@ -0,0 +1,53 @@
+import os
+
+import pytest
+from nltk_utils.datasets import CorpusWriter, generate_documents_pcfg
+
+grammar_string = '\n'.join([
+    'S -> A B [1.0]',
+    'A -> "a" [0.6] | A B [0.4]',
+    'B -> "b" [0.5] | "c" [0.5]',
+])
+
+class CrashingWriter(CorpusWriter):
+    """A writer that dies after a number of records, after flushing them to disk."""
+
+    def __init__(self, *args, crash_after: int, **kwargs):
+        super().__init__(*args, buffer_size=1, **kwargs)
+        self.crash_after = crash_after
+
+    def write(self, document):
+        if self.n_records == self.crash_after:
+            raise RuntimeError('crash')
+        super().write(document)
+
+def read_files(directory):
+    return {name: open(os.path.join(directory, name), 'rb').read() for name in sorted(os.listdir(directory))}
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+def test_resumed_run_is_identical(tmp_path, compression):
+    args = dict(n_documents=95, n_sentences=3, seed=7, shard_size=10)
+    writer_args = dict(prefix='corpus', compression=compression, max_shard_bytes=600)
+
+    with CorpusWriter(str(tmp_path / 'full'), **writer_args) as writer:
+        generate_documents_pcfg(grammar_string, **args, writer=writer, checkpoint=str(tmp_path / 'full.json'))
+
+    # crash in the middle of a shard, twice, then finish
+    checkpoint = str(tmp_path / 'resumed.json')
+    for crash_after in (23, 61):
+        with pytest.raises(RuntimeError):
+            writer = CrashingWriter(str(tmp_path / 'resumed'), **writer_args, crash_after=crash_after)
+            generate_documents_pcfg(grammar_string, **args, writer=writer, checkpoint=checkpoint)
+    with CorpusWriter(str(tmp_path / 'resumed'), **writer_args) as writer:
+        generate_documents_pcfg(grammar_string, **args, writer=writer, checkpoint=checkpoint)
+
+    assert read_files(tmp_path / 'full') == read_files(tmp_path / 'resumed')
+    assert writer.n_records == 95
+
+def test_checkpoint_rejects_other_parameters(tmp_path):
+    checkpoint = str(tmp_path / 'job.json')
+    with CorpusWriter(str(tmp_path / 'corpus')) as writer:
+        generate_documents_pcfg(grammar_string, n_documents=10, seed=1, writer=writer, checkpoint=checkpoint)
+
+    with pytest.raises(ValueError):
+        generate_documents_pcfg(grammar_string, n_documents=20, seed=1, writer=CorpusWriter(str(tmp_path / 'corpus')), checkpoint=checkpoint)
@@ -0,0 +1,74 @@
+from collections import OrderedDict
+
+import nltk
+import pytest
+
+from nltk_utils import utils
+from nltk_utils.utils import CompiledGrammar, compile_grammar
+
+PCFG_TEXT = 'S -> A [1.0]\nA -> "a" [0.4] | A "b" A [0.6]'
+CFG_TEXT = 'S -> A B | "c"\nA -> "a"\nB -> "b" S'
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = OrderedDict()
+    monkeypatch.setattr(utils, '_compiled_cache', cache)
+    return cache
+
+def test_cache_hits_return_the_same_grammar(cache):
+    compiled = compile_grammar(PCFG_TEXT)
+    assert compile_grammar(PCFG_TEXT) is compiled
+    assert compile_grammar(PCFG_TEXT, probabilistic=True) is compiled
+    assert list(cache) == ['pcfg:' + utils.grammar_hash(PCFG_TEXT)]
+
+    # equal nltk objects share a key, although they are different objects
+    first, second = nltk.PCFG.fromstring(PCFG_TEXT), nltk.PCFG.fromstring(PCFG_TEXT)
+    assert first is not second
+    assert compile_grammar(first) is compile_grammar(second)
+    assert len(cache) == 2
+
+def test_cache_is_bounded(cache, monkeypatch):
+    monkeypatch.setattr(utils, 'COMPILED_CACHE_SIZE', 2)
+    texts = [f'S -> "{terminal}"' for terminal in 'abc']
+    compiled = [compile_grammar(text) for text in texts[:2]]
+
+    # a hit moves the grammar to the end, so the least recently used one is evicted
+    assert compile_grammar(texts[0]) is compiled[0]
+    compile_grammar(texts[2])
+    assert list(cache) == ['cfg:' + utils.grammar_hash(text) for text in (texts[0], texts[2])]
+    assert compile_grammar(texts[1]) is not compiled[1]
+
+def test_cache_keys_tell_pcfgs_and_cfgs_apart(cache):
+    compiled = compile_grammar(PCFG_TEXT, probabilistic=True)
+    assert compiled.is_probabilistic
+    assert list(cache) == ['pcfg:' + utils.grammar_hash(PCFG_TEXT)]
+
+    # the cached PCFG is not returned for the same text read as a CFG
+    with pytest.raises(ValueError):
+        compile_grammar(PCFG_TEXT, probabilistic=False)
+
+    assert not compile_grammar(CFG_TEXT).is_probabilistic
+    assert 'cfg:' + utils.grammar_hash(CFG_TEXT) in cache
+
+@pytest.mark.parametrize('text, probabilistic', [
+    (PCFG_TEXT, True),
+    (CFG_TEXT, False),
+    ('S -> "[" S "]" | "a"', False),
+    ("S -> '[' [0.5] | ']' [0.5]", True),
+    ('# [comment]\nS -> "a"', False),
+])
+def test_probabilities_are_detected(cache, text, probabilistic):
+    assert compile_grammar(text).is_probabilistic == probabilistic
+
+@pytest.mark.parametrize('text, probabilistic', [(PCFG_TEXT, True), (CFG_TEXT, False)])
+def test_inputs_give_the_same_grammar(cache, text, probabilistic):
+    compiled = compile_grammar(text)
+    assert isinstance(compiled, CompiledGrammar)
+    assert compile_grammar(compiled) is compiled
+    assert compile_grammar(text.split('\n')) is compiled
+
+    grammar = nltk.PCFG.fromstring(text) if probabilistic else nltk.CFG.fromstring(text)
+    from_nltk = compile_grammar(grammar)
+    assert from_nltk.content_hash == compiled.content_hash
+    assert (from_nltk.nonterminals, from_nltk.terminals, from_nltk.start, from_nltk.lhs, from_nltk.rhs, from_nltk.probs) == \
+           (compiled.nonterminals, compiled.terminals, compiled.start, compiled.lhs, compiled.rhs, compiled.probs)
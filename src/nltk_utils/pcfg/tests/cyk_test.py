@@ -0,0 +1,63 @@
+import random
+
+from nltk_utils.cfg.generate import generate_random_grammar, sentence_in_grammar, sentences_in_grammar
+from nltk_utils.pcfg.generate import generate_pcfg, generate_sentence_pcfg, sentence_in_pcfg, sentences_in_pcfg
+from nltk_utils.recognizers import CYKRecognizer
+from nltk_utils.utils import compile_grammar, generate_nonterminals, generate_terminals
+
+def test_cyk_agrees_with_earley():
+    rng = random.Random(0)
+    terminals = generate_terminals(4)
+
+    for seed in range(40):
+        random.seed(seed)
+        grammar = compile_grammar(generate_pcfg(terminals, generate_nonterminals(4), n_rules=8, prob_terminal=0.6))
+
+        candidates = [''.join(rng.choice(terminals) for _ in range(rng.randint(1, 7))) for _ in range(20)]
+        for _ in range(10):
+            try:
+                candidates.append(generate_sentence_pcfg(grammar, '', engine='stack'))
+            except ValueError:
+                pass
+
+        for sentence in candidates:
+            if len(sentence) > 12:
+                continue
+            assert sentence_in_pcfg(sentence, grammar, parser='cyk') == sentence_in_pcfg(sentence, grammar, parser='earley'), (grammar, sentence)
+
+def test_cyk_rejects_unknown_tokens():
+    grammar = 'S -> A [1.0]\nA -> A A [0.5] | "a" [0.5]'
+    assert sentence_in_pcfg('aaa', grammar, parser='cyk')
+    assert not sentence_in_pcfg('aab', grammar, parser='cyk')
+    assert not sentence_in_pcfg('', grammar, parser='cyk')
+
+def test_batch_membership_agrees_with_single_sentences():
+    rng = random.Random(1)
+    terminals = generate_terminals(3)
+
+    for seed in range(20):
+        random.seed(seed)
+        pcfg = compile_grammar(generate_pcfg(terminals, generate_nonterminals(4), n_rules=8, prob_terminal=0.6))
+        cfg = compile_grammar(generate_random_grammar(terminals, generate_nonterminals(4), n_rules=8), probabilistic=False)
+
+        # many shared prefixes, duplicates and the empty sentence
+        candidates = [''.join(rng.choice(terminals) for _ in range(rng.randint(0, 8))) for _ in range(80)]
+
+        expected = [sentence_in_pcfg(sentence, pcfg, parser='earley') for sentence in candidates]
+        assert sentences_in_pcfg(candidates, pcfg).tolist() == expected
+        assert sentences_in_pcfg(iter(candidates), pcfg, parser='earley', chunk_size=7).tolist() == expected
+
+        # the random CFGs are not in Chomsky normal form
+        expected = [sentence_in_grammar(sentence, cfg, parser='earley') for sentence in candidates]
+        assert sentences_in_grammar(iter(candidates), cfg, chunk_size=7).tolist() == expected
+
+def test_cyk_memo_is_bounded():
+    grammar = compile_grammar('S -> A [1.0]\nA -> A B [0.3] | B A [0.2] | "a" [0.5]\nB -> A A [0.4] | "b" [0.6]')
+    unbounded, bounded = CYKRecognizer(grammar), CYKRecognizer(grammar, max_combined=2)
+
+    rng = random.Random(0)
+    for _ in range(200):
+        tokens = [rng.choice('ab') for _ in range(rng.randint(1, 9))]
+        assert bounded.recognize(tokens) == unbounded.recognize(tokens)
+        assert len(bounded._combined) <= 2
+    assert len(unbounded._combined) > 2
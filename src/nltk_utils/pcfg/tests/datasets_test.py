@@ -0,0 +1,92 @@
+import gzip
+import json
+import lzma
+import os
+
+import numpy as np
+import pytest
+from nltk_utils.datasets import CorpusWriter, generate_documents_pcfg, generate_token_corpus, save_documents
+from nltk_utils.pcfg.generate import generate_sentences_batch
+from nltk_utils.utils import compile_grammar
+
+grammar_string = '\n'.join([
+    'S -> A B [1.0]',
+    'A -> "a" [0.6] | A B [0.4]',
+    'B -> "b" [0.5] | "c" [0.5]',
+])
+
+def read_files(directory):
+    return {name: open(os.path.join(directory, name), 'rb').read() for name in sorted(os.listdir(directory))}
+
+@pytest.mark.parametrize('use_writer', [True, False])
+def test_documents_do_not_depend_on_workers(tmp_path, monkeypatch, use_writer):
+    # more shards than the window of submitted shards, so shards are submitted while others are written
+    args = dict(n_documents=60, n_sentences=3, seed=11, shard_size=4)
+
+    for n_workers in (1, 2):
+        directory = tmp_path / str(n_workers)
+        directory.mkdir()
+        monkeypatch.chdir(directory)
+        if use_writer:
+            with CorpusWriter(str(directory / 'documents')) as writer:
+                generate_documents_pcfg(grammar_string, **args, n_workers=n_workers, writer=writer)
+        else:
+            generate_documents_pcfg(grammar_string, **args, n_workers=n_workers)
+
+    files = read_files(tmp_path / '1' / 'documents')
+    assert files == read_files(tmp_path / '2' / 'documents')
+    assert (writer.n_records if use_writer else len(files)) == 60
+
+def test_token_corpus_decodes_to_the_sentences(tmp_path):
+    grammar = compile_grammar('S -> A [1.0]\nA -> "ab" [0.3] | "c" A [0.4] | A "de" A [0.2] | [0.1]')
+    corpus = generate_token_corpus(grammar, str(tmp_path), n_documents=30, n_sentences=4, seed=5)
+
+    # the corpus is a single chunk, so it has the sentences of one batch with the same seed
+    batch = generate_sentences_batch(grammar, 120, seed=np.random.default_rng(5))
+    sentences = [' '.join(grammar.terminals[token] for token in batch.tokens[start:stop])
+                 for start, stop in zip(batch.offsets[:-1], batch.offsets[1:])]
+
+    assert len(corpus) == 30
+    for i, document in enumerate(corpus):
+        assert document[-1] == corpus.eos_id
+        assert corpus.decode(document) == '.'.join(sentences[4 * i:4 * i + 4]) + '.'
+    assert [corpus.decode(corpus.sentence(j)) for j in range(120)] == sentences
+
+    with pytest.raises(ValueError):
+        generate_token_corpus(grammar, str(tmp_path / 'empty'), n_sentences=0)
+
+@pytest.mark.parametrize('format', ['txt', 'jsonl'])
+@pytest.mark.parametrize('compression', [None, 'gzip', 'lzma'])
+def test_corpus_writer_manifest(tmp_path, format, compression):
+    documents = [f'document {i} ' + 'ab' * (i % 7) + '. ü.' for i in range(100)]
+    writer = CorpusWriter(str(tmp_path), prefix='part', format=format, compression=compression, max_shard_bytes=400, buffer_size=64)
+    save_documents(documents, writer=writer)
+    writer.close()
+
+    with open(tmp_path / 'manifest.json') as f:
+        manifest = json.load(f)
+    assert (manifest['format'], manifest['compression'], manifest['records']) == (format, compression, 100)
+    assert len(manifest['shards']) > 1
+
+    opener = {None: open, 'gzip': gzip.open, 'lzma': lzma.open}[compression]
+    records, offset = [], 0
+    for shard in manifest['shards']:
+        path = tmp_path / shard['file']
+        assert os.path.getsize(path) == shard['compressed_bytes']
+        with opener(path, 'rb') as f:
+            data = f.read()
+
+        # every shard starts where the previous one ends, in records and in uncompressed bytes
+        assert (shard['first_record'], shard['offset'], shard['bytes']) == (len(records), offset, len(data))
+        assert shard['bytes'] <= 400
+        lines = data.decode('utf-8').splitlines()
+        assert len(lines) == shard['records']
+        records += lines
+        offset += len(data)
+
+    assert offset == manifest['bytes']
+    if format == 'jsonl':
+        records = [json.loads(record) for record in records]
+        assert [record['id'] for record in records] == list(range(100))
+        records = [record['text'] for record in records]
+    assert records == documents
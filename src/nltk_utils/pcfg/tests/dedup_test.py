@@ -0,0 +1,51 @@
+import random
+
+import pytest
+
+from nltk_utils.datasets import CorpusWriter, generate_documents_pcfg
+from nltk_utils.dedup import BloomFilter, SentenceDeduplicator
+
+# a finite language: 2 * 3 = 6 sentences
+finite_grammar = '\n'.join([
+    'S -> A B [1.0]',
+    'A -> "a" [0.5] | "b" [0.5]',
+    'B -> "c" [0.2] | "d" [0.3] | "e" [0.5]',
+])
+
+def test_bloom_filter_false_positive_rate():
+    rng = random.Random(0)
+    bloom = BloomFilter(capacity=20000, false_positive_rate=0.01)
+    keys = [rng.getrandbits(64) for _ in range(20000)]
+    for key in keys:
+        bloom.add(key)
+
+    assert all(key in bloom for key in keys)
+    false_positives = sum(rng.getrandbits(64) in bloom for _ in range(20000))
+    assert false_positives / 20000 < 0.02
+
+def test_exact_dedup_stops_when_saturated(tmp_path):
+    writer = CorpusWriter(str(tmp_path))
+    dedup = SentenceDeduplicator('exact', window=500)
+    generate_documents_pcfg(finite_grammar, n_documents=10, n_sentences=2, seed=0, shard_size=50, writer=writer, dedup=dedup)
+    writer.close()
+
+    # all 6 sentences are found, then the yield drops to zero
+    assert dedup.saturated
+    assert dedup.n_distinct == 6
+    assert writer.n_records == 3
+
+    with open(tmp_path / 'corpus_00000.txt') as f:
+        sentences = [sentence for line in f for sentence in line.strip().split('.') if sentence]
+    assert len(sentences) == len(set(sentences)) == 6
+
+def test_dedup_drops_partial_document_and_needs_saturation(tmp_path):
+    # 6 distinct sentences fill one document of 4, the 2 that are left over are dropped
+    with CorpusWriter(str(tmp_path / 'partial')) as writer:
+        dedup = generate_documents_pcfg(finite_grammar, n_documents=3, n_sentences=4, seed=0, shard_size=50, writer=writer,
+                                        dedup=SentenceDeduplicator('exact', window=500))
+    assert dedup.saturated and dedup.n_distinct == 6 and writer.n_records == 1
+
+    # a deduplicator that never saturates would sample the finite language forever
+    with pytest.raises(ValueError):
+        generate_documents_pcfg(finite_grammar, n_documents=10, n_sentences=2, seed=0, writer=CorpusWriter(str(tmp_path / 'never')),
+                                dedup=SentenceDeduplicator('exact', min_yield=0))
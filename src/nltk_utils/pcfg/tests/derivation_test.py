@@ -0,0 +1,143 @@
+import random
+from collections import Counter
+
+import nltk
+import numpy as np
+import pytest
+from nltk_utils.datasets import generate_token_corpus
+from nltk_utils.derivation import derivation_spans
+from nltk_utils.pcfg.generate import generate_sentence_pcfg, generate_sentences_batch
+from nltk_utils.utils import compile_grammar
+
+grammar_string = '\n'.join([
+    'S -> A [1.0]',
+    'A -> "a" [0.3] | A B [0.45] | "c" B [0.25]',
+    'B -> "b" [0.6] | A "d" B [0.4]',
+])
+
+def legacy_generate_sentence_pcfg(grammar, join_char=' '):
+    """The original rewrite loop, rescanning the sentence on every step."""
+    grammar = nltk.PCFG.fromstring(grammar)
+    for current_try in range(5):
+        current_iteration = 0
+        sentence = [grammar.start()]
+        while any(nltk.grammar.is_nonterminal(symbol) for symbol in sentence):
+            non_terminals = [i for i, symbol in enumerate(sentence) if nltk.grammar.is_nonterminal(symbol)]
+            nt_index = random.choice(non_terminals)
+            productions = grammar.productions(lhs=sentence[nt_index])
+            production = random.choices(productions, weights=[p.prob() for p in productions])[0]
+            sentence = sentence[:nt_index] + list(production.rhs()) + sentence[nt_index+1:]
+            current_iteration += 1
+            if current_iteration > 10000:
+                break
+        if not any(nltk.grammar.is_nonterminal(symbol) for symbol in sentence):
+            return join_char.join(str(symbol) for symbol in sentence)
+    raise ValueError("The grammar is too complex to generate a valid sentence.")
+
+def test_rewrite_engine_matches_legacy_loop():
+    for seed in range(200):
+        random.seed(seed)
+        expected = legacy_generate_sentence_pcfg(grammar_string)
+        random.seed(seed)
+        assert generate_sentence_pcfg(grammar_string, engine='rewrite') == expected
+
+def test_stack_engine_matches_length_distribution():
+    n = 20000
+    random.seed(0)
+    rewrite = Counter(min(len(generate_sentence_pcfg(grammar_string, '', engine='rewrite')), 8) for _ in range(n))
+    random.seed(1)
+    stack = Counter(min(len(generate_sentence_pcfg(grammar_string, '', engine='stack')), 8) for _ in range(n))
+
+    # two-sample chi-square statistic, 7 degrees of freedom, 0.1% critical value is 24.3
+    chi2 = sum((rewrite[k] - stack[k]) ** 2 / (rewrite[k] + stack[k]) for k in set(rewrite) | set(stack))
+    assert chi2 < 24.3
+
+def test_length_conditioned_sampling_matches_rejection():
+    n = 5000
+    random.seed(2)
+    rejected = Counter()
+    while sum(rejected.values()) < n:
+        sentence = generate_sentence_pcfg(grammar_string, '', engine='stack')
+        if len(sentence) == 4:
+            rejected[sentence] += 1
+    conditioned = Counter(generate_sentence_pcfg(grammar_string, '', length=4) for _ in range(n))
+
+    # there are 4 sentences of length 4, 3 degrees of freedom, 0.1% critical value is 16.3
+    assert set(rejected) == set(conditioned) == {'cadb', 'cbbb', 'aadb', 'abbb'}
+    chi2 = sum((rejected[k] - conditioned[k]) ** 2 / (rejected[k] + conditioned[k]) for k in rejected)
+    assert chi2 < 16.3
+
+    assert all(3 <= len(generate_sentence_pcfg(grammar_string, '', min_length=3, max_length=5)) <= 5 for _ in range(200))
+    for bounds in [{'min_length': 10}, {'max_length': 20}, {'min_length': 10, 'max_length': 20}]:
+        with pytest.raises(ValueError):
+            generate_sentence_pcfg(grammar_string, '', length=3, **bounds)
+
+def tree_spans(tree, start=0):
+    """The spans of the subtrees of an nltk.Tree in preorder."""
+    spans = []
+    stack = [(tree, start)]
+    while stack:
+        node, position = stack.pop()
+        spans.append((position, position + len(node.leaves())))
+        children = []
+        for child in node:
+            if isinstance(child, nltk.Tree):
+                children.append((child, position))
+                position += len(child.leaves())
+            else:
+                position += 1
+        stack.extend(reversed(children))
+    return spans
+
+def test_recorded_derivations_are_the_sampled_trees():
+    compiled = compile_grammar(grammar_string, probabilistic=True)
+    for engine in ['rewrite', 'stack']:
+        for seed in range(50):
+            sentence, derivation = generate_sentence_pcfg(grammar_string, engine=engine, rng=random.Random(seed), derivation=True)
+            # recording does not change the sentence
+            assert sentence == generate_sentence_pcfg(grammar_string, engine=engine, rng=random.Random(seed))
+
+            tree = derivation.to_tree(compiled)
+            assert ' '.join(tree.leaves()) == sentence
+            assert derivation.spans.tolist() == [list(span) for span in tree_spans(tree)]
+            assert [(str(production.lhs()), [str(symbol) for symbol in production.rhs()]) for production in tree.productions()] == \
+                   [(compiled.nonterminals[compiled.lhs[p]], [compiled.nonterminals[symbol] if symbol >= 0 else compiled.terminals[~symbol]
+                     for symbol in compiled.rhs_tuples[p]]) for p in derivation.productions]
+
+    sentence, derivation = generate_sentence_pcfg(grammar_string, length=9, rng=random.Random(0), derivation=True)
+    assert derivation.to_tree(compiled).leaves() == sentence.split(' ')
+
+def test_batch_derivations():
+    # the second grammar has subtrees that yield no terminals, their nodes share positions with their right siblings
+    empty_string = '\n'.join([
+        'S -> A B "c" [0.5] | B A [0.5]',
+        'A -> C [0.6] | "a" A [0.4]',
+        'C -> [0.7] | B [0.3]',
+        'B -> "b" [0.5] | A C [0.5]',
+    ])
+    for string in [grammar_string, empty_string]:
+        compiled = compile_grammar(string, probabilistic=True)
+        batch = generate_sentences_batch(string, 500, seed=0, batch_size=128, derivations=True)
+        assert np.array_equal(batch.tokens, generate_sentences_batch(string, 500, seed=0, batch_size=128).tokens)
+
+        for i in range(500):
+            derivation = batch.derivations.derivation(i)
+            assert np.array_equal(derivation_spans(compiled, derivation.productions.tolist()), derivation.spans)
+            assert ' '.join(batch.derivations.tree(i, compiled).leaves()) == batch.sentence(i)
+
+    # the example where sorting by position puts C after B
+    compiled = compile_grammar('S -> A B "c" [1.0]\nA -> C [1.0]\nC -> [1.0]\nB -> "b" [1.0]', probabilistic=True)
+    derivation = generate_sentences_batch(compiled, 1, seed=0, derivations=True).derivations.derivation(0)
+    assert [compiled.nonterminals[compiled.lhs[p]] for p in derivation.productions] == ['S', 'A', 'C', 'B']
+    assert derivation.spans.tolist() == [[0, 2], [0, 0], [0, 0], [0, 1]]
+
+def test_token_corpus_derivations(tmp_path):
+    corpus = generate_token_corpus(grammar_string, str(tmp_path), n_documents=20, n_sentences=3, seed=0, derivations=True)
+    plain = generate_token_corpus(grammar_string, str(tmp_path / 'plain'), n_documents=20, n_sentences=3, seed=0)
+    assert np.array_equal(corpus.tokens, plain.tokens)
+
+    for j in range(60):
+        tree = corpus.tree(j)
+        assert [corpus.vocab[token] for token in corpus.sentence(j)] == tree.leaves()
+        assert corpus.derivation(j).spans[0].tolist() == [0, len(corpus.sentence(j))]
+
@@ -0,0 +1,29 @@
+import random
+
+import nltk
+import pytest
+from nltk_utils.pcfg.generate import generate_pcfg
+from nltk_utils.utils import CompiledGrammar, compile_grammar, generate_nonterminals, generate_terminals
+
+def test_direct_grammar_matches_parsed_string():
+    random.seed(0)
+    for _ in range(20):
+        grammar = generate_pcfg(generate_terminals(4), generate_nonterminals(5), n_rules=12, prob_terminal=0.5)
+        parsed = CompiledGrammar.from_nltk(nltk.PCFG.fromstring(grammar))
+
+        # the cached compiled grammar was built without nltk, it must be the same as parsing the string
+        assert compile_grammar(grammar).to_string() == parsed.to_string()
+        assert len(set(grammar.split('\n'))) == len(grammar.split('\n'))
+
+def test_too_many_rules_for_prob_terminal():
+    # with prob_terminal 1 only the 2 * 3 terminal rules can be drawn, with 0 only the 3 * 9 binary rules
+    for n_rules, prob_terminal in [(7, 1.0), (28, 0.0)]:
+        with pytest.raises(ValueError):
+            generate_pcfg(generate_terminals(2), generate_nonterminals(3), n_rules, prob_terminal, method='direct')
+
+    grammar = generate_pcfg(generate_terminals(2), generate_nonterminals(3), 6, 1.0, method='direct', rng=random.Random(0))
+    assert len(grammar.split('\n')) == 7
+
+    # the spanning rules of the constructive method can be binary rules even with prob_terminal 1
+    grammar = generate_pcfg(generate_terminals(2), generate_nonterminals(3), 7, 1.0, method='constructive', rng=random.Random(0))
+    assert len(grammar.split('\n')) == 8
@@ -0,0 +1,14 @@
+import random
+
+from nltk_utils.graphs import has_unproductive_rules, is_transient
+from nltk_utils.pcfg.generate import generate_pcfg
+from nltk_utils.utils import generate_nonterminals, generate_terminals
+
+def test_constructive_grammars_are_transient():
+    random.seed(0)
+    for n_nonterminals in [2, 5, 12]:
+        for n_extra in [0, 4]:
+            for _ in range(10):
+                grammar = generate_pcfg(generate_terminals(3), generate_nonterminals(n_nonterminals),
+                                        n_rules=n_nonterminals + n_extra, prob_terminal=0.5, method='constructive')
+                assert is_transient(grammar) and not has_unproductive_rules(grammar), grammar
@@ -1,5 +1,7 @@
 import nltk
-from nltk_utils.graphs import is_transient, build_transient_transition_graph, get_reachable_states, find_absorbing_states
+import pytest
+from nltk_utils.graphs import is_transient, build_transient_transition_graph, get_reachable_states, find_absorbing_states, classify_recursion, get_strongly_connected_components
+from nltk_utils.graphs import build_transition_graph, get_unproductive_rules, print_graph
 
 # Test cases for is_grammar_transient
 # True, simple path to terminal
@@ -69,6 +71,80 @@ complex_grammar_multiple_paths = [
     'Z -> "k" [1.0]',
 ]
 
+# L is left recursive, R right recursive, E self-embedding, M and N call each other, T is not recursive
+recursion_grammar = [
+    'S -> L R E M T [1.0]',
+    'L -> L "a" [0.5] | "a" [0.5]',
+    'R -> "b" R [0.5] | "b" [0.5]',
+    'E -> "c" E "d" [0.5] | "c" [0.5]',
+    'M -> "e" N [0.5] | "e" [0.5]',
+    'N -> M "f" [1.0]',
+    'T -> "g" [1.0]',
+]
+
+# (grammar, transient, unproductive rules, absorbing states, strongly connected components)
+# the results of the graph helpers from before GrammarAnalysis, the components are new
+GRAPH_CASES = [
+    (transient_grammar, True, set(), {'B'}, [{'S'}, {'A'}, {'B'}]),
+    (nontransient_grammar, False, {'S', 'A', 'B'}, set(), [{'S'}, {'A', 'B'}]),
+    (direct_loop_with_terminal, True, set(), {'A'}, [{'S'}, {'A'}]),
+    (indirect_loop_without_terminal, False, {'S', 'A', 'B', 'C'}, set(), [{'S'}, {'A', 'B', 'C'}]),
+    (mixed_starting_nonterminals, True, {'B', 'C'}, {'A', 'D'}, [{'S'}, {'A'}, {'B', 'C'}, {'D'}]),
+    (nested_loops_with_escape, True, set(), {'A', 'D'}, [{'S'}, {'A'}, {'B', 'C'}, {'D'}]),
+    (deeply_nested_structure, True, set(), {'E'}, [{'S'}, {'A'}, {'B'}, {'C'}, {'D'}, {'E'}]),
+    (complex_grammar_multiple_paths, True, set(), {'A', 'B', 'C', 'Z'}, [{'S'}, {'A', 'B', 'C'}, {'X', 'Y'}, {'Z'}]),
+]
+
+@pytest.mark.parametrize('grammar, transient, unproductive, absorbing, components', GRAPH_CASES)
+def test_graph_helpers(grammar, transient, unproductive, absorbing, components):
+    grammar = '\n'.join(grammar)
+    assert is_transient(grammar) == transient
+    assert get_unproductive_rules(grammar) == {nltk.Nonterminal(symbol) for symbol in unproductive}
+    assert find_absorbing_states(grammar) == absorbing
+
+    # any topological order will do: every edge goes to the same or a later component
+    found = get_strongly_connected_components(grammar)
+    assert sorted(map(sorted, found)) == sorted(map(sorted, components))
+    position = {symbol: i for i, component in enumerate(found) for symbol in component}
+    graph = build_transition_graph(grammar)
+    assert all(position[lhs] <= position[child] for lhs, children in graph.items() for child in children)
+
+def test_transition_graph_order():
+    # the keys are in compiled order: the start symbol, then by first appearance, not by the order of the left-hand sides
+    graph = build_transition_graph('\n'.join(complex_grammar_multiple_paths))
+    assert list(graph) == ['S', 'A', 'X', 'B', 'C', 'Y', 'Z']
+    assert graph == {'S': ['A', 'X'], 'A': ['B'], 'B': ['C'], 'C': ['A'], 'X': ['Y'], 'Y': ['Z', 'X'], 'Z': []}
+
+# a unary cycle next to left or right recursion does not change the kind, U and V only have a unary cycle
+unary_recursion_grammar = [
+    'S -> L R U [1.0]',
+    'L -> L "a" [0.4] | L [0.2] | "a" [0.4]',
+    'R -> "b" R [0.4] | R [0.2] | "b" [0.4]',
+    'U -> V [0.5] | "u" [0.5]',
+    'V -> U [1.0]',
+]
+
+def test_unary_recursion():
+    recursion = classify_recursion('\n'.join(unary_recursion_grammar))
+    assert {symbol: info.kind for symbol, info in recursion.items()} == {
+        'S': 'non-recursive', 'L': 'left', 'R': 'right', 'U': 'unary', 'V': 'unary',
+    }
+    assert recursion['L'].unary and not recursion['L'].right
+    assert recursion['R'].unary and not recursion['R'].left
+    assert not recursion['U'].left and not recursion['U'].right and recursion['U'].mutual
+    assert not any(info.unary for info in classify_recursion('\n'.join(recursion_grammar)).values())
+
+def test_recursion_classes():
+    recursion = classify_recursion('\n'.join(recursion_grammar))
+    assert {symbol: info.kind for symbol, info in recursion.items()} == {
+        'S': 'non-recursive', 'L': 'left', 'R': 'right', 'E': 'self-embedding', 'M': 'self-embedding', 'N': 'self-embedding', 'T': 'non-recursive',
+    }
+    assert recursion['M'].mutual and recursion['N'].mutual and not recursion['E'].mutual
+
+    # S comes first, it depends on all other components
+    components = get_strongly_connected_components('\n'.join(recursion_grammar))
+    assert components[0] == {'S'} and {'M', 'N'} in components
+
 if __name__ == "__main__":
                                                                 # Expected output
     print(is_transient(transient_grammar))              # True
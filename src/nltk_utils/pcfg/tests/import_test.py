@@ -0,0 +1,18 @@
+import os
+import subprocess
+import sys
+
+# the core of the package must import without nltk, tqdm or networkx, see `python -X importtime`.
+# The import time itself is checked against a budget by the benchmarks, see `benchmarks/imports.py`
+SRC = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+MODULES = ['nltk_utils.datasets', 'nltk_utils.pcfg.generate', 'nltk_utils.cfg.generate', 'nltk_utils.graphs', 'nltk_utils.pcfg.analysis']
+
+def imported_modules(modules: list[str]) -> set[str]:
+    """Import the modules in a fresh interpreter and return the names of all modules it loaded."""
+
+    code = 'import sys, ' + ', '.join(modules) + '; print("\\n".join(sys.modules))'
+    result = subprocess.run([sys.executable, '-c', code], cwd=SRC, capture_output=True, text=True, check=True)
+    return set(result.stdout.split())
+
+def test_core_imports_without_nltk():
+    assert not {'nltk', 'tqdm', 'networkx'} & imported_modules(MODULES)
@@ -0,0 +1,62 @@
+import json
+import random
+
+from nltk_utils import instrumentation
+from nltk_utils.datasets import CorpusWriter, generate_documents_pcfg
+from nltk_utils.pcfg.generate import generate_sentence_pcfg, sentences_in_pcfg
+from nltk_utils.utils import compile_grammar
+
+grammar_string = '\n'.join([
+    'S -> A B [1.0]',
+    'A -> "a" [0.7] | A B [0.3]',
+    'B -> "b" [1.0]',
+])
+
+def test_counters(tmp_path):
+    key = compile_grammar(grammar_string, probabilistic=True).content_hash
+    instrumentation.reset()
+    instrumentation.enable()
+    try:
+        rng = random.Random(0)
+        sentences = [generate_sentence_pcfg(grammar_string, '', rng=rng) for _ in range(100)]
+        sentences_in_pcfg(sentences, grammar_string)
+        instrumentation.dump(str(tmp_path / 'metrics.json'))
+        instrumentation.dump(str(tmp_path / 'metrics.prom'), format='prometheus')
+    finally:
+        instrumentation.disable()
+
+    stats = instrumentation.snapshot()[key]
+    assert stats['sentences'] == stats['derivations'] == 100
+    assert stats['aborts'] == stats['retries'] == 0
+    # every derivation expands at least S, A and B
+    assert stats['expansions'] >= 300
+    assert stats['recognitions'] == 100
+    assert stats['chart_items'] > 0
+
+    with open(tmp_path / 'metrics.json') as f:
+        assert json.load(f)['grammars'][key]['sentences'] == 100
+    with open(tmp_path / 'metrics.prom') as f:
+        assert f'cfg_sentences_total{{grammar="{key[:12]}"}} 100' in f.read()
+
+    # nothing is recorded while disabled
+    generate_sentence_pcfg(grammar_string, '', rng=rng)
+    assert instrumentation.snapshot()[key]['sentences'] == 100
+
+def test_worker_counters_are_merged(tmp_path):
+    key = compile_grammar(grammar_string, probabilistic=True).content_hash
+    for n_workers in (1, 2):
+        instrumentation.reset()
+        instrumentation.enable()
+        try:
+            with CorpusWriter(str(tmp_path / str(n_workers))) as writer:
+                generate_documents_pcfg(grammar_string, n_documents=40, n_sentences=3, seed=0, shard_size=5, n_workers=n_workers, writer=writer)
+        finally:
+            instrumentation.disable()
+
+        # the parent sees every sentence, whichever process sampled it
+        stats = instrumentation.snapshot()[key]
+        assert stats['sentences'] == stats['derivations'] == 120
+        if n_workers == 1:
+            expected = stats
+        assert {name: stats[name] for name in ('expansions', 'max_expansions')} == \
+               {name: expected[name] for name in ('expansions', 'max_expansions')}
@@ -0,0 +1,38 @@
+import itertools
+import random
+
+import nltk
+from nltk_utils.cfg.generate import generate_valid_strings
+from nltk_utils.pcfg.generate import generate_pcfg, generate_sentences_pcfg
+from nltk_utils.utils import generate_nonterminals, generate_terminals
+
+def brute_force(terminals, grammar, max_length):
+    """Every combination of terminals, shortest first, kept if nltk can parse it."""
+    parser = nltk.ChartParser(grammar)
+    words = []
+    for k in range(1, max_length + 1):
+        for word in itertools.product(terminals, repeat=k):
+            try:
+                if any(True for _ in parser.parse(list(word))):
+                    words.append(''.join(word))
+            except ValueError:
+                # a terminal the grammar does not cover
+                pass
+    return words
+
+def test_language_matches_product_and_parse():
+    rng = random.Random(0)
+    for i in range(20):
+        n_nonterminals = rng.randint(2, 4)
+        terminals = generate_terminals(3)
+        nonterminals = generate_nonterminals(n_nonterminals)
+        grammar = generate_pcfg(terminals, nonterminals, rng.randint(n_nonterminals, 8), 0.5, method='direct', rng=rng)
+
+        # a terminal order that is not the grammar's, and a terminal the grammar does not have
+        order = terminals[::-1] if i % 2 else terminals + ['z']
+        expected = brute_force(order, nltk.PCFG.fromstring(grammar), 4)
+        assert list(generate_sentences_pcfg(order, grammar, max_length=4)) == expected
+
+        # the same rules as a CFG, with a unary cycle through the start symbol
+        cfg = '\n'.join([rule.rsplit(' [', 1)[0] for rule in grammar.split('\n')] + [f'{nonterminals[-1]} -> S'])
+        assert list(generate_valid_strings(order, cfg, max_length=4)) == brute_force(order, nltk.CFG.fromstring(cfg), 4)
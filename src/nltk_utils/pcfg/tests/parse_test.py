@@ -0,0 +1,65 @@
+import nltk
+import pytest
+
+from nltk_utils.utils import PROBABILITY_EPSILON, parse_grammar
+
+PCFG_CASES = [
+    'S -> A [1.0]\nA -> "a" [0.4] | A "b" A [0.6]',
+    # comments, on their own line and after a production
+    '# a comment\nS -> A [1.0] # after a production\nA -> "a" [1.0]',
+    # a production continued on the next line
+    'S -> A \\\n  B [1.0]\nA -> "a" [1.0]\nB -> "b" [1.0]',
+    '%start A\nS -> "s" [1.0]\nA -> S [1.0]',
+    '%start A B\nA -> "a" [1.0]',
+    '%end A\nA -> "a" [1.0]',
+    # quoted terminals with spaces and the other kind of quote
+    'S -> "a b" [0.5] | \'c "d\' [0.5]',
+    # empty right-hand sides
+    'S -> [1.0]',
+    'S -> [0.5] | "a" [0.5]',
+    'S "a" [1.0]',
+    'S -> "a" [1.5]',
+    'S -> "a" [0.6] | "b" [0.6]',
+    # the sums of the probabilities just inside and just outside of the tolerance
+    f'S -> "a" [0.5] | "b" [{0.5 - PROBABILITY_EPSILON / 2}]',
+    f'S -> "a" [0.5] | "b" [{0.5 + PROBABILITY_EPSILON / 2}]',
+    f'S -> "a" [0.5] | "b" [{0.5 - PROBABILITY_EPSILON * 1.1}]',
+    f'S -> "a" [0.5] | "b" [{0.5 + PROBABILITY_EPSILON * 1.1}]',
+    'S -> "a"',
+    'S -> "a" [1.0',
+    'S -> "a [1.0]',
+    '',
+]
+
+CFG_CASES = [
+    'S -> A B | "c"\nA -> "a"\nB -> "b" S',
+    '# only a comment',
+    'S -> | "a"',
+    'S -> A |\nA -> "a"',
+    'S -> "a b" | \'c\'',
+    'S -> "a" [1.0]',
+    'S A',
+    'S -> A \\\nA -> "a"',
+    'S -> "a"\n%start B\nB -> "b"',
+]
+
+def nltk_grammar(text, probabilistic):
+    """The start symbol and the productions of nltk in the form of `parse_grammar`."""
+    grammar = (nltk.PCFG if probabilistic else nltk.CFG).fromstring(text)
+    productions = [
+        (str(production.lhs()), tuple((str(symbol), nltk.grammar.is_nonterminal(symbol)) for symbol in production.rhs()),
+         production.prob() if probabilistic else None)
+        for production in grammar.productions()
+    ]
+    return str(grammar.start()), productions
+
+@pytest.mark.parametrize('text, probabilistic', [(text, True) for text in PCFG_CASES] + [(text, False) for text in CFG_CASES])
+def test_parse_grammar_matches_nltk(text, probabilistic):
+    try:
+        expected = nltk_grammar(text, probabilistic)
+    except ValueError:
+        with pytest.raises(ValueError):
+            parse_grammar(text, probabilistic)
+        return
+
+    assert parse_grammar(text, probabilistic) == expected
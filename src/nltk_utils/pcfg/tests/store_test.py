@@ -0,0 +1,78 @@
+import random
+
+import pytest
+
+from nltk_utils.pcfg.generate import generate_pcfg
+from nltk_utils.store import GrammarCatalog, load_arrays, load_compiled, save_compiled
+from nltk_utils.utils import compile_grammar, generate_nonterminals, generate_terminals
+
+def test_compiled_file_round_trip(tmp_path):
+    for text, probabilistic in [('S -> A [1.0]\nA -> "a" [0.4] | A "b" A [0.6]', True), ('S -> A B | "c"\nA -> "a"\nB -> "b" S', False)]:
+        grammar = compile_grammar(text, probabilistic=probabilistic)
+        save_compiled(grammar, str(tmp_path / 'g.grammar'))
+        loaded = load_compiled(str(tmp_path / 'g.grammar'))
+
+        assert loaded.to_string() == grammar.to_string()
+        assert (loaded.nonterminals, loaded.terminals, loaded.lhs, loaded.rhs, loaded.probs) == \
+               (grammar.nonterminals, grammar.terminals, grammar.lhs, grammar.rhs, grammar.probs)
+
+        # the arrays are read-only views of the mapped file
+        header, arrays = load_arrays(str(tmp_path / 'g.grammar'))
+        assert header['content_hash'] == grammar.content_hash
+        assert arrays['rhs'].tolist() == grammar.rhs and not arrays['rhs'].flags.writeable
+
+def test_catalog_queries(tmp_path):
+    rng = random.Random(0)
+    grammars = []
+    with GrammarCatalog(str(tmp_path / 'catalog.sqlite')) as catalog:
+        for i in range(30):
+            n_nonterminals = 3 + i % 3
+            method = 'constructive' if i % 2 else 'direct'
+            grammar = generate_pcfg(generate_terminals(4), generate_nonterminals(n_nonterminals), n_nonterminals + 2, 0.5, method=method, rng=rng)
+            grammars.append(grammar)
+            catalog.add(grammar, params={'method': method})
+            catalog.add(grammar)
+
+        assert len(catalog) == len(set(grammars))
+
+        # constructive grammars are always transient
+        rows = catalog.query(transient=True, n_nonterminals=4)
+        assert rows and all(row['transient'] and row['n_nonterminals'] == 4 for row in rows)
+        assert all(row['params']['method'] == 'direct' for row in catalog.query(transient=False))
+
+        row = rows[0]
+        assert catalog.load(row['content_hash']).content_hash == row['content_hash']
+
+    # the catalog persists
+    with GrammarCatalog(str(tmp_path / 'catalog.sqlite')) as catalog:
+        assert len(catalog) == len(set(grammars))
+
+def test_load_compiled_is_verified_by_checksum(tmp_path):
+    path = str(tmp_path / 'g.grammar')
+    grammar = compile_grammar('S -> A [1.0]\nA -> "a" [0.4] | A "b" A [0.6]')
+    save_compiled(grammar, path)
+
+    # the content hash comes from the file, the grammar is cached under its text
+    loaded = load_compiled(path)
+    assert loaded.content_hash == grammar.content_hash
+    assert compile_grammar(grammar.to_string()) is loaded
+
+    # flip a byte of the last array
+    data = bytearray(open(path, 'rb').read())
+    data[-1] ^= 1
+    open(path, 'wb').write(bytes(data))
+    with pytest.raises(ValueError):
+        load_compiled(path)
+
+def test_load_compiled_verifies_the_header(tmp_path):
+    path = str(tmp_path / 'g.grammar')
+    grammar = compile_grammar('S -> A [1.0]\nA -> "a" [0.4] | A "b" A [0.6]')
+    other = compile_grammar('S -> "z" [1.0]')
+    save_compiled(grammar, path)
+
+    # the content hash is the key of the grammar in the cache, a file with another hash must not replace that grammar
+    data = open(path, 'rb').read().replace(grammar.content_hash.encode('utf-8'), other.content_hash.encode('utf-8'))
+    open(path, 'wb').write(data)
+    with pytest.raises(ValueError):
+        load_compiled(path)
+    assert compile_grammar('S -> "z" [1.0]') is other
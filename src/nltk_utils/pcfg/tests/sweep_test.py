@@ -0,0 +1,70 @@
+from nltk_utils.store import GrammarCatalog
+from nltk_utils.sweep import grid_cells, run_cell, run_sweep, sweep_grammars, sweep_stats
+
+GRID = {'n_terminals': [3, 4], 'n_nonterminals': 3, 'n_rules': [2, 5], 'prob_terminal': 0.5}
+
+def test_grid_cells():
+    assert grid_cells(GRID) == [(3, 3, 2, 0.5), (3, 3, 5, 0.5), (4, 3, 2, 0.5), (4, 3, 5, 0.5)]
+
+def test_run_cell_is_deterministic():
+    first = run_cell((4, 3, 5, 0.5), 5, seed=1, batch_size=3)
+    second = run_cell((4, 3, 5, 0.5), 5, seed=1, batch_size=7)
+    assert first['grammars'] == second['grammars'] and first['accepted'] == 5
+    assert first['attempts'] >= 5 and first['acceptance_rate'] == 5 / first['attempts']
+
+    # fewer rules than nonterminals is not a valid cell
+    invalid = run_cell((4, 3, 2, 0.5), 5, seed=1)
+    assert invalid['accepted'] == 0 and invalid['error']
+
+def test_unseeded_sweeps_draw_a_seed(tmp_path):
+    # without a seed every run samples other grammars, the drawn seed is stored to repeat the sweep
+    assert run_cell((4, 3, 5, 0.5), 5)['grammars'] != run_cell((4, 3, 5, 0.5), 5)['grammars']
+
+    path = str(tmp_path / 'catalog.sqlite')
+    run_sweep({**GRID, 'n_rules': 5}, grammars_per_cell=3, catalog=path)
+    first, second = sweep_stats(path)
+    assert first['seed'] is not None and first['seed'] == second['seed']
+
+def test_sweep_skips_finished_cells(tmp_path):
+    path = str(tmp_path / 'catalog.sqlite')
+    results = run_sweep(GRID, grammars_per_cell=3, catalog=path, n_workers=2, seed=0)
+    assert [result['cell'] for result in results] == ['3_3_2_0.5', '3_3_5_0.5', '4_3_2_0.5', '4_3_5_0.5']
+
+    with GrammarCatalog(path) as catalog:
+        stats = {row['cell']: row for row in sweep_stats(catalog)}
+        assert stats['4_3_5_0.5']['accepted'] == 3 and stats['4_3_2_0.5']['accepted'] == 0
+        hashes = sweep_grammars(catalog, '4_3_5_0.5')
+        assert len(hashes) == 3 and all(content_hash in catalog for content_hash in hashes)
+        assert catalog.query(content_hash=hashes[0])[0]['params']['cell'] == '4_3_5_0.5'
+
+    # the same grammars in a single process, and only the new cell is run again
+    assert run_sweep(GRID, grammars_per_cell=3, catalog=path, seed=0) == []
+    results = run_sweep({**GRID, 'n_rules': [5, 6]}, grammars_per_cell=3, catalog=path, seed=0)
+    assert [result['cell'] for result in results] == ['3_3_6_0.5', '4_3_6_0.5']
+
+    cell = run_cell((4, 3, 5, 0.5), 3, seed=0)
+    with GrammarCatalog(path) as catalog:
+        assert [catalog.load(content_hash).to_string() for content_hash in sweep_grammars(catalog, '4_3_5_0.5')] == cell['grammars']
+
+def test_sweep_keeps_isomorphic_grammars_once(tmp_path):
+    # one nonterminal and one rule: every grammar of both cells is `A -> "a"` up to renaming
+    grid = {'n_terminals': 2, 'n_nonterminals': 1, 'n_rules': 1, 'prob_terminal': [0.5, 0.9]}
+    results = run_sweep(grid, grammars_per_cell=2, catalog=str(tmp_path / 'catalog.sqlite'), seed=0, max_attempts=20)
+
+    assert [(result['accepted'], result['attempts'], result['duplicates']) for result in results] == [(1, 20, 19), (0, 20, 20)]
+
+def test_cells_skip_grammars_in_the_catalog(tmp_path):
+    grid = {'n_terminals': 4, 'n_nonterminals': 3, 'n_rules': 5, 'prob_terminal': 0.5}
+    with GrammarCatalog(str(tmp_path / 'catalog.sqlite')) as catalog:
+        run_sweep(grid, grammars_per_cell=3, catalog=catalog, seed=0)
+        first = set(sweep_grammars(catalog, '4_3_5_0.5'))
+
+        # run the cell again with the same seed: it finds the same grammars first, skips them and still fills up
+        with catalog.connection:
+            catalog.connection.execute('DELETE FROM sweep_cells')
+        for n_workers in (1, 2):
+            (result,) = run_sweep(grid, grammars_per_cell=4, catalog=catalog, seed=0, n_workers=n_workers)
+            assert result['accepted'] == 4 and result['duplicates'] >= 3
+            assert first.isdisjoint(sweep_grammars(catalog, '4_3_5_0.5'))
+            with catalog.connection:
+                catalog.connection.execute('DELETE FROM sweep_cells')
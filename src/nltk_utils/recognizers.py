@@ -0,0 +1,345 @@
+import itertools
+
+import numpy as np
+
+from nltk_utils import instrumentation
+from nltk_utils.utils import CompiledGrammar
+
+# Recognizers answer "is this sentence in the language?" without building parse trees.
+# They are compiled once per grammar and cached on the compiled grammar.
+# Both build their chart one column per token, left to right: `start()` gives the columns before the first token,
+# `extend(columns, token)` the column for the next token and `accepts(columns)` tells if the tokens so far are a sentence.
+# Sentences that share a prefix can therefore share the columns of that prefix, see `recognize_many`.
+# With instrumentation enabled, the number of columns computed and their sizes (`column_size`) are recorded.
+
+# the number of combined cell pairs a CYK recognizer keeps, about 200 bytes each
+COMBINED_CACHE_SIZE = 1_000_000
+
+
+class CYKRecognizer:
+    """
+    A CYK recognizer for grammars in Chomsky normal form, with unary rules allowed (like the `S -> X` start rule).\\
+    Every chart cell is a bitmask over the nonterminals, binary rules combine two cells with bitwise operations.
+    Combined cells are memoized, since the same pairs of cells come up over and over.
+    The memo is cleared once it holds `max_combined` pairs, so a recognizer that is cached on its grammar
+    and used for many sentences does not grow without bound. Clearing is cheaper than LRU bookkeeping on every hit.
+    - max_combined (`int`): the size of the memo
+    """
+
+    def __init__(self, grammar: CompiledGrammar, max_combined: int = COMBINED_CACHE_SIZE):
+
+        if not CYKRecognizer.supports(grammar):
+            raise ValueError("The grammar is not in Chomsky normal form (A -> B C, A -> B or A -> \"a\").")
+
+        n_nonterminals = len(grammar.nonterminals)
+        self.grammar = grammar
+        self.start_mask = 1 << grammar.start
+
+        # up[B]: all nonterminals that derive B through unary rules, including B itself
+        parents = [[] for _ in range(n_nonterminals)]
+        for production, rhs in enumerate(grammar.rhs_tuples):
+            if len(rhs) == 1 and rhs[0] >= 0:
+                parents[rhs[0]].append(grammar.lhs[production])
+
+        self.up = [0] * n_nonterminals
+        for symbol in range(n_nonterminals):
+            mask, stack = 0, [symbol]
+            while stack:
+                current = stack.pop()
+                if not mask >> current & 1:
+                    mask |= 1 << current
+                    stack.extend(parents[current])
+            self.up[symbol] = mask
+
+        # terminal -> nonterminals that derive it
+        self.terminal_masks = {}
+        for production, rhs in enumerate(grammar.rhs_tuples):
+            if len(rhs) == 1 and rhs[0] < 0:
+                terminal = grammar.terminals[~rhs[0]]
+                self.terminal_masks[terminal] = self.terminal_masks.get(terminal, 0) | 1 << grammar.lhs[production]
+        self.terminal_masks = {terminal: self.closure(mask) for terminal, mask in self.terminal_masks.items()}
+
+        # binary[B] = [(C, mask of all A with A -> B C), ...]
+        binary = [{} for _ in range(n_nonterminals)]
+        for production, rhs in enumerate(grammar.rhs_tuples):
+            if len(rhs) == 2:
+                left, right = rhs
+                binary[left][right] = binary[left].get(right, 0) | 1 << grammar.lhs[production]
+        self.binary = [list(rules.items()) for rules in binary]
+
+        self.max_combined = max_combined
+        self._combined = {}
+
+    @staticmethod
+    def supports(grammar: CompiledGrammar) -> bool:
+        """Check if every production is `A -> B C`, `A -> B` or `A -> "a"`."""
+        for rhs in grammar.rhs_tuples:
+            if len(rhs) == 2 and (rhs[0] < 0 or rhs[1] < 0):
+                return False
+            if len(rhs) not in (1, 2):
+                return False
+        return True
+
+    def closure(self, mask: int) -> int:
+        """Add all nonterminals that derive a nonterminal in `mask` through unary rules."""
+        result = mask
+        while mask:
+            low = mask & -mask
+            result |= self.up[low.bit_length() - 1]
+            mask ^= low
+        return result
+
+    def combine(self, left: int, right: int) -> int:
+        """All nonterminals A with a rule A -> B C, B in `left` and C in `right`, closed under unary rules."""
+
+        key = (left, right)
+        result = self._combined.get(key)
+        if result is not None:
+            return result
+
+        result = 0
+        mask = left
+        while mask:
+            low = mask & -mask
+            for symbol, lhs_mask in self.binary[low.bit_length() - 1]:
+                if right >> symbol & 1:
+                    result |= lhs_mask
+            mask ^= low
+
+        result = self.closure(result)
+        # clear in place, `extend` holds on to the bound `get` of the memo
+        if len(self._combined) >= self.max_combined:
+            self._combined.clear()
+        self._combined[key] = result
+        return result
+
+    def extend(self, columns: list[list[int]], token) -> list[int]:
+        """
+        Compute the chart column for the next token.\\
+        `columns[j][i]` is the cell of the span `i..j` (inclusive), so a column only depends on the columns before it.
+        """
+
+        j = len(columns)
+        column = [0] * j + [self.terminal_masks.get(token, 0)]
+        combined, combine = self._combined.get, self.combine
+
+        for i in range(j - 1, -1, -1):
+            cell = 0
+            for k in range(i, j):
+                left = columns[k][i]
+                if left:
+                    right = column[k + 1]
+                    if right:
+                        result = combined((left, right))
+                        if result is None:
+                            result = combine(left, right)
+                        cell |= result
+            column[i] = cell
+
+        return column
+
+    def start(self) -> list:
+        """The chart before the first token, CYK has no columns yet."""
+        return []
+
+    def accepts(self, columns: list[list[int]]) -> bool:
+        """Check if the start symbol spans all tokens of the chart."""
+        return bool(columns and columns[-1][0] & self.start_mask)
+
+    @staticmethod
+    def column_size(column: list[int]) -> int:
+        """The number of non-empty cells of a column."""
+        return len(column) - column.count(0)
+
+    def recognize(self, tokens) -> bool:
+        """Return True if the sequence of terminals is generated by the grammar."""
+
+        columns = self.start()
+        for token in tokens:
+            columns.append(self.extend(columns, token))
+
+        if instrumentation.enabled:
+            _record_chart(self, columns)
+
+        return self.accepts(columns)
+
+
+class EarleyRecognizer:
+    """
+    An Earley recognizer on the compiled grammar, for grammars that are not in Chomsky normal form.\\
+    An item is a tuple `(production, dot, origin)`. Every column keeps its items indexed by the symbol after the dot,
+    so scanning a token and completing a nonterminal only look at the items waiting for exactly that symbol.
+    Empty productions are not supported, so no nonterminal is nullable and every column only depends on the columns before it.
+    """
+
+    def __init__(self, grammar: CompiledGrammar):
+
+        if not EarleyRecognizer.supports(grammar):
+            raise ValueError("The Earley recognizer does not support empty productions.")
+
+        self.grammar = grammar
+
+    @staticmethod
+    def supports(grammar: CompiledGrammar) -> bool:
+        """Check if the grammar has no empty productions."""
+        return all(len(rhs) > 0 for rhs in grammar.rhs_tuples)
+
+    def _close(self, columns: list[tuple[dict, bool]], agenda: list[tuple]) -> tuple[dict, bool]:
+        """Predict and complete the items of the agenda, this gives the column at position `len(columns)`."""
+
+        grammar = self.grammar
+        rhs_tuples, lhs, prod_offsets = grammar.rhs_tuples, grammar.lhs, grammar.prod_offsets
+        start = grammar.start
+        j = len(columns)
+
+        waiting = {}
+        seen = set()
+        predicted = set()
+        accepted = False
+
+        while agenda:
+            item = agenda.pop()
+            if item in seen:
+                continue
+            seen.add(item)
+
+            production, dot, origin = item
+            rhs = rhs_tuples[production]
+
+            if dot == len(rhs):
+                # complete: advance the items of the origin column that wait for this nonterminal
+                symbol = lhs[production]
+                if origin == 0 and symbol == start:
+                    accepted = True
+                for waiting_production, waiting_dot, waiting_origin in columns[origin][0].get(symbol, ()):
+                    agenda.append((waiting_production, waiting_dot + 1, waiting_origin))
+                continue
+
+            symbol = rhs[dot]
+            waiting.setdefault(symbol, []).append(item)
+
+            # predict: every nonterminal is expanded once per column
+            if symbol >= 0 and symbol not in predicted:
+                predicted.add(symbol)
+                agenda.extend((p, 0, j) for p in range(prod_offsets[symbol], prod_offsets[symbol + 1]))
+
+        return waiting, accepted
+
+    def start(self) -> list[tuple[dict, bool]]:
+        """The chart before the first token: the productions of the start symbol are predicted."""
+        grammar = self.grammar
+        agenda = [(p, 0, 0) for p in range(grammar.prod_offsets[grammar.start], grammar.prod_offsets[grammar.start + 1])]
+        return [self._close([], agenda)]
+
+    def extend(self, columns: list[tuple[dict, bool]], token) -> tuple[dict, bool]:
+        """Compute the chart column after the next token."""
+
+        terminal = self.grammar.terminal_index.get(token)
+        if terminal is None:
+            return {}, False
+
+        # scan: advance the items of the last column that wait for this terminal
+        agenda = [(production, dot + 1, origin) for production, dot, origin in columns[-1][0].get(~terminal, ())]
+        return self._close(columns, agenda)
+
+    def accepts(self, columns: list[tuple[dict, bool]]) -> bool:
+        """Check if the start symbol has been completed over all tokens of the chart."""
+        return columns[-1][1]
+
+    @staticmethod
+    def column_size(column: tuple[dict, bool]) -> int:
+        """The number of incomplete items of a column, completed items are not kept."""
+        return sum(len(items) for items in column[0].values())
+
+    def recognize(self, tokens) -> bool:
+        """Return True if the sequence of terminals is generated by the grammar."""
+
+        columns = self.start()
+        for token in tokens:
+            columns.append(self.extend(columns, token))
+
+        if instrumentation.enabled:
+            _record_chart(self, columns)
+
+        return self.accepts(columns)
+
+
+def _record_chart(recognizer: CYKRecognizer | EarleyRecognizer, columns: list, n_sentences: int = 1) -> None:
+    key = recognizer.grammar.content_hash
+    instrumentation.record(key, 'recognitions', n_sentences)
+    instrumentation.record(key, 'chart_columns', len(columns))
+    instrumentation.record(key, 'chart_items', sum(recognizer.column_size(column) for column in columns))
+
+
+def get_cyk_recognizer(grammar: CompiledGrammar) -> CYKRecognizer:
+    """Return the CYK recognizer of a compiled grammar, it is built on first use."""
+
+    recognizer = grammar.cache.get('cyk')
+    if recognizer is None:
+        recognizer = grammar.cache['cyk'] = CYKRecognizer(grammar)
+
+    return recognizer
+
+
+def get_earley_recognizer(grammar: CompiledGrammar) -> EarleyRecognizer:
+    """Return the Earley recognizer of a compiled grammar, it is built on first use."""
+
+    recognizer = grammar.cache.get('earley')
+    if recognizer is None:
+        recognizer = grammar.cache['earley'] = EarleyRecognizer(grammar)
+
+    return recognizer
+
+
+def _common_prefix_length(a, b) -> int:
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+def recognize_many(recognizer: CYKRecognizer | EarleyRecognizer, sentences, chunk_size: int = 65536) -> np.ndarray:
+    """
+    Check many sentences with one recognizer and return a boolean array in the order of `sentences`.\\
+    The sentences are read in chunks, so `sentences` can be any iterable, including a generator.
+    Every chunk is sorted, which walks the prefix trie of the chunk depth first: the chart columns of the prefix
+    shared with the previous sentence are kept and only the columns of the remaining tokens are computed.
+    - sentences: an iterable of token sequences, a string is a sequence of one-character tokens
+    - chunk_size (`int`): how many sentences are sorted and checked together
+    """
+
+    results = []
+    iterator = iter(sentences)
+    instrumented = instrumentation.enabled
+
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            break
+
+        accepted = np.zeros(len(chunk), dtype=np.bool_)
+        columns = recognizer.start()
+        n_start = len(columns)
+        previous = None
+
+        for i in sorted(range(len(chunk)), key=chunk.__getitem__):
+            tokens = chunk[i]
+
+            # drop the columns below the branching point of the trie, keep the shared prefix
+            shared = _common_prefix_length(previous, tokens) if previous is not None else 0
+            del columns[n_start + shared:]
+
+            for token in tokens[shared:]:
+                columns.append(recognizer.extend(columns, token))
+
+            # only the columns computed for this sentence, the shared prefix was recorded before
+            if instrumented:
+                _record_chart(recognizer, columns[n_start + shared:])
+
+            accepted[i] = recognizer.accepts(columns)
+            previous = tokens
+
+        results.append(accepted)
+
+    return np.concatenate(results) if results else np.zeros(0, dtype=np.bool_)
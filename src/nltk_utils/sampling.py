@@ -0,0 +1,282 @@
+import random
+from bisect import bisect_right
+
+import numpy as np
+
+from nltk_utils.graphs import _strongly_connected_components
+from nltk_utils.utils import CompiledGrammar
+
+# Sampling conditioned on the sentence length.
+# A LengthTable holds the inside weights of every nonterminal and every sentence length: the total weight of all
+# derivations of that length. With production weights that are probabilities this is the probability of the length,
+# with integer weights of 1 it is the number of derivations. A derivation is then sampled top-down: every nonterminal
+# picks a production and splits its length among the symbols of the right-hand side, weighted by the inside weights,
+# which gives exactly the distribution of the derivations of that length. No derivation is ever rejected.
+
+
+class LengthTable:
+    """
+    Inside weights `inside[A][n]` of the derivations of nonterminal `A` with exactly `n` terminals.\\
+    The table is filled up to the longest length asked for so far, and extended when a longer length is needed.
+    The cumulative weights used for sampling are built on first use and kept.
+    - weights (`list`): a weight for every production, floats or ints. Ints are summed exactly,
+    so counts of derivations don't overflow.
+    """
+
+    def __init__(self, grammar: CompiledGrammar, weights: list):
+
+        if any(len(rhs) == 0 for rhs in grammar.rhs_tuples):
+            raise ValueError("Empty productions are not supported.")
+
+        self.grammar = grammar
+        self.weights = list(weights)
+        self.exact = all(isinstance(weight, int) for weight in self.weights)
+        self.zero = 0 if self.exact else 0.0
+
+        n_nonterminals = len(grammar.nonterminals)
+        self.inside = [[self.zero] for _ in range(n_nonterminals)]
+        self.max_length = 0
+
+        # suffix[p][j][m]: the weight of rhs[j:] of production p yielding m terminals, for j >= 1.
+        # rhs[0:] is not stored, its weight at length n is only needed to fill inside[lhs][n]
+        self.suffix = [[None] + [[self.zero] for _ in range(len(rhs) - 1)] for rhs in grammar.rhs_tuples]
+
+        # unary rules A -> B stay at the same length, the nonterminals are filled in an order where B comes before A
+        unary = [[] for _ in range(n_nonterminals)]
+        self.unary_productions = [[] for _ in range(n_nonterminals)]
+        for production, rhs in enumerate(grammar.rhs_tuples):
+            if len(rhs) == 1 and rhs[0] >= 0:
+                unary[grammar.lhs[production]].append(rhs[0])
+                self.unary_productions[grammar.lhs[production]].append(production)
+
+        self.unary_components = _strongly_connected_components(unary)
+        self.unary_cyclic = [len(component) > 1 or component[0] in unary[component[0]] for component in self.unary_components]
+        if self.exact and any(self.unary_cyclic):
+            raise ValueError("The grammar has a cycle of unary rules, so there are infinitely many derivations.")
+
+        self._choices = {}
+
+    def symbol(self, symbol: int, length: int):
+        """The inside weight of a right-hand side symbol, a terminal yields exactly one terminal."""
+        if symbol >= 0:
+            return self.inside[symbol][length]
+        return 1 if length == 1 else self.zero
+
+    def rhs(self, production: int, start: int, length: int):
+        """The inside weight of `rhs[start:]` of a production."""
+        if start == len(self.grammar.rhs_tuples[production]) - 1:
+            return self.symbol(self.grammar.rhs_tuples[production][start], length)
+        if start == 0:
+            return self._split_total(production, 0, length)
+        return self.suffix[production][start][length]
+
+    def _split_total(self, production: int, start: int, length: int):
+        rhs = self.grammar.rhs_tuples[production]
+        rest = self.suffix[production][start + 1] if start + 1 < len(rhs) - 1 else None
+        total = self.zero
+        for i in range(1, length - (len(rhs) - start - 1) + 1):
+            head = self.symbol(rhs[start], i)
+            if head:
+                tail = rest[length - i] if rest is not None else self.symbol(rhs[-1], length - i)
+                total += head * tail
+        return total
+
+    def extend(self, max_length: int):
+        """Fill the table up to `max_length` terminals."""
+
+        grammar = self.grammar
+        weights = self.weights
+
+        for length in range(self.max_length + 1, max_length + 1):
+
+            # the suffixes only need shorter lengths, fill them from the back
+            for production, rhs in enumerate(grammar.rhs_tuples):
+                for start in range(len(rhs) - 2, 0, -1):
+                    self.suffix[production][start].append(self._split_total(production, start, length))
+
+            # productions that are not unary only need shorter lengths as well
+            direct = [self.zero] * len(grammar.nonterminals)
+            for production, rhs in enumerate(grammar.rhs_tuples):
+                if len(rhs) == 1 and rhs[0] >= 0:
+                    continue
+                direct[grammar.lhs[production]] += weights[production] * self.rhs(production, 0, length)
+
+            for symbol in range(len(grammar.nonterminals)):
+                self.inside[symbol].append(direct[symbol])
+
+            # unary rules, dependencies first. A cycle of unary rules is a linear system
+            for component, cyclic in zip(self.unary_components, self.unary_cyclic):
+                if not cyclic:
+                    symbol = component[0]
+                    for production in self.unary_productions[symbol]:
+                        self.inside[symbol][length] += weights[production] * self.inside[grammar.rhs_tuples[production][0]][length]
+                    continue
+
+                index = {symbol: i for i, symbol in enumerate(component)}
+                matrix = np.eye(len(component))
+                vector = np.array([direct[symbol] for symbol in component], dtype=np.float64)
+                for i, symbol in enumerate(component):
+                    for production in self.unary_productions[symbol]:
+                        child = grammar.rhs_tuples[production][0]
+                        if child in index:
+                            matrix[i, index[child]] -= weights[production]
+                        else:
+                            vector[i] += weights[production] * self.inside[child][length]
+                for symbol, value in zip(component, np.linalg.solve(matrix, vector)):
+                    self.inside[symbol][length] = float(value)
+
+            self.max_length = length
+
+    def _cumulative(self, key, options) -> tuple[list, list]:
+        """The choices with a non-zero weight and their cumulative weights, built from `options()` once per key."""
+
+        choices = self._choices.get(key)
+        if choices is None:
+            values, cumulative, total = [], [], self.zero
+            for value, weight in options():
+                if weight:
+                    total += weight
+                    values.append(value)
+                    cumulative.append(total)
+            choices = self._choices[key] = (values, cumulative)
+        return choices
+
+    def choose(self, key, options, rng=random):
+        """
+        Pick one of the choices of `options()`, a list of `(choice, weight)`, proportionally to its weight.\\
+        `key` identifies the list, it is only built the first time. Returns None if all weights are zero.
+        """
+
+        values, cumulative = self._cumulative(key, options)
+        if not values:
+            return None
+
+        total = cumulative[-1]
+        if self.exact:
+            index = bisect_right(cumulative, rng.randrange(total))
+        else:
+            index = min(bisect_right(cumulative, rng.random() * total), len(values) - 1)
+
+        return values[index]
+
+    def sample(self, symbol: int, length: int, rng=random, productions: list | None = None) -> list[int]:
+        """
+        Sample a derivation of `symbol` with exactly `length` terminals and return the terminal ids.\\
+        Every node of the derivation makes one weighted choice with a binary search, O(n log n) for a sentence of n terminals.
+        - productions (`list`): append the productions of the derivation to it, in preorder
+        """
+
+        grammar = self.grammar
+        if length > self.max_length:
+            self.extend(length)
+        if not self.symbol(symbol, length):
+            raise ValueError(f"The grammar generates no sentence with {length} terminals.")
+
+        sentence = []
+        stack = [(symbol, length)]
+        while stack:
+            symbol, length = stack.pop()
+            if symbol < 0:
+                sentence.append(~symbol)
+                continue
+
+            production = self.choose(('production', symbol, length), lambda: [
+                (p, self.weights[p] * self.rhs(p, 0, length))
+                for p in range(grammar.prod_offsets[symbol], grammar.prod_offsets[symbol + 1])
+            ], rng)
+            if productions is not None:
+                productions.append(production)
+
+            # split the length among the symbols of the right-hand side, left to right
+            rhs = grammar.rhs_tuples[production]
+            children = []
+            for start in range(len(rhs) - 1):
+                head = self.choose(('split', production, start, length), lambda: [
+                    (i, self.symbol(rhs[start], i) * self.rhs(production, start + 1, length - i))
+                    for i in range(1, length - (len(rhs) - start - 1) + 1)
+                ], rng)
+                children.append((rhs[start], head))
+                length -= head
+            children.append((rhs[-1], length))
+
+            stack.extend(reversed(children))
+
+        return sentence
+
+
+def normalized_weights(grammar: CompiledGrammar) -> list[float]:
+    """The production probabilities of the samplers: PCFG probabilities normalized per nonterminal, uniform for a CFG."""
+
+    weights = []
+    for symbol in range(len(grammar.nonterminals)):
+        lo, hi = grammar.prod_offsets[symbol], grammar.prod_offsets[symbol + 1]
+        for production in range(lo, hi):
+            if grammar.probs is None:
+                weights.append(1.0 / (hi - lo))
+            else:
+                weights.append(grammar.probs[production] / grammar.cum_weights[hi - 1])
+
+    return weights
+
+
+def get_length_table(grammar: CompiledGrammar) -> LengthTable:
+    """Return the table of length probabilities of a compiled grammar, it is built on first use."""
+
+    table = grammar.cache.get('length_table')
+    if table is None:
+        table = grammar.cache['length_table'] = LengthTable(grammar, normalized_weights(grammar))
+
+    return table
+
+
+def get_count_table(grammar: CompiledGrammar) -> LengthTable:
+    """Return the table of derivation counts of a compiled grammar (every production has weight 1), it is built on first use."""
+
+    table = grammar.cache.get('count_table')
+    if table is None:
+        table = grammar.cache['count_table'] = LengthTable(grammar, [1] * grammar.n_productions)
+
+    return table
+
+
+def sample_length(table: LengthTable, symbol: int, min_length: int, max_length: int, rng=random) -> int:
+    """Pick a length in `min_length..max_length`, weighted by the inside weights of `symbol`."""
+
+    if min_length < 1 or max_length < min_length:
+        raise ValueError(f"Invalid length range {min_length}..{max_length}.")
+
+    if max_length > table.max_length:
+        table.extend(max_length)
+
+    length = table.choose(('length', symbol, min_length, max_length), lambda: [
+        (n, table.symbol(symbol, n)) for n in range(min_length, max_length + 1)
+    ], rng)
+    if length is None:
+        raise ValueError(f"The grammar generates no sentence with {min_length} to {max_length} terminals.")
+
+    return length
+
+
+def derive_length(grammar: CompiledGrammar, length: int | None = None, min_length: int | None = None,
+                  max_length: int | None = None, rng=random, table: LengthTable | None = None,
+                  productions: list | None = None) -> list[int]:
+    """
+    Derive a sentence conditioned on its length: exactly `length` terminals, or between `min_length` and `max_length`.\\
+    The sentence follows the distribution of the samplers conditioned on the length, without any rejections.
+    - table (`LengthTable`): the weights to sample with, by default `get_length_table(grammar)`.
+    With `get_count_table(grammar)` every derivation of the length is equally likely.
+    - productions (`list`): append the productions of the derivation to it, in preorder
+    """
+
+    if table is None:
+        table = get_length_table(grammar)
+
+    if length is not None and (min_length is not None or max_length is not None):
+        raise ValueError("Pass either `length` or `min_length` and `max_length`, not both.")
+
+    if length is None:
+        if max_length is None:
+            raise ValueError("Conditioning on the length needs `length` or `max_length`.")
+        length = sample_length(table, grammar.start, min_length or 1, max_length, rng)
+
+    return table.sample(grammar.start, length, rng, productions)
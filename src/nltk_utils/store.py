@@ -0,0 +1,331 @@
+import hashlib
+import json
+import math
+import mmap
+import os
+import sqlite3
+import struct
+from datetime import datetime, timezone
+
+import numpy as np
+
+from nltk_utils.canonical import canonical_hash
+from nltk_utils.graphs import get_grammar_analysis
+from nltk_utils.pcfg.analysis import expected_length, termination_probabilities
+from nltk_utils.utils import CompiledGrammar, compile_grammar, register_compiled
+
+# Storing compiled grammars.
+# A `.grammar` file holds a compiled grammar in a form that is loaded without parsing:
+#   b'CGRAMMAR' | header length (uint64, little endian) | JSON header | arrays
+# The header has the symbol names, the start symbol, the content hash and, for every array, its dtype, length
+# and byte offset in the file. The arrays are 8-byte aligned, so they are mapped straight into NumPy with mmap.
+# The checksum in the header covers the content hash, the symbols and the bytes of the arrays, so a file is verified
+# without formatting the grammar.
+# A `GrammarCatalog` is an SQLite index over stored grammars: content hash, canonical hash, sizes and computed properties.
+
+MAGIC = b'CGRAMMAR'
+FORMAT_VERSION = 1
+
+
+def _align(n: int) -> int:
+    return (n + 7) // 8 * 8
+
+
+def _checksum(header: dict, arrays: dict[str, np.ndarray]) -> str:
+    """The hash of the content hash, the kind and the symbols of a header and the bytes of its arrays."""
+
+    fields = [header['content_hash'], header['probabilistic'], header['start'], header['nonterminals'], header['terminals']]
+    digest = hashlib.sha1(json.dumps(fields).encode('utf-8'))
+    for name in sorted(arrays):
+        digest.update(name.encode('utf-8'))
+        digest.update(arrays[name].data)
+    return digest.hexdigest()
+
+
+def save_compiled(grammar: str | CompiledGrammar, path: str) -> None:
+    """
+    Write a compiled grammar to a `.grammar` file, see `load_compiled`.\\
+    The file is written next to `path` and moved in place, so a reader never sees a half-written grammar.
+    """
+
+    grammar = compile_grammar(grammar)
+
+    arrays = {
+        'lhs': np.array(grammar.lhs, dtype='<i4'),
+        'rhs_offsets': np.array(grammar.rhs_offsets, dtype='<i8'),
+        'rhs': np.array(grammar.rhs, dtype='<i4'),
+    }
+    if grammar.is_probabilistic:
+        arrays['probs'] = np.array(grammar.probs, dtype='<f8')
+
+    header = {
+        'version': FORMAT_VERSION,
+        'content_hash': grammar.content_hash,
+        'probabilistic': grammar.is_probabilistic,
+        'start': grammar.start,
+        'nonterminals': grammar.nonterminals,
+        'terminals': grammar.terminals,
+        'arrays': {},
+    }
+    header['checksum'] = _checksum(header, arrays)
+
+    # the offsets depend on the length of the header, which contains them: lay out the arrays after a header
+    # that is large enough, and pad the header with spaces to that size
+    size = 0
+    while True:
+        offset = _align(len(MAGIC) + 8 + size)
+        for name, array in arrays.items():
+            header['arrays'][name] = {'dtype': array.dtype.str, 'length': len(array), 'offset': offset}
+            offset = _align(offset + array.nbytes)
+        encoded = json.dumps(header).encode('utf-8')
+        if len(encoded) <= size:
+            break
+        size = _align(len(encoded))
+    encoded = encoded.ljust(size)
+
+    temporary = f'{path}.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(MAGIC + struct.pack('<Q', len(encoded)) + encoded)
+        for name, array in arrays.items():
+            f.write(b'\0' * (header['arrays'][name]['offset'] - f.tell()))
+            f.write(array.tobytes())
+    os.replace(temporary, path)
+
+
+def load_arrays(path: str) -> tuple[dict, dict[str, np.ndarray]]:
+    """
+    Map a `.grammar` file into memory and return its header and its arrays.\\
+    The arrays are read-only views of the mapped file, nothing is parsed or copied.
+    """
+
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if buffer[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not a compiled grammar file.")
+
+    (length,) = struct.unpack_from('<Q', buffer, len(MAGIC))
+    header = json.loads(buffer[len(MAGIC) + 8:len(MAGIC) + 8 + length])
+    if header['version'] != FORMAT_VERSION:
+        raise ValueError(f"{path} has format version {header['version']}, only version {FORMAT_VERSION} is supported.")
+
+    arrays = {
+        name: np.frombuffer(buffer, dtype=spec['dtype'], count=spec['length'], offset=spec['offset'])
+        for name, spec in header['arrays'].items()
+    }
+
+    return header, arrays
+
+
+def load_compiled(path: str) -> CompiledGrammar:
+    """
+    Load a grammar written by `save_compiled`, without parsing it.\\
+    Only `load_arrays` is zero-copy: the mapped arrays are copied into the lists of the `CompiledGrammar`,
+    which is O(size) in Python objects, but much cheaper than parsing the text.
+    The grammar is put into the compiled grammar cache, so later calls with its text are not parsed either.
+    The content hash is taken from the file, the grammar is never formatted: the file is verified by its checksum.
+    Raises a ValueError if the checksum does not match the file. Files without a checksum
+    are verified by formatting the grammar and comparing its content hash.
+    """
+
+    header, arrays = load_arrays(path)
+
+    checksum = header.get('checksum')
+    if checksum is not None and checksum != _checksum(header, arrays):
+        raise ValueError(f"{path} is corrupted, its checksum does not match.")
+
+    grammar = CompiledGrammar(
+        header['nonterminals'], header['terminals'], header['start'],
+        arrays['lhs'].tolist(), arrays['rhs_offsets'].tolist(), arrays['rhs'].tolist(),
+        arrays['probs'].tolist() if header['probabilistic'] else None,
+        content_hash=header['content_hash'] if checksum is not None else None,
+    )
+
+    if grammar.content_hash != header['content_hash']:
+        raise ValueError(f"{path} is corrupted, its content hash does not match.")
+
+    register_compiled(None, grammar)
+    return grammar
+
+
+def grammar_sizes(grammar: str | CompiledGrammar) -> tuple[int, int, int]:
+    """
+    The `(n_terminals, n_nonterminals, n_rules)` of a grammar as in the file names of `save_grammar`:
+    the start symbol and the start rule are not counted.
+    """
+
+    grammar = compile_grammar(grammar)
+    n_nonterminals = len(set(grammar.lhs)) - 1
+    return len(grammar.terminals), n_nonterminals, grammar.n_productions - 1
+
+
+def _add_columns(connection: sqlite3.Connection, table: str, columns: dict[str, str]) -> list[str]:
+    """Add the columns (name -> type) that an existing table does not have yet. Returns the names of the added columns."""
+
+    existing = {row[1] for row in connection.execute(f'PRAGMA table_info({table})')}
+    added = [column for column in columns if column not in existing]
+    for column in added:
+        connection.execute(f'ALTER TABLE {table} ADD COLUMN {column} {columns[column]}')
+    return added
+
+
+class GrammarCatalog:
+    """
+    A local SQLite catalog of stored grammars.\\
+    Every grammar is stored once, as `{directory}/{content_hash}.grammar`, and indexed by its content hash,
+    its `canonical_hash` (the same for grammars that only differ in the names of their symbols, see `find_isomorphic`),
+    its sizes (see `grammar_sizes`) and properties computed when it is added:
+    `transient`, `productive` (no unproductive nonterminals), and for a PCFG the `termination_probability`
+    and `expected_length` (`NULL` if it is infinite).
+    - path (`str`): the SQLite database, created if it does not exist
+    - directory (`str`): where the grammar files go, by default `compiled/` next to the database
+    """
+
+    columns = ('content_hash', 'path', 'n_terminals', 'n_nonterminals', 'n_rules', 'n_productions', 'probabilistic',
+               'transient', 'productive', 'termination_probability', 'expected_length', 'added', 'params', 'canonical_hash')
+
+    def __init__(self, path: str = 'grammars/catalog.sqlite', directory: str | None = None):
+
+        if directory is None:
+            directory = os.path.join(os.path.dirname(path), 'compiled')
+
+        self.path = path
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS grammars (
+                    content_hash TEXT PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    n_terminals INTEGER NOT NULL,
+                    n_nonterminals INTEGER NOT NULL,
+                    n_rules INTEGER NOT NULL,
+                    n_productions INTEGER NOT NULL,
+                    probabilistic INTEGER NOT NULL,
+                    transient INTEGER NOT NULL,
+                    productive INTEGER NOT NULL,
+                    termination_probability REAL,
+                    expected_length REAL,
+                    added TEXT NOT NULL,
+                    params TEXT,
+                    canonical_hash TEXT
+                )""")
+            # catalogs from before the canonical hash get the column, filled from their stored grammars
+            if _add_columns(self.connection, 'grammars', {'canonical_hash': 'TEXT'}):
+                for row in self.connection.execute('SELECT content_hash, path FROM grammars').fetchall():
+                    grammar = load_compiled(os.path.join(os.path.dirname(path), row['path']))
+                    self.connection.execute('UPDATE grammars SET canonical_hash = ? WHERE content_hash = ?',
+                                            (canonical_hash(grammar), row['content_hash']))
+            self.connection.execute("CREATE INDEX IF NOT EXISTS grammars_sizes ON grammars (n_nonterminals, n_terminals, n_rules)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS grammars_transient ON grammars (transient, n_nonterminals)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS grammars_canonical ON grammars (canonical_hash)")
+
+    def add(self, grammar: str | CompiledGrammar, params: dict | None = None) -> str:
+        """
+        Store a grammar and index it. A grammar that is already in the catalog is not stored again.
+        Returns its content hash.
+        - params (`dict`): anything to keep with the grammar, e.g. the parameters it was generated with, stored as JSON
+        """
+
+        grammar = compile_grammar(grammar)
+        if grammar.content_hash in self:
+            return grammar.content_hash
+
+        path = os.path.join(self.directory, f'{grammar.content_hash}.grammar')
+        save_compiled(grammar, path)
+
+        analysis = get_grammar_analysis(grammar, start=grammar.nonterminals[grammar.start])
+        n_terminals, n_nonterminals, n_rules = grammar_sizes(grammar)
+
+        termination, length = None, None
+        if grammar.is_probabilistic:
+            termination = float(termination_probabilities(grammar)[grammar.start])
+            length = expected_length(grammar)
+            length = length if math.isfinite(length) else None
+
+        with self.connection:
+            self.connection.execute(
+                f"INSERT INTO grammars ({', '.join(self.columns)}) VALUES ({', '.join('?' * len(self.columns))})",
+                (grammar.content_hash, os.path.relpath(path, os.path.dirname(self.path) or '.'), n_terminals, n_nonterminals,
+                 n_rules, grammar.n_productions, grammar.is_probabilistic, analysis.transient, not analysis.unproductive,
+                 termination, length, datetime.now(timezone.utc).isoformat(), None if params is None else json.dumps(params),
+                 canonical_hash(grammar)),
+            )
+
+        return grammar.content_hash
+
+    def query(self, limit: int | None = None, min_expected_length: float | None = None,
+              max_expected_length: float | None = None, **conditions) -> list[dict]:
+        """
+        Return the catalog rows that match all conditions, in the order the grammars were added.\\
+        Conditions are columns and values, e.g. `catalog.query(transient=True, n_nonterminals=10)`.
+        """
+
+        clauses, values = [], []
+        for column, value in conditions.items():
+            if column not in self.columns:
+                raise ValueError(f"Unknown column '{column}', choose one of {list(self.columns)}.")
+            clauses.append(f'{column} = ?')
+            values.append(value)
+        if min_expected_length is not None:
+            clauses.append('expected_length >= ?')
+            values.append(min_expected_length)
+        if max_expected_length is not None:
+            clauses.append('expected_length <= ?')
+            values.append(max_expected_length)
+
+        sql = 'SELECT * FROM grammars'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY rowid'
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+
+        rows = []
+        for row in self.connection.execute(sql, values):
+            row = dict(row)
+            for column in ('probabilistic', 'transient', 'productive'):
+                row[column] = bool(row[column])
+            row['params'] = None if row['params'] is None else json.loads(row['params'])
+            rows.append(row)
+        return rows
+
+    def find_isomorphic(self, grammar: str | CompiledGrammar) -> str | None:
+        """
+        The content hash of a stored grammar that is the same as `grammar` up to renaming its symbols
+        and reordering its rules, or None. This is an index lookup, see `nltk_utils.canonical`.
+        """
+
+        row = self.connection.execute('SELECT content_hash FROM grammars WHERE canonical_hash = ? ORDER BY rowid LIMIT 1',
+                                      (canonical_hash(grammar),)).fetchone()
+        return None if row is None else row['content_hash']
+
+    def canonical_hashes(self) -> set[str]:
+        """The canonical hashes of all stored grammars, to check many grammars against the catalog without a query each."""
+        return {row['canonical_hash'] for row in self.connection.execute('SELECT canonical_hash FROM grammars')}
+
+    def load(self, content_hash: str) -> CompiledGrammar:
+        """Load a stored grammar by its content hash."""
+
+        row = self.connection.execute('SELECT path FROM grammars WHERE content_hash = ?', (content_hash,)).fetchone()
+        if row is None:
+            raise KeyError(content_hash)
+        return load_compiled(os.path.join(os.path.dirname(self.path), row['path']))
+
+    def __contains__(self, content_hash: str) -> bool:
+        return self.connection.execute('SELECT 1 FROM grammars WHERE content_hash = ?', (content_hash,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        return self.connection.execute('SELECT COUNT(*) FROM grammars').fetchone()[0]
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self) -> 'GrammarCatalog':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
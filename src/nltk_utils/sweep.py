@@ -0,0 +1,302 @@
+import itertools
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone
+
+from nltk_utils.canonical import GrammarSet, canonical_hash
+from nltk_utils.graphs import is_transient
+from nltk_utils.pcfg.analysis import can_sample, can_sample_many
+from nltk_utils.pcfg.generate import generate_pcfg_compiled
+from nltk_utils.store import GrammarCatalog, _add_columns
+from nltk_utils.utils import generate_nonterminals, generate_terminals
+
+# Parameter sweeps over the standardized PCFGs of `save_grammar_standardized_pcfg`.
+# Every cell of the grid (n_terminals, n_nonterminals, n_rules, prob_terminal) is one task of a process pool: it generates
+# grammars in batches, validates every batch at once (transient, and `can_sample_many`) and returns the accepted grammars
+# with its acceptance rate and timings. The grammars go into a `GrammarCatalog`, the cell stats into the table
+# `sweep_cells` of the same database, so a sweep has a single output and cells that are in it are skipped when it is run again.
+# Grammars that are the same up to renaming their symbols are only kept once, by their canonical hash (see `nltk_utils.canonical`).
+#
+#   grid = {'n_terminals': [5, 10], 'n_nonterminals': [5, 10], 'n_rules': [10, 30], 'prob_terminal': [0.3, 0.5]}
+#   run_sweep(grid, grammars_per_cell=100, catalog='grammars/catalog.sqlite', n_workers=8)
+
+PARAMETERS = ('n_terminals', 'n_nonterminals', 'n_rules', 'prob_terminal')
+
+
+def grid_cells(grid: dict) -> list[tuple]:
+    """
+    The cells of a parameter grid, every combination of the values of `PARAMETERS`.\\
+    A parameter may be given as a single value instead of a list.
+    """
+
+    unknown = set(grid) - set(PARAMETERS)
+    if unknown:
+        raise ValueError(f"Unknown sweep parameters {sorted(unknown)}, choose from {list(PARAMETERS)}.")
+    missing = [parameter for parameter in PARAMETERS if parameter not in grid]
+    if missing:
+        raise ValueError(f"The grid has no values for {missing}.")
+
+    values = [grid[parameter] if isinstance(grid[parameter], (list, tuple)) else [grid[parameter]] for parameter in PARAMETERS]
+    return list(itertools.product(*values))
+
+
+def cell_key(cell: tuple) -> str:
+    """The name of a cell, `{n_terminals}_{n_nonterminals}_{n_rules}_{prob_terminal}`, like the suffixes of `save_grammar`."""
+    return '_'.join(str(value) for value in cell)
+
+
+def validate_grammar(grammar) -> bool:
+    """A grammar is accepted by a sweep if it is transient and `can_sample` passes."""
+    return is_transient(grammar) and can_sample(grammar)
+
+
+def validate_grammars(grammars: list) -> list[bool]:
+    """
+    `validate_grammar` for a batch of grammars.\\
+    The transient check is a graph search per grammar, the analysis of `can_sample` runs on all transient grammars at once.
+    """
+
+    transient = [is_transient(grammar) for grammar in grammars]
+    samplable = iter(can_sample_many([grammar for grammar, is_valid in zip(grammars, transient) if is_valid]))
+    return [is_valid and bool(next(samplable)) for is_valid in transient]
+
+
+def run_cell(cell: tuple, grammars_per_cell: int, seed=None, batch_size: int = 16, max_attempts: int | None = None,
+             method: str = 'constructive', unique: bool = True, known: set[str] | None = None) -> dict:
+    """
+    Generate the grammars of one cell until `grammars_per_cell` of them are accepted, or `max_attempts` were tried.\\
+    Grammars are generated a batch at a time and the batch is validated afterwards with `validate_grammars`,
+    so generation and validation are timed separately. Only the grammars up to the one that fills the cell count as attempts.
+    The random generator is seeded with `f'{seed}:{cell_key(cell)}'`, so a cell gives the same grammars
+    no matter which worker runs it. If `seed` is `None`, it is drawn from the `random` module.
+    A cell whose parameters are invalid is returned with an `error`.
+    With `unique`, a valid grammar that is the same as an accepted one up to renaming is counted as a duplicate instead,
+    and so is a grammar whose canonical hash is in `known` (e.g. the grammars of a catalog), so the cell keeps sampling
+    until it has `grammars_per_cell` new grammars.
+    Returns the cell stats, with the accepted grammars under `'grammars'` and their canonical hashes under `'canonical_hashes'`.
+    """
+
+    n_terminals, n_nonterminals, n_rules, prob_terminal = cell
+    if max_attempts is None:
+        max_attempts = 100 * grammars_per_cell
+
+    if seed is None:
+        seed = random.getrandbits(64)
+    rng = random.Random(f'{seed}:{cell_key(cell)}')
+    terminals = generate_terminals(n_terminals)
+    nonterminals = generate_nonterminals(n_nonterminals)
+
+    grammars = []
+    seen = GrammarSet()
+    attempts = duplicates = 0
+    generation_seconds = validation_seconds = 0.0
+    error = None
+    start_time = time.perf_counter()
+
+    try:
+        while len(grammars) < grammars_per_cell and attempts < max_attempts:
+            size = min(batch_size, max_attempts - attempts)
+
+            batch_start = time.perf_counter()
+            batch = [generate_pcfg_compiled(terminals, nonterminals, n_rules, prob_terminal, method=method, rng=rng)
+                     for _ in range(size)]
+            generation_seconds += time.perf_counter() - batch_start
+
+            batch_start = time.perf_counter()
+            valid = validate_grammars(batch)
+            for grammar, is_valid in zip(batch, valid):
+                attempts += 1
+                if is_valid:
+                    if unique:
+                        duplicate = grammar in seen or (known is not None and canonical_hash(grammar) in known)
+                        if duplicate:
+                            duplicates += 1
+                            continue
+                        seen.add(grammar)
+                    grammars.append(grammar.to_string())
+                    if len(grammars) == grammars_per_cell:
+                        break
+            validation_seconds += time.perf_counter() - batch_start
+
+    except (AssertionError, ValueError) as e:
+        error = str(e)
+
+    return {
+        'cell': cell_key(cell),
+        **dict(zip(PARAMETERS, cell)),
+        'requested': grammars_per_cell,
+        'accepted': len(grammars),
+        'attempts': attempts,
+        'duplicates': duplicates,
+        'acceptance_rate': len(grammars) / attempts if attempts else 0.0,
+        'generation_seconds': generation_seconds,
+        'validation_seconds': validation_seconds,
+        'seconds': time.perf_counter() - start_time,
+        'error': error,
+        'grammars': grammars,
+        'canonical_hashes': [canonical_hash(grammar) if unique else None for grammar in grammars],
+    }
+
+
+def _create_tables(catalog: GrammarCatalog) -> None:
+    with catalog.connection:
+        catalog.connection.execute("""
+            CREATE TABLE IF NOT EXISTS sweep_cells (
+                cell TEXT PRIMARY KEY,
+                n_terminals INTEGER NOT NULL,
+                n_nonterminals INTEGER NOT NULL,
+                n_rules INTEGER NOT NULL,
+                prob_terminal REAL NOT NULL,
+                seed TEXT,
+                requested INTEGER NOT NULL,
+                accepted INTEGER NOT NULL,
+                attempts INTEGER NOT NULL,
+                duplicates INTEGER NOT NULL DEFAULT 0,
+                acceptance_rate REAL NOT NULL,
+                generation_seconds REAL NOT NULL,
+                validation_seconds REAL NOT NULL,
+                seconds REAL NOT NULL,
+                error TEXT,
+                finished TEXT NOT NULL
+            )""")
+        _add_columns(catalog.connection, 'sweep_cells', {'duplicates': 'INTEGER NOT NULL DEFAULT 0'})
+        # the grammars of a cell in the order they were accepted, a grammar can be in several cells
+        catalog.connection.execute("""
+            CREATE TABLE IF NOT EXISTS sweep_grammars (
+                cell TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                content_hash TEXT NOT NULL,
+                PRIMARY KEY (cell, position)
+            )""")
+
+
+def _finished_cells(catalog: GrammarCatalog) -> set[str]:
+    return {row['cell'] for row in catalog.connection.execute('SELECT cell FROM sweep_cells')}
+
+
+def _store_cell(catalog: GrammarCatalog, result: dict, seed, unique: bool) -> None:
+    """
+    Add the grammars of a cell to the catalog, then its stats. A cell is only finished once its stats are written.\\
+    With `unique`, grammars that are already in the catalog up to renaming are dropped and counted as duplicates.
+    The cells skip the grammars that were in the catalog when they started, so this only drops grammars
+    that a cell running at the same time stored first.
+    """
+
+    params = {parameter: result[parameter] for parameter in PARAMETERS}
+    grammars, hashes = [], []
+    for grammar in result['grammars']:
+        if unique and catalog.find_isomorphic(grammar) is not None:
+            result['duplicates'] += 1
+            continue
+        grammars.append(grammar)
+        hashes.append(catalog.add(grammar, params={**params, 'cell': result['cell'], 'seed': seed}))
+
+    result['grammars'] = grammars
+    result['accepted'] = len(grammars)
+    result['acceptance_rate'] = len(grammars) / result['attempts'] if result['attempts'] else 0.0
+
+    stats = {key: value for key, value in result.items() if key not in ('grammars', 'canonical_hashes')}
+    stats['seed'] = None if seed is None else str(seed)
+    stats['finished'] = datetime.now(timezone.utc).isoformat()
+
+    with catalog.connection:
+        catalog.connection.executemany(
+            'INSERT OR REPLACE INTO sweep_grammars (cell, position, content_hash) VALUES (?, ?, ?)',
+            [(result['cell'], position, content_hash) for position, content_hash in enumerate(hashes)],
+        )
+        catalog.connection.execute(
+            f"INSERT OR REPLACE INTO sweep_cells ({', '.join(stats)}) VALUES ({', '.join('?' * len(stats))})",
+            list(stats.values()),
+        )
+
+
+def run_sweep(grid: dict, grammars_per_cell: int = 10, catalog: str | GrammarCatalog = 'grammars/catalog.sqlite',
+              n_workers: int = 1, seed=None, batch_size: int = 16, max_attempts: int | None = None,
+              method: str = 'constructive', unique: bool = True) -> list[dict]:
+    """
+    Run a parameter sweep, see the top of this module. Returns the stats of the cells that were run, in grid order.
+    - grid (`dict`): a list of values (or a single value) for every parameter in `PARAMETERS`
+    - grammars_per_cell (`int`): the number of accepted grammars every cell should have
+    - catalog (`str | GrammarCatalog`): the output, a catalog or the path of its database.
+    Cells that already have stats in it are skipped, delete their rows in `sweep_cells` to run them again.
+    - n_workers (`int`): the number of worker processes, 1 runs every cell in this process
+    - seed: the seed of the sweep, every cell is seeded from it and its parameters, see `run_cell`.
+    If `None`, it is drawn from the `random` module and stored with the stats of the cells.
+    - batch_size (`int`): the number of grammars generated before a batch is validated
+    - max_attempts (`int`): the number of grammars a cell tries at most, by default `100 * grammars_per_cell`
+    - method (`str`): the generation method of `generate_pcfg_compiled`
+    - unique (`bool`): keep every grammar only once up to renaming its symbols, in its cell and in the whole catalog.
+    A cell skips the grammars that are in the catalog when it starts and keeps sampling until it is full.
+    Cells are stored in grid order, so a grammar that two cells running at the same time find is kept by the earlier one,
+    the later cell then has fewer grammars than requested.
+    """
+
+    from tqdm import tqdm
+
+    owned = not isinstance(catalog, GrammarCatalog)
+    if owned:
+        catalog = GrammarCatalog(catalog)
+
+    try:
+        _create_tables(catalog)
+
+        finished = _finished_cells(catalog)
+        cells = [cell for cell in grid_cells(grid) if cell_key(cell) not in finished]
+        skipped = len(grid_cells(grid)) - len(cells)
+        if skipped:
+            print(f"Skipping {skipped} cells that are already in {catalog.path}")
+
+        if seed is None:
+            seed = random.getrandbits(64)
+
+        # the canonical hashes of the catalog, every cell skips these grammars
+        known = catalog.canonical_hashes() if unique else None
+        arguments = (grammars_per_cell, seed, batch_size, max_attempts, method, unique)
+        results = {}
+
+        if n_workers <= 1:
+            for cell in tqdm(cells, desc="Sweeping cells"):
+                results[cell] = run_cell(cell, *arguments, known)
+                _store_cell(catalog, results[cell], seed, unique)
+                if unique:
+                    known.update(results[cell]['canonical_hashes'])
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                futures = {executor.submit(run_cell, cell, *arguments, known): cell for cell in cells}
+                stored = 0
+                for future in tqdm(as_completed(futures), total=len(futures), desc="Sweeping cells"):
+                    results[futures[future]] = future.result()
+                    # store the finished cells in grid order
+                    while stored < len(cells) and cells[stored] in results:
+                        _store_cell(catalog, results[cells[stored]], seed, unique)
+                        stored += 1
+
+        return [{key: value for key, value in results[cell].items() if key not in ('grammars', 'canonical_hashes')} for cell in cells]
+
+    finally:
+        if owned:
+            catalog.close()
+
+
+def sweep_stats(catalog: str | GrammarCatalog = 'grammars/catalog.sqlite') -> list[dict]:
+    """The stats of every finished cell of the sweeps in a catalog, in the order they finished."""
+
+    owned = not isinstance(catalog, GrammarCatalog)
+    if owned:
+        catalog = GrammarCatalog(catalog)
+
+    try:
+        _create_tables(catalog)
+        return [dict(row) for row in catalog.connection.execute('SELECT * FROM sweep_cells ORDER BY rowid')]
+    finally:
+        if owned:
+            catalog.close()
+
+
+def sweep_grammars(catalog: GrammarCatalog, cell: str) -> list[str]:
+    """The content hashes of the grammars of a cell, in the order they were accepted, see `GrammarCatalog.load`."""
+
+    _create_tables(catalog)
+    rows = catalog.connection.execute('SELECT content_hash FROM sweep_grammars WHERE cell = ? ORDER BY position', (cell,))
+    return [row['content_hash'] for row in rows]
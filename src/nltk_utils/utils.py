@@ -1,4 +1,20 @@
-import nltk
+from __future__ import annotations
+
+import hashlib
+import random
+import re
+import sys
+import time
+from bisect import bisect
+from decimal import Decimal
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+from nltk_utils import instrumentation
+
+# nltk is slow to import, it is only loaded when nltk objects or parsers are asked for
+if TYPE_CHECKING:
+    import nltk
 
 def generate_nonterminals(n: int, start='S') -> list[str]:
     """
@@ -21,41 +37,519 @@ def generate_terminals(n: int) -> list[str]:
     """
     return [chr(97+i) for i in range(n)]
 
-def to_pcfg(grammar: str | nltk.PCFG) -> nltk.PCFG:
+def format_probability(prob: float) -> str:
+    """
+    Format a probability for a grammar string, i.e. `0.25`.\\
+    nltk can't read scientific notation, so small probabilities are written out: `1e-05` becomes `0.00001`.
+    The string always reads back as the same float.
+    """
+    text = repr(float(prob))
+    if 'e' in text:
+        text = format(Decimal(text), 'f')
+    return text
+
+class CompiledGrammar:
+    """
+    A grammar compiled into flat, integer-indexed arrays, so it never has to be parsed again.\\
+    Nonterminals are interned to `0..len(nonterminals)-1` with the start symbol at `start`,
+    terminals are interned to `0..len(terminals)-1`. On the right-hand side of a production,
+    nonterminal `i` is stored as `i` and terminal `j` as `~j` (i.e. `-j-1`), so `symbol >= 0` tells them apart.
+    - `lhs[p]`: the left-hand side of production `p`
+    - `rhs[rhs_offsets[p]:rhs_offsets[p+1]]`: the right-hand side of production `p`
+    - `prod_offsets[A]:prod_offsets[A+1]`: the productions of nonterminal `A`, in grammar order
+    - `probs[p]`: the probability of production `p` (`None` for a CFG)
+    - `cum_weights[p]`: the cumulative weight of production `p` within the productions of its nonterminal.
+    For a CFG every production has weight 1.
+    - `content_hash`: the hash of `to_string()`. It is computed unless it is passed in,
+    e.g. by `load_compiled`, which has it from the file and would otherwise format the whole grammar.
+    """
+
+    def __init__(self, nonterminals: list[str], terminals: list[str], start: int, lhs: list[int],
+                 rhs_offsets: list[int], rhs: list[int], probs: list[float] | None = None, grammar=None,
+                 content_hash: str | None = None):
+
+        self.nonterminals = list(nonterminals)
+        self.terminals = list(terminals)
+        self.start = start
+        self.lhs = list(lhs)
+        self.rhs_offsets = list(rhs_offsets)
+        self.rhs = list(rhs)
+        self.probs = None if probs is None else [float(p) for p in probs]
+
+        n_productions = len(self.lhs)
+        assert all(self.lhs[i] <= self.lhs[i+1] for i in range(n_productions - 1)), "Productions must be grouped by their left-hand side."
+
+        # the productions of every nonterminal are a contiguous range
+        self.prod_offsets = [0] * (len(self.nonterminals) + 1)
+        for symbol in self.lhs:
+            self.prod_offsets[symbol + 1] += 1
+        for i in range(len(self.nonterminals)):
+            self.prod_offsets[i + 1] += self.prod_offsets[i]
+
+        # right-hand sides as tuples, the samplers index these directly
+        self.rhs_tuples = [tuple(self.rhs[self.rhs_offsets[p]:self.rhs_offsets[p+1]]) for p in range(n_productions)]
+        self.reversed_rhs = [rhs[::-1] for rhs in self.rhs_tuples]
+
+        # cumulative weights, restarting at every nonterminal
+        self.cum_weights = [0.0] * n_productions
+        for symbol in range(len(self.nonterminals)):
+            total = 0.0
+            for p in range(self.prod_offsets[symbol], self.prod_offsets[symbol + 1]):
+                total += 1.0 if self.probs is None else self.probs[p]
+                self.cum_weights[p] = total
+
+        self.nonterminal_index = {symbol: i for i, symbol in enumerate(self.nonterminals)}
+        self.terminal_index = {symbol: i for i, symbol in enumerate(self.terminals)}
+
+        self.content_hash = grammar_hash(self.to_string()) if content_hash is None else content_hash
+
+        self._grammar = grammar
+        # the grammar string it was compiled from, the nltk object is read from it when needed
+        self._source = None
+        self._alias = None
+
+        # structures derived by other modules (parsers, samplers), built on first use
+        self.cache = {}
+
+    @classmethod
+    def from_nltk(cls, grammar: nltk.CFG | nltk.PCFG) -> 'CompiledGrammar':
+        """
+        Compile an nltk CFG or PCFG object.
+        """
+
+        import nltk
+
+        probabilistic = isinstance(grammar, nltk.PCFG)
+
+        productions = []
+        for production in grammar.productions():
+            rhs = tuple((str(symbol), nltk.grammar.is_nonterminal(symbol)) for symbol in production.rhs())
+            productions.append((str(production.lhs()), rhs, production.prob() if probabilistic else None))
+
+        return cls.from_productions(str(grammar.start()), productions, probabilistic, grammar=grammar)
+
+    @classmethod
+    def from_productions(cls, start: str, productions: list[tuple], probabilistic: bool, grammar=None) -> 'CompiledGrammar':
+        """
+        Compile a list of productions `(lhs, rhs, prob)` given in grammar order, without going through nltk.\\
+        `rhs` is a tuple of `(symbol, is_nonterminal)` pairs, `prob` is ignored for a CFG.
+        The symbols are interned like nltk would read the same grammar from a string,
+        so the result is identical to compiling the string.
+        """
+
+        # intern the nonterminals in order of appearance, starting with the start symbol
+        nonterminals = [start]
+        nonterminal_index = {start: 0}
+        terminals = []
+        terminal_index = {}
+
+        for lhs_symbol, rhs_symbols, prob in productions:
+            for symbol, is_nonterminal in ((lhs_symbol, True),) + tuple(rhs_symbols):
+                if is_nonterminal:
+                    if symbol not in nonterminal_index:
+                        nonterminal_index[symbol] = len(nonterminals)
+                        nonterminals.append(symbol)
+                elif symbol not in terminal_index:
+                    terminal_index[symbol] = len(terminals)
+                    terminals.append(symbol)
+
+        # keep the order of the productions of every nonterminal, the samplers rely on it
+        by_lhs = [[] for _ in nonterminals]
+        for production in productions:
+            by_lhs[nonterminal_index[production[0]]].append(production)
+
+        lhs, rhs, rhs_offsets, probs = [], [], [0], []
+        for index, symbol_productions in enumerate(by_lhs):
+            for lhs_symbol, rhs_symbols, prob in symbol_productions:
+                lhs.append(index)
+                for symbol, is_nonterminal in rhs_symbols:
+                    if is_nonterminal:
+                        rhs.append(nonterminal_index[symbol])
+                    else:
+                        rhs.append(~terminal_index[symbol])
+                rhs_offsets.append(len(rhs))
+                if probabilistic:
+                    probs.append(prob)
+
+        return cls(
+            nonterminals, terminals, 0, lhs, rhs_offsets, rhs,
+            probs if probabilistic else None,
+            grammar=grammar,
+        )
+
+    @property
+    def is_probabilistic(self) -> bool:
+        return self.probs is not None
+
+    @property
+    def n_productions(self) -> int:
+        return len(self.lhs)
+
+    @property
+    def grammar(self) -> nltk.CFG | nltk.PCFG:
+        """
+        The equivalent nltk CFG or PCFG object. It is only built when needed.
+        """
+
+        if self._grammar is None:
+            import nltk
+            text = self.to_string() if self._source is None else self._source
+            if self.is_probabilistic:
+                self._grammar = nltk.PCFG.fromstring(text)
+            else:
+                self._grammar = nltk.CFG.fromstring(text)
+
+        return self._grammar
+
+    def symbol_str(self, symbol: int) -> str:
+        """
+        Return the name of an interned right-hand side symbol.
+        """
+
+        if symbol >= 0:
+            return self.nonterminals[symbol]
+        return self.terminals[~symbol]
+
+    def production_str(self, production: int) -> str:
+        """
+        Format a production like a grammar rule, i.e. `A -> "a" B [0.5]`.
+        """
+
+        rhs = []
+        for symbol in self.rhs_tuples[production]:
+            if symbol >= 0:
+                rhs.append(self.nonterminals[symbol])
+            else:
+                terminal = self.terminals[~symbol]
+                rhs.append(f"'{terminal}'" if '"' in terminal else f'"{terminal}"')
+
+        rule = f'{self.nonterminals[self.lhs[production]]} -> {" ".join(rhs)}'
+        if self.is_probabilistic:
+            rule += f' [{format_probability(self.probs[production])}]'
+
+        return rule
+
+    def to_string(self) -> str:
+        """
+        Format the grammar in the string format used throughout this package.
+        The productions of the start symbol come first.
+        """
+
+        order = list(range(self.prod_offsets[self.start], self.prod_offsets[self.start + 1]))
+        order += [p for p in range(self.n_productions) if self.lhs[p] != self.start]
+
+        return '\n'.join(self.production_str(p) for p in order)
+
+    def sample_production(self, symbol: int, rng=random) -> int:
+        """
+        Choose a production for a nonterminal, weighted by the production probabilities (uniformly for a CFG).
+        This consumes the random number generator exactly like `random.choices(productions, weights)`
+        for a PCFG and `random.choice(productions)` for a CFG.
+        """
+
+        lo, hi = self.prod_offsets[symbol], self.prod_offsets[symbol + 1]
+        if lo == hi:
+            raise ValueError(f"The nonterminal {self.nonterminals[symbol]} has no productions.")
+
+        if self.probs is None:
+            return rng.randrange(lo, hi)
+
+        return bisect(self.cum_weights, rng.random() * self.cum_weights[hi - 1], lo, hi - 1)
+
+    def alias_tables(self) -> tuple[list[float], list[int]]:
+        """
+        Return Walker/Vose alias tables for O(1) production sampling, aligned with the productions.\\
+        To sample nonterminal `A` with `n` productions starting at `lo`: draw `u = random() * n`,
+        take `p = lo + int(u)` and keep `p` if `u - int(u) < alias_prob[p]`, otherwise use `alias[p]`.
+        """
+
+        if self._alias is not None:
+            return self._alias
+
+        alias_prob = [1.0] * self.n_productions
+        alias = list(range(self.n_productions))
+
+        for symbol in range(len(self.nonterminals)):
+            lo, hi = self.prod_offsets[symbol], self.prod_offsets[symbol + 1]
+            n = hi - lo
+            if n == 0 or self.probs is None:
+                continue
+
+            total = sum(self.probs[lo:hi])
+            scaled = [self.probs[p] * n / total for p in range(lo, hi)]
+            small = [i for i in range(n) if scaled[i] < 1.0]
+            large = [i for i in range(n) if scaled[i] >= 1.0]
+
+            while small and large:
+                i, j = small.pop(), large[-1]
+                alias_prob[lo + i] = scaled[i]
+                alias[lo + i] = lo + j
+                scaled[j] -= 1.0 - scaled[i]
+                if scaled[j] < 1.0:
+                    small.append(large.pop())
+
+            # whatever is left is 1 up to rounding errors
+            for i in small + large:
+                alias_prob[lo + i] = 1.0
+
+        self._alias = (alias_prob, alias)
+        return self._alias
+
+    def __getstate__(self):
+        # the nltk object can be rebuilt from the arrays, no need to ship it around
+        state = self.__dict__.copy()
+        state['_grammar'] = None
+        state['cache'] = {}
+        return state
+
+    def __repr__(self) -> str:
+        kind = 'PCFG' if self.is_probabilistic else 'CFG'
+        return f'<CompiledGrammar {kind} with {self.n_productions} productions ({self.content_hash[:12]})>'
+
+    def __str__(self) -> str:
+        return self.to_string()
+
+
+# parsed grammars, keyed by the hash of their content
+COMPILED_CACHE_SIZE = 256
+_compiled_cache: OrderedDict[str, CompiledGrammar] = OrderedDict()
+
+def grammar_hash(text: str) -> str:
+    """
+    Return the content hash of a grammar string.
+    """
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+# the tokens of the nltk grammar format, the same expressions as nltk.grammar.read_grammar
+_NONTERMINAL_RE = re.compile(r"( [\w/][\w/^<>-]* ) \s*", re.VERBOSE)
+_ARROW_RE = re.compile(r"\s* -> \s*", re.VERBOSE)
+_PROBABILITY_RE = re.compile(r"( \[ [\d\.]+ \] ) \s*", re.VERBOSE)
+_TERMINAL_RE = re.compile(r'( "[^"]*" | \'[^\']*\' ) \s*', re.VERBOSE)
+_DISJUNCTION_RE = re.compile(r"\| \s*", re.VERBOSE)
+
+# how far the probabilities of a nonterminal may be from 1, like nltk.PCFG.EPSILON
+PROBABILITY_EPSILON = 0.01
+
+def _read_nonterminal(line: str, pos: int) -> tuple[str, int]:
+    m = _NONTERMINAL_RE.match(line, pos)
+    if not m:
+        raise ValueError("Expected a nonterminal, found: " + line[pos:])
+    return m.group(1), m.end()
+
+def _read_production(line: str, probabilistic: bool) -> list[tuple]:
+    """Read one line `A -> B "c" [0.5] | ...` into `(lhs, rhs, prob)` productions."""
+
+    lhs, pos = _read_nonterminal(line, 0)
+
+    m = _ARROW_RE.match(line, pos)
+    if not m:
+        raise ValueError("Expected an arrow")
+    pos = m.end()
+
+    probabilities = [0.0]
+    rhs_list = [[]]
+    while pos < len(line):
+        m = _PROBABILITY_RE.match(line, pos)
+        if probabilistic and m:
+            pos = m.end()
+            probabilities[-1] = float(m.group(1)[1:-1])
+            if probabilities[-1] > 1.0:
+                raise ValueError(f"Production probability {probabilities[-1]:f}, should not be greater than 1.0")
+        elif line[pos] in '\'"':
+            m = _TERMINAL_RE.match(line, pos)
+            if not m:
+                raise ValueError("Unterminated string")
+            rhs_list[-1].append((m.group(1)[1:-1], False))
+            pos = m.end()
+        elif line[pos] == '|':
+            m = _DISJUNCTION_RE.match(line, pos)
+            probabilities.append(0.0)
+            rhs_list.append([])
+            pos = m.end()
+        else:
+            symbol, pos = _read_nonterminal(line, pos)
+            rhs_list[-1].append((symbol, True))
+
+    return [(lhs, tuple(rhs), probability if probabilistic else None) for rhs, probability in zip(rhs_list, probabilities)]
+
+def parse_grammar(text: str, probabilistic: bool) -> tuple[str, list[tuple]]:
+    """
+    Read a grammar string in the nltk format without importing nltk.\\
+    Returns the start symbol and the productions `(lhs, rhs, prob)` for `CompiledGrammar.from_productions`.
+    Accepts and rejects the same strings as `nltk.CFG.fromstring` and `nltk.PCFG.fromstring`:
+    comments, line continuations with `\\`, the `%start` directive, and for a PCFG the check
+    that the probabilities of every nonterminal sum to 1.
+    """
+
+    start = None
+    productions = []
+    continue_line = ''
+
+    for number, line in enumerate(text.split('\n')):
+        line = continue_line + line.strip()
+        if line.startswith('#') or line == '':
+            continue
+        if line.endswith('\\'):
+            continue_line = line[:-1].rstrip() + ' '
+            continue
+        continue_line = ''
+
+        try:
+            if line[0] == '%':
+                directive, args = line[1:].split(None, 1)
+                if directive != 'start':
+                    raise ValueError("Bad directive")
+                start, pos = _read_nonterminal(args, 0)
+                if pos != len(args):
+                    raise ValueError("Bad argument to start directive")
+            else:
+                productions += _read_production(line, probabilistic)
+        except ValueError as e:
+            raise ValueError(f"Unable to parse line {number + 1}: {line}\n{e}") from e
+
+    if not productions:
+        raise ValueError("No productions found!")
+    if start is None:
+        start = productions[0][0]
+
+    if probabilistic:
+        totals = {}
+        for lhs, rhs, prob in productions:
+            totals[lhs] = totals.get(lhs, 0.0) + prob
+        for lhs, total in totals.items():
+            if not (1 - PROBABILITY_EPSILON) < total < (1 + PROBABILITY_EPSILON):
+                raise ValueError(f"Productions for {lhs} do not sum to 1")
+
+    return start, productions
+
+def _has_probabilities(text: str) -> bool:
+    """
+    Check for probabilities in a grammar string: a `[` or `]` outside of its quoted terminals and comments.
+    """
+    for line in text.split('\n'):
+        if line.strip().startswith('#'):
+            continue
+        line = _TERMINAL_RE.sub('', line)
+        if '[' in line or ']' in line:
+            return True
+    return False
+
+def _is_nltk_grammar(grammar, probabilistic: bool = False) -> bool:
+    """
+    Check for an nltk CFG (or PCFG if `probabilistic`) without importing nltk: if it was never imported, there are no nltk objects.
+    """
+    nltk = sys.modules.get('nltk')
+    return nltk is not None and isinstance(grammar, nltk.PCFG if probabilistic else nltk.CFG)
+
+def compile_grammar(grammar: str | list[str] | nltk.CFG | nltk.PCFG | CompiledGrammar, probabilistic: bool | None = None) -> CompiledGrammar:
+    """
+    Compile a grammar into a `CompiledGrammar`.\\
+    Grammars are cached by content, so the same grammar text is only parsed once.
+    - grammar: a grammar string, a list of rules, an nltk CFG/PCFG or an already compiled grammar
+    - probabilistic (`bool | None`): whether to parse strings as a PCFG. If `None`, strings with probabilities `[p]` are PCFGs.
+    """
+
+    if isinstance(grammar, CompiledGrammar):
+        return grammar
+
+    if isinstance(grammar, list):
+        grammar = '\n'.join(grammar)
+
+    if isinstance(grammar, str):
+        if probabilistic is None:
+            probabilistic = _has_probabilities(grammar)
+        key = ('pcfg:' if probabilistic else 'cfg:') + grammar_hash(grammar)
+    elif _is_nltk_grammar(grammar):
+        # probabilities are written out in full, so close probabilities don't share a key
+        productions = [f'{production.lhs()!r} -> {production.rhs()!r} {getattr(production, "prob", lambda: None)()!r}' for production in grammar.productions()]
+        key = f'{type(grammar).__name__}:{grammar.start()!r}:' + grammar_hash('\n'.join(productions))
+    else:
+        raise ValueError("The grammar must be a string, a list of rules, a CFG/PCFG object or a compiled grammar.")
+
+    compiled = _compiled_cache.get(key)
+    if compiled is not None:
+        _compiled_cache.move_to_end(key)
+        return compiled
+
+    start_time = time.perf_counter()
+
+    # strings are read without nltk, the nltk object is only built if someone asks for it
+    if isinstance(grammar, str):
+        start, productions = parse_grammar(grammar, probabilistic)
+        compiled = CompiledGrammar.from_productions(start, productions, probabilistic)
+        compiled._source = grammar
+    else:
+        compiled = CompiledGrammar.from_nltk(grammar)
+    _cache_compiled(key, compiled)
+
+    if instrumentation.enabled:
+        instrumentation.record(compiled.content_hash, 'parses')
+        instrumentation.record(compiled.content_hash, 'parse_seconds', time.perf_counter() - start_time)
+
+    return compiled
+
+def _cache_compiled(key: str, compiled: CompiledGrammar):
+    _compiled_cache[key] = compiled
+    if len(_compiled_cache) > COMPILED_CACHE_SIZE:
+        _compiled_cache.popitem(last=False)
+
+def register_compiled(text: str | None, compiled: CompiledGrammar):
+    """
+    Put a grammar that was compiled without parsing into the cache, under the grammar string it was formatted as.\\
+    Later calls with that string are served from the cache instead of being parsed by nltk.
+    With `text=None` the grammar is put under `compiled.to_string()`, by its content hash, without formatting it.
+    """
+    key = ('pcfg:' if compiled.is_probabilistic else 'cfg:') + (compiled.content_hash if text is None else grammar_hash(text))
+    _cache_compiled(key, compiled)
+
+def to_pcfg(grammar: str | nltk.PCFG | CompiledGrammar) -> nltk.PCFG:
     """
     Transform a string into a PCFG object.
+    Strings are parsed only once, repeated calls are served from the compiled grammar cache.
     """
 
+    start_time = time.perf_counter()
+    compiled = None
+
     if isinstance(grammar, str) or isinstance(grammar, list):
-        grammar = nltk.PCFG.fromstring(grammar)
-    elif not isinstance(grammar, nltk.PCFG):
+        compiled = compile_grammar(grammar, probabilistic=True)
+        grammar = compiled.grammar
+    elif isinstance(grammar, CompiledGrammar):
+        if not grammar.is_probabilistic:
+            raise ValueError("The compiled grammar is not a PCFG.")
+        compiled = grammar
+        grammar = grammar.grammar
+    elif not _is_nltk_grammar(grammar, probabilistic=True):
         raise ValueError("The grammar must be a string or an CFG object.")
-    
+
+    # an nltk PCFG is returned as it is, there is nothing to time
+    if instrumentation.enabled and compiled is not None:
+        instrumentation.record(compiled.content_hash, 'to_pcfg_calls')
+        instrumentation.record(compiled.content_hash, 'to_pcfg_seconds', time.perf_counter() - start_time)
+
     return grammar
 
-def to_cfg(grammar: str | nltk.CFG) -> nltk.CFG:
+def to_cfg(grammar: str | nltk.CFG | CompiledGrammar) -> nltk.CFG:
     """
     Transform a string into a CFG object.
+    Strings are parsed only once, repeated calls are served from the compiled grammar cache.
     """
 
     if isinstance(grammar, str) or isinstance(grammar, list):
-        grammar = nltk.CFG.fromstring(grammar)
-    elif not isinstance(grammar, nltk.CFG):
+        grammar = compile_grammar(grammar, probabilistic=False).grammar
+    elif isinstance(grammar, CompiledGrammar):
+        grammar = grammar.grammar
+    elif not _is_nltk_grammar(grammar):
         raise ValueError("The grammar must be a string or an CFG object.")
     
     return grammar
 
-def to_grammar(grammar: str | nltk.CFG | nltk.PCFG) -> nltk.CFG | nltk.PCFG:
+def to_grammar(grammar: str | nltk.CFG | nltk.PCFG | CompiledGrammar) -> nltk.CFG | nltk.PCFG:
     """
     Automatically translate a string into a CFG or PCFG object.
     """
 
-    if isinstance(grammar, str):
-        # if the grammar is a string AND contains '[' or ']', it is a PCFG
-        # otherwise, it is a CFG
-        if '[' in grammar or ']' in grammar:
-            grammar = to_pcfg(grammar)
-        else:
-            grammar = to_cfg(grammar)
+    if isinstance(grammar, str) or isinstance(grammar, list) or isinstance(grammar, CompiledGrammar):
+        grammar = compile_grammar(grammar).grammar
     
     return grammar
\ No newline at end of file